@@ -0,0 +1,76 @@
+"""
+Staging a 10k-track playlist in append_data: one INSERT per data.iterrows() row vs SQLWork.append_tracks'
+multi-row INSERT batches.
+
+Statements go through mysql-connector's own MySQLCursor (parameter escaping, executemany's multi-row rewrite)
+over a connection that only records them, so the client side cost is real and each statement is one round trip.
+The network / server side is estimated from a fixed round trip time per statement.
+
+Run from flask_app/: python benchmarks/bench_append.py
+"""
+from synthetic import make_rec_dataset, timeit
+from mysql.connector.conversion import MySQLConverter
+from mysql.connector.cursor import MySQLCursor
+from feature_store import DATASET_COLUMNS
+from sql_work import append_rows, APPEND_BATCH_SIZE, QUOTED_COLUMNS
+
+NUM_TRACKS = 10000
+ROUND_TRIP_MS = 0.5 # Same-region RDS, the server's per-statement parse / commit overhead not included
+
+QUERY = f"""
+    INSERT INTO append_data ({', '.join(QUOTED_COLUMNS)})
+    VALUES ({', '.join(['%s'] * len(DATASET_COLUMNS))})
+"""
+
+
+class RecordingConnection:
+    python_charset = 'utf8'
+    sql_mode = None
+    get_warnings = False
+    raise_on_warnings = False
+
+    def __init__(self):
+        self.converter = MySQLConverter('utf8mb4', True)
+        self.statements = 0
+        self.sent_bytes = 0
+
+    def handle_unread_result(self):
+        pass
+
+    def cmd_query(self, statement):
+        self.statements += 1
+        self.sent_bytes += len(statement)
+        return {'affected_rows': 1, 'insert_id': 0, 'warning_count': 0, 'status_flag': 0}
+
+    def cursor(self):
+        cursor = MySQLCursor()
+        cursor._connection = self
+        return cursor
+
+
+def per_row_insert(data, connection):
+    cursor = connection.cursor()
+    for _, row in data.iterrows():
+        cursor.execute(QUERY, tuple(row[column] for column in DATASET_COLUMNS))
+
+
+def bulk_insert(data, connection):
+    cursor = connection.cursor()
+    rows = append_rows(data)
+    for start in range(0, len(rows), APPEND_BATCH_SIZE):
+        cursor.executemany(QUERY, rows[start:start + APPEND_BATCH_SIZE])
+
+
+def main():
+    data = make_rec_dataset(NUM_TRACKS)[DATASET_COLUMNS]
+    print(f"{'insert':>8} {'client ms':>10} {'statements':>11} {'sent MB':>8} {'est. total ms':>14}")
+    for name, func in (('per row', per_row_insert), ('bulk', bulk_insert)):
+        connection = RecordingConnection()
+        func(data, connection)
+        elapsed = timeit(lambda: func(data, RecordingConnection()), repeat=3)
+        total = elapsed + connection.statements * ROUND_TRIP_MS
+        print(f"{name:>8} {elapsed:>10.1f} {connection.statements:>11} {connection.sent_bytes / 1024**2:>8.1f} {total:>14.1f}")
+
+
+if __name__ == '__main__':
+    main()
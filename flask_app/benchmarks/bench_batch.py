@@ -0,0 +1,81 @@
+"""
+Per-seed throughput: N sequential recommend_by_playlist calls (one RecEngine per request, as /t4/recommend does)
+vs one RecEngine.recommend_many call for the same N seeds (/t4/recommend/batch).
+
+Spotify calls are replaced by offline stand-ins so only the recommendation work is timed.
+
+Run from flask_app/: python benchmarks/bench_batch.py
+"""
+import contextlib
+import io
+import random
+from synthetic import make_rec_dataset, timeit, GENRES
+import numpy as np
+import pandas as pd
+from feature_store import FeatureStore
+from rec_engine import RecEngine
+
+NUM_TRACKS = 200000
+
+
+class OfflineSpotipy:
+    def artist_related_artists(self, artist_id):
+        i = int(artist_id.split('_')[1])
+        return {'artists': [{'id': f'aid_{i + k}', 'name': f'artist_{i + k}'} for k in range(1, 6)]}
+
+
+class OfflineSpotifyClient:
+    """predict() returns already labelled tracks, the genre model isn't part of what's measured"""
+    sp = OfflineSpotipy()
+
+    def __init__(self, top_tracks):
+        self.top_tracks = top_tracks
+
+    def predict(self, data, choice, class_items):
+        return self.top_tracks.copy()
+
+
+def as_playlist(store, rows):
+    playlist = store.frame(rows).reset_index(drop=True).rename(columns={'artists': 'artist', 'track_name': 'name', 'track_id': 'id'})
+    playlist['date_added'] = (pd.Timestamp('2024-06-01') - pd.to_timedelta(np.arange(len(rows)) * 9, unit='D')).astype('int64') // 10**6
+    return playlist
+
+
+def main():
+    store = FeatureStore(make_rec_dataset(NUM_TRACKS))
+    rng = np.random.default_rng(0)
+    sp = OfflineSpotifyClient(as_playlist(store, rng.choice(len(store), 20, replace=False)))
+    user_top_artists = [{'artist_id': f'aid_{i}', 'artist_name': f'artist_{i}', 'short_term_rank': r + 1} for r, i in enumerate([3, 17, 40, 77, 120])]
+
+    seeds = []
+    engine = RecEngine(sp, 'bench', None, store)
+    for i in range(16):
+        rows = store.genre_rows(GENRES[i % 18:i % 18 + 3])
+        playlist = as_playlist(store, rng.choice(rows, 60, replace=False))
+        vector = engine.playlist_vector(playlist)
+        top_genres, top_ratios = engine.get_top_genres(vector)
+        seeds.append({'type': 'playlist', 'vector': vector, 'track_ids': set(playlist['id']), 'recommended_ids': [],
+                      'top_genres': top_genres, 'top_ratios': top_ratios})
+
+    def sequential(batch):
+        random.seed(0)
+        return [RecEngine(sp, 'bench', None, store).recommend_by_playlist(seed['vector'], seed['track_ids'], [None] * 20, user_top_artists,
+                                                                         {}, seed['top_genres'], seed['top_ratios'], []) for seed in batch]
+
+    def batched(batch):
+        random.seed(0)
+        return RecEngine(sp, 'bench', None, store).recommend_many(batch, [None] * 20, user_top_artists, {})
+
+    # Near-tied scores can swap between the GEMV and GEMM rounding, so compare the recommended sets
+    print(f"{'seeds':>6} {'sequential ms/seed':>19} {'batch ms/seed':>14} {'speedup':>8} {'overlap':>8}")
+    for num_seeds in (1, 4, 16):
+        batch = seeds[:num_seeds]
+        with contextlib.redirect_stdout(io.StringIO()):
+            overlap = np.mean([len(set(a) & set(b)) / max(len(a), 1) for a, b in zip(sequential(batch), batched(batch))])
+            sequential_ms = timeit(lambda: sequential(batch), repeat=3) / num_seeds
+            batch_ms = timeit(lambda: batched(batch), repeat=3) / num_seeds
+        print(f"{num_seeds:>6} {sequential_ms:>19.2f} {batch_ms:>14.2f} {sequential_ms / batch_ms:>7.2f}x {overlap:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Scoring memory per request vs number of candidate rows: one weighted_cosine_many over every candidate
+(slice of the encoded matrix + full score matrix) vs FeatureStore.score_chunks with a RunningTopK per seed.
+
+Peaks are tracemalloc peaks of the scoring step, the resident store itself isn't counted.
+
+Run from flask_app/: python benchmarks/bench_chunked.py
+"""
+import tracemalloc
+from synthetic import make_rec_dataset, timeit, GENRES
+import numpy as np
+from feature_store import FeatureStore
+from scoring import weighted_cosine_many, grouped_top_k, genre_weight_vector, RunningTopK
+
+NUM_SEEDS = 4
+K = 30
+
+
+def full_scoring(store, rows, genre_weights, queries, wanted):
+    similarity = weighted_cosine_many(store.encoded[rows], store.feature_sqnorms[rows], store.schema_genre_codes[rows], genre_weights, queries)
+    groups = store.genre_codes[rows]
+    return [rows[grouped_top_k(similarity[:, i], groups, wanted, K)] for i in range(len(queries))]
+
+
+def chunked_scoring(store, rows, genre_weights, queries, wanted):
+    top_songs = [RunningTopK(wanted, K) for _ in queries]
+    for _, chunk_rows, similarity in store.score_chunks(rows, genre_weights, queries):
+        groups = store.genre_codes[chunk_rows]
+        for i, running in enumerate(top_songs):
+            running.push(chunk_rows, similarity[:, i], groups)
+    return [running.result()[0] for running in top_songs]
+
+
+def peak_mb(func, *args):
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024**2
+
+
+def main():
+    rng = np.random.default_rng(0)
+    print(f"{'candidates':>10} {'full ms':>8} {'chunked ms':>11} {'full peak MB':>13} {'chunked peak MB':>16} {'same':>5}")
+    for num_tracks in (50000, 200000, 800000):
+        store = FeatureStore(make_rec_dataset(num_tracks))
+        rows = np.arange(len(store), dtype=np.int32) # Broadest possible selection, every track is a candidate
+        wanted = [store.genre_lookup[genre] for genre in GENRES[:3]]
+        queries = store.encoded[rng.choice(len(store), NUM_SEEDS)]
+        genre_weights = np.stack([genre_weight_vector({GENRES[0]: 0.5, GENRES[1]: 0.3, GENRES[2]: 0.2, 'default': 0.16})] * NUM_SEEDS)
+        args = (store, rows, genre_weights, queries, wanted)
+
+        same = all(np.array_equal(a, b) for a, b in zip(full_scoring(*args), chunked_scoring(*args)))
+        full_ms, chunked_ms = timeit(lambda: full_scoring(*args), repeat=3), timeit(lambda: chunked_scoring(*args), repeat=3)
+        print(f"{num_tracks:>10} {full_ms:>8.1f} {chunked_ms:>11.1f} {peak_mb(full_scoring, *args):>13.1f} {peak_mb(chunked_scoring, *args):>16.1f} {str(same):>5}")
+
+
+if __name__ == '__main__':
+    main()
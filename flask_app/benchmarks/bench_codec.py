@@ -0,0 +1,51 @@
+"""
+Session values in Redis: pickled vectors (one-row DataFrame as cached before the feature schema, and ndarray) vs
+the binary vector codec, json vs orjson for the prev recs / top data payloads. Size on the wire and best
+encode / decode time of a batch.
+
+Run from flask_app/: python benchmarks/bench_codec.py
+"""
+from synthetic import timeit
+import json
+import pickle
+import numpy as np
+import pandas as pd
+from codec import encode_vector, encode_json, decode
+from feature_schema import FEATURES, NUM_FEATURES
+
+BATCH = 1000
+
+
+def legacy_load(payload):
+    # SessionStore.get_data before the codec: pickle first, JSON when that fails
+    try:
+        return pickle.loads(payload)
+    except (pickle.UnpicklingError, EOFError):
+        return json.loads(payload)
+
+
+def report(name, value, encode, load):
+    payload = encode(value)
+    encode_ms = timeit(lambda: [encode(value) for _ in range(BATCH)])
+    decode_ms = timeit(lambda: [load(payload) for _ in range(BATCH)])
+    print(f"{name:<22} {len(payload):>8} {encode_ms * 1000 / BATCH:>10.1f} {decode_ms * 1000 / BATCH:>10.1f}")
+
+
+def main():
+    rng = np.random.default_rng(0)
+    vector = rng.random(NUM_FEATURES).astype(np.float32)
+    prev_rec = {
+        'track_ids': [f'{i:022d}' for i in range(200)],
+        'recommended_ids': [f'{i:022d}' for i in range(200, 700)],
+    }
+
+    print(f"{'payload':<22} {'bytes':>8} {'encode us':>10} {'decode us':>10}")
+    report('pickle DataFrame', pd.DataFrame([vector], columns=FEATURES), pickle.dumps, legacy_load)
+    report('pickle ndarray', vector, pickle.dumps, legacy_load)
+    report('vector codec', vector, encode_vector, decode)
+    report('json prev rec', prev_rec, lambda value: json.dumps(value).encode(), legacy_load)
+    report('orjson prev rec', prev_rec, encode_json, decode)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""
+Per-request encode cost: legacy RecEngine.ohe_features vs slicing the precomputed encoded matrix.
+
+Run from flask_app/: python benchmarks/bench_encode.py
+"""
+from synthetic import make_rec_dataset, timeit, GENRES
+import pandas as pd
+from feature_store import FeatureStore
+from feature_schema import GENRE_COUNTS_PATH
+
+
+def legacy_ohe_features(df):
+    # RecEngine.ohe_features before the precomputed layout
+    all_genres = pd.read_csv(GENRE_COUNTS_PATH)
+    df = pd.get_dummies(df, columns=['track_genre', 'mode', 'key'])
+    ohe_columns = [col for col in df.columns if 'track_genre' in col or 'mode' in col or 'key' in col]
+    df[ohe_columns] = df[ohe_columns].astype(int)
+
+    expected_genres = {'track_genre_' + genre for genre in all_genres['track_genre']}
+    for genre in expected_genres - set(df.columns):
+        df[genre] = 0
+    expected_keys_modes = {f'key_{i}' for i in range(12)} | {f'mode_{i}' for i in range(2)}
+    for key_mode in expected_keys_modes - set(df.columns):
+        df[key_mode] = 0
+    return df
+
+
+def main():
+    store = FeatureStore(make_rec_dataset(200000))
+    print(f"Store: {len(store)} tracks, version {store.version}")
+    print(f"{'genres':>8} {'rows':>8} {'legacy ms':>10} {'slice ms':>10}")
+    for num_genres in (1, 3, 6):
+        rows = store.genre_rows(GENRES[:num_genres])
+        dataset = store.frame(rows)
+
+        legacy = timeit(lambda: legacy_ohe_features(dataset))
+        sliced = timeit(lambda: store.encoded[rows])
+        print(f"{num_genres:>8} {len(rows):>8} {legacy:>10.2f} {sliced:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
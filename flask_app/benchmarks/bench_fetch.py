@@ -0,0 +1,69 @@
+"""
+Client side cost of a 50k-row genre pull: get_dataset's dictionary cursor + pd.DataFrame(fetchall())
+vs the columnar fetch (tuple cursor, fetchmany chunks into typed arrays).
+
+The cursors below stand in for mysql-connector's: rows are produced lazily as the driver returns them off the
+socket, the dictionary cursor additionally builds one dict per row. Driver-side parsing is the same for both
+paths and not measured.
+
+Run from flask_app/: python benchmarks/bench_fetch.py
+"""
+import itertools
+import tracemalloc
+from synthetic import make_rec_dataset, timeit
+import pandas as pd
+from feature_store import DATASET_COLUMNS
+from sql_work import read_columnar
+
+NUM_ROWS = 50000
+
+
+class StreamingCursor:
+    def __init__(self, columns, dictionary=False):
+        self.description = [(name,) for name in columns]
+        self._rows = zip(*columns.values())
+        self._dictionary = dictionary
+
+    def _next(self, size=None):
+        rows = itertools.islice(self._rows, size)
+        if self._dictionary:
+            names = [column[0] for column in self.description]
+            return [dict(zip(names, row)) for row in rows]
+        return list(rows)
+
+    def fetchall(self):
+        return self._next()
+
+    def fetchmany(self, size):
+        return self._next(size)
+
+
+def legacy_fetch(columns):
+    return pd.DataFrame(StreamingCursor(columns, dictionary=True).fetchall())
+
+
+def columnar_fetch(columns):
+    return read_columnar(StreamingCursor(columns))
+
+
+def peak_mb(func, *args):
+    tracemalloc.start()
+    result = func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024**2, result
+
+
+def main():
+    dataset = make_rec_dataset(NUM_ROWS)[DATASET_COLUMNS]
+    columns = {name: dataset[name].tolist() for name in DATASET_COLUMNS} # Python values, as the driver returns them
+
+    print(f"{'fetch':>9} {'ms':>8} {'peak MB':>8} {'frame MB':>9}")
+    for name, func in (('dict', legacy_fetch), ('columnar', columnar_fetch)):
+        elapsed = timeit(lambda: func(columns), repeat=3)
+        peak, frame = peak_mb(func, columns)
+        print(f"{name:>9} {elapsed:>8.1f} {peak:>8.1f} {frame.memory_usage(deep=True).sum() / 1024**2:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Cold playlist request: live recommend_by_playlist + recommend_playist_to_playlist vs serving the precomputed
+lookup table (lookup + recommend_precomputed), plus the offline job's throughput.
+
+Run from flask_app/: python benchmarks/bench_precompute.py
+"""
+import contextlib
+import io
+import time
+from synthetic import make_rec_dataset, timeit, GENRES
+import numpy as np
+from feature_store import FeatureStore
+from rec_engine import RecEngine
+from playlist_index import PlaylistVectorIndex
+from precompute import precompute
+from bench_batch import OfflineSpotifyClient, as_playlist
+
+NUM_TRACKS = 200000
+NUM_PLAYLISTS = 2000
+
+
+def main():
+    store = FeatureStore(make_rec_dataset(NUM_TRACKS))
+    rng = np.random.default_rng(0)
+    sp = OfflineSpotifyClient(as_playlist(store, rng.choice(len(store), 20, replace=False)))
+    user_top_artists = [{'artist_id': f'aid_{i}', 'artist_name': f'artist_{i}', 'short_term_rank': r + 1} for r, i in enumerate([3, 17, 40, 77, 120])]
+    engine = RecEngine(sp, 'bench', None, store)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        playlists = [as_playlist(store, rng.choice(store.genre_rows(GENRES[i % 18:i % 18 + 3]), 60, replace=False)) for i in range(NUM_PLAYLISTS)]
+        vectors = np.stack([engine.playlist_vector(playlist) for playlist in playlists])
+        playlist_ids = np.array([f'playlist_{i}' for i in range(NUM_PLAYLISTS)], dtype=object)
+        index = PlaylistVectorIndex(playlist_ids, vectors)
+
+        start_time = time.perf_counter()
+        table = precompute(engine, playlist_ids, vectors)
+        precompute_s = time.perf_counter() - start_time
+
+    print(f"precompute: {NUM_PLAYLISTS} playlists in {precompute_s:.2f} s, table {table.nbytes / 1024**2:.2f} MB")
+
+    playlist, vector = playlists[7], vectors[7]
+    track_ids = set(playlist['id'])
+    top_genres, top_ratios = engine.get_top_genres(vector)
+
+    def live():
+        re = RecEngine(sp, 'bench', None, store)
+        re.recommend_by_playlist(vector, track_ids, [None] * 20, user_top_artists, {}, top_genres, top_ratios, [])
+        re.recommend_playist_to_playlist('playlist_7', vector, index, [], [])
+
+    def precomputed():
+        rows, similarity, neighbour_ids = table.lookup('playlist_7', vector)
+        RecEngine(sp, 'bench', None, store).recommend_precomputed(rows, similarity, track_ids, top_genres, top_ratios)
+        [playlist_id for playlist_id in neighbour_ids if playlist_id in index][:9]
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        live_ms = timeit(live)
+        precomputed_ms = timeit(precomputed)
+    print(f"{'live ms':>10} {'precomputed ms':>15} {'speedup':>8}")
+    print(f"{live_ms:>10.2f} {precomputed_ms:>15.2f} {live_ms / precomputed_ms:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+Scoring cost per request: apply_weights + calc_cosine_similarity as they were vs the fused weighted_cosine kernel.
+
+Run from flask_app/: python benchmarks/bench_scoring.py
+"""
+from synthetic import make_rec_dataset, timeit, GENRES
+import numpy as np
+from sklearn.metrics.pairwise import cosine_similarity
+from feature_store import FeatureStore
+from feature_schema import GENRE_SLICE, NUM_SCORED
+from scoring import weighted_cosine, genre_weight_vector
+
+
+def legacy_score(dataset, ohe_dataset, vector, weights):
+    # RecEngine.apply_weights: scale the genre columns of a fresh copy
+    ohe_dataset = ohe_dataset.copy()
+    column_weights = np.ones(NUM_SCORED, dtype=np.float32)
+    column_weights[GENRE_SLICE] = [weights.get(genre, weights['default']) for genre in GENRES]
+    ohe_dataset *= column_weights
+
+    # RecEngine.calc_cosine_similarity: sklearn cosine, then map genre weights through pandas
+    dataset['similarity'] = cosine_similarity(ohe_dataset, vector.reshape(1, -1))[:, 0]
+    dataset['similarity'] *= dataset['track_genre'].map(weights).fillna(weights['default'])
+    return dataset['similarity'].to_numpy()
+
+
+def main():
+    store = FeatureStore(make_rec_dataset(200000))
+    rng = np.random.default_rng(0)
+    vector = rng.random(NUM_SCORED).astype(np.float32)
+    weights = {GENRES[0]: 0.5, GENRES[1]: 0.3, GENRES[2]: 0.2, 'default': 0.16}
+
+    print(f"{'rows':>8} {'legacy ms':>10} {'fused ms':>10} {'speedup':>8} {'max diff':>10}")
+    for num_rows in (10000, 50000, 200000):
+        rows = np.arange(num_rows)
+        dataset = store.frame(rows)
+        ohe_dataset = store.encoded[rows]
+        sqnorms = store.feature_sqnorms[rows]
+        codes = store.schema_genre_codes[rows]
+
+        legacy = timeit(lambda: legacy_score(dataset, ohe_dataset, vector, weights))
+        fused = timeit(lambda: weighted_cosine(ohe_dataset, sqnorms, codes, genre_weight_vector(weights), vector))
+        diff = np.abs(legacy_score(dataset, ohe_dataset, vector, weights)
+                      - weighted_cosine(ohe_dataset, sqnorms, codes, genre_weight_vector(weights), vector)).max()
+        print(f"{num_rows:>8} {legacy:>10.2f} {fused:>10.2f} {legacy / fused:>7.1f}x {diff:>10.2e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Offline recall@k of the IVF TrackIndex against the exact weighted cosine scorer, per nprobe setting.
+
+For sampled query tracks the exact top k of their genre is compared with the top k of the rows the index probes.
+Synthetic features are uniformly random, so recall here is a lower bound for the clustered real catalogue.
+
+Run from flask_app/: python benchmarks/eval_ann.py [num_tracks]
+"""
+import sys
+import time
+from synthetic import make_rec_dataset
+import numpy as np
+from feature_store import FeatureStore
+from feature_schema import SCORED
+from scoring import weighted_cosine, genre_weight_vector, top_k
+from ann_index import TrackIndex
+
+K = 45 # recommend_by_track keeps the top 45
+NUM_QUERIES = 200
+
+
+def search(store, rows, query, genre_weights, k):
+    scores = weighted_cosine(store.encoded[rows], store.feature_sqnorms[rows], store.schema_genre_codes[rows], genre_weights, query)
+    return rows[top_k(scores, k)]
+
+
+def main(num_tracks=200000):
+    store = FeatureStore(make_rec_dataset(num_tracks))
+    index = TrackIndex(store)
+    rng = np.random.default_rng(1)
+    queries = rng.choice(len(store), NUM_QUERIES, replace=False)
+
+    exact_ms = 0
+    exact = []
+    for row in queries:
+        genre = store.genres[store.genre_codes[row]]
+        genre_weights = genre_weight_vector({genre: 0.9, 'default': 0.8})
+        start_time = time.perf_counter()
+        exact.append(search(store, store.genre_rows(genre), store.encoded[row][SCORED], genre_weights, K))
+        exact_ms += (time.perf_counter() - start_time) * 1000
+
+    print(f"{len(store)} tracks, {index.num_lists} lists, exact search {exact_ms / NUM_QUERIES:.3f} ms/query")
+    print(f"{'nprobe':>7} {'recall@' + str(K):>10} {'rows scored':>12} {'ms/query':>9}")
+    for nprobe in (1, 2, 4, 8, 16):
+        recall = rows_scored = elapsed = 0
+        for row, expected in zip(queries, exact):
+            genre = store.genres[store.genre_codes[row]]
+            genre_weights = genre_weight_vector({genre: 0.9, 'default': 0.8})
+            start_time = time.perf_counter()
+            rows = index.genre_rows(genre, store.encoded[row], nprobe=nprobe, min_rows=K)
+            found = search(store, rows, store.encoded[row][SCORED], genre_weights, K)
+            elapsed += time.perf_counter() - start_time
+            recall += len(np.intersect1d(found, expected)) / len(expected)
+            rows_scored += len(rows)
+        print(f"{nprobe:>7} {recall / NUM_QUERIES:>10.3f} {rows_scored / NUM_QUERIES:>12.0f} {elapsed * 1000 / NUM_QUERIES:>9.3f}")
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,47 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+import time
+import numpy as np
+import pandas as pd
+from feature_schema import GENRES
+
+
+def make_rec_dataset(num_tracks, num_artists=None, seed=0):
+    """
+    Random rec_dataset shaped DataFrame, genre mix roughly following genre_counts.csv.
+    """
+    rng = np.random.default_rng(seed)
+    num_artists = num_artists or max(num_tracks // 20, 1)
+    artists = np.array([f'artist_{i}' for i in range(num_artists)], dtype=object)
+    return pd.DataFrame({
+        'artists': artists[rng.integers(0, num_artists, num_tracks)],
+        'track_name': [f'track_{i}' for i in range(num_tracks)],
+        'track_id': [f'{i:022d}' for i in range(num_tracks)],
+        'popularity': rng.integers(0, 100, num_tracks),
+        'duration_ms': rng.integers(60000, 400000, num_tracks),
+        'danceability': rng.random(num_tracks),
+        'energy': rng.random(num_tracks),
+        'key': rng.integers(0, 12, num_tracks),
+        'loudness': rng.uniform(-30, 0, num_tracks),
+        'mode': rng.integers(0, 2, num_tracks),
+        'speechiness': rng.random(num_tracks),
+        'acousticness': rng.random(num_tracks),
+        'instrumentalness': rng.random(num_tracks),
+        'liveness': rng.random(num_tracks),
+        'valence': rng.random(num_tracks),
+        'tempo': rng.uniform(60, 200, num_tracks),
+        'time_signature': rng.integers(3, 6, num_tracks).astype(float),
+        'track_genre': rng.choice(GENRES, num_tracks),
+    })
+
+
+def timeit(func, repeat=5):
+    """Best wall time of func() over repeat runs, in milliseconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start_time)
+    return best * 1000
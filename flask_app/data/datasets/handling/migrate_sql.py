@@ -1,7 +1,24 @@
+"""
+Load the rec_dataset catalogue CSV into MySQL.
+
+The CSV is read in chunks, each prepared column-wise (NULLs, string truncation) and written by one of a few
+worker threads, each with its own connection, as multi-row INSERTs committed per chunk. Row ids are the CSV row
+numbers, so re-writing a chunk is a no-op, and finished chunks are recorded in a checkpoint file: an
+interrupted load picks up where it stopped when run again.
+
+Run from flask_app/:
+
+    python data/datasets/handling/migrate_sql.py [--workers 4] [--chunk-size 5000] [--restart]
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import mysql.connector
 from dotenv import load_dotenv
-import os
 
 
 load_dotenv()
@@ -9,14 +26,38 @@ MYSQL_HOST = os.getenv("MYSQL_HOST")
 MYSQL_USER = os.getenv("MYSQL_USER")
 MYSQL_PASSWORD = os.getenv("MYSQL_PASSWORD")
 MYSQL_DB = os.getenv("MYSQL_DB")
-db = mysql.connector.connect(
+
+CSV_PATH = 'data/datasets/rec_dataset.csv'
+CHECKPOINT_PATH = 'data/datasets/rec_dataset.load_checkpoint.json'
+COLUMNS = [
+    'artists', 'track_name', 'track_id', 'popularity', 'duration_ms', 'danceability', 'energy', 'key',
+    'loudness', 'mode', 'speechiness', 'acousticness', 'instrumentalness', 'liveness', 'valence', 'tempo',
+    'time_signature', 'track_genre'
+]
+MAX_LENGTH = 255 # VARCHAR(255) columns
+CHUNK_SIZE = 5000 # CSV rows per chunk, the unit of work, commit and checkpoint
+BATCH_SIZE = 1000 # Rows per multi-row INSERT statement
+
+INSERT_QUERY = """
+INSERT INTO rec_dataset (id, {columns})
+VALUES ({placeholders})
+ON DUPLICATE KEY UPDATE id = id
+""".format(
+    columns=', '.join(f'`{column}`' for column in COLUMNS),
+    placeholders=', '.join(['%s'] * (len(COLUMNS) + 1))
+)
+
+
+def connect():
+    return mysql.connector.connect(
         host=MYSQL_HOST,
         user=MYSQL_USER,
         passwd=MYSQL_PASSWORD,
         database=MYSQL_DB
     )
 
-def create_table_query(cursor, df):
+
+def create_table(cursor):
     create_table_query = """
     CREATE TABLE IF NOT EXISTS rec_dataset (
         id INT AUTO_INCREMENT PRIMARY KEY,
@@ -42,49 +83,153 @@ def create_table_query(cursor, df):
     """
     cursor.execute(create_table_query)
 
-    values = []
-    for i, row in df.iterrows():
-        max_length = 255  # replace with the actual max length of your 'artists' column
-        row['artists'] = str(row['artists'])[:max_length]
-        row['track_name'] = str(row['track_name'])[:max_length]
-        row_values = (row['artists'], row['track_name'], row['track_id'], row['popularity'],
-                    row['duration_ms'], row['danceability'], row['energy'], row['key'],
-                    row['loudness'], row['mode'], row['speechiness'], row['acousticness'],
-                    row['instrumentalness'], row['liveness'], row['valence'], row['tempo'],
-                    row['time_signature'], row['track_genre'])
-        row_values = tuple(None if pd.isna(val) else val for val in row_values)
-        values.append(row_values)
-    insert_query = """
-    INSERT INTO rec_dataset (artists, track_name, track_id, popularity,
-                                duration_ms, danceability, energy, `key`, 
-                                loudness, mode, speechiness, acousticness, 
-                                instrumentalness, liveness, valence, tempo, 
-                                time_signature, track_genre)
-    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+
+def chunk_rows(chunk):
+    """
+    Insert parameters for a CSV chunk: (id, *COLUMNS) tuples of plain Python values, id being the CSV row number + 1.
+    Strings are cut to MAX_LENGTH and NaN becomes None (NULL), one column at a time.
+    """
+    values = [(chunk.index.to_numpy() + 1).tolist()]
+    for column in COLUMNS:
+        series = chunk[column]
+        if series.dtype == object:
+            series = series.astype(str).str[:MAX_LENGTH].where(series.notna())
+        array = series.to_numpy(dtype=object) # numpy scalars -> Python, which mysql-connector can convert
+        array[pd.isna(array)] = None
+        values.append(array)
+    return list(zip(*values))
+
+
+class Checkpoint:
+    """Numbers of the chunks already committed, saved to a JSON file after each one."""
+
+    def __init__(self, path, chunk_size):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.done = set()
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved['chunk_size'] == chunk_size:
+                self.done = set(saved['done'])
+            else:
+                print(f"Checkpoint {path} was written with chunks of {saved['chunk_size']} rows, starting over")
+
+    def mark(self, number):
+        with self._lock:
+            self.done.add(number)
+            if self.path:
+                temp_path = self.path + '.tmp'
+                with open(temp_path, 'w') as f:
+                    json.dump({'chunk_size': self.chunk_size, 'done': sorted(self.done)}, f)
+                os.replace(temp_path, self.path) # Never leaves a half-written checkpoint behind
+
+    def clear(self):
+        self.done = set()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def load(chunks, checkpoint, connect=connect, workers=4, batch_size=BATCH_SIZE):
     """
+    Insert every chunk not in the checkpoint, workers chunks at a time.
+
+    Args:
+        chunks (iterable): CSV chunks as DataFrames, indexed by CSV row number (pd.read_csv(chunksize=...)).
+        checkpoint (Checkpoint): Chunks to skip, marked as each one commits.
+        connect (callable): Opens a MySQL connection, one per worker thread.
+    Returns:
+        int: Rows inserted by this call.
+    """
+    local = threading.local()
+    connections = []
+    connections_lock = threading.Lock()
+    progress = {'rows': 0, 'chunks': 0}
+    progress_lock = threading.Lock()
+    start_time = time.perf_counter()
+
+    def write(number, chunk):
+        if not hasattr(local, 'connection'):
+            local.connection = connect()
+            with connections_lock:
+                connections.append(local.connection)
+        rows = chunk_rows(chunk)
+        cursor = local.connection.cursor()
+        try:
+            for start in range(0, len(rows), batch_size):
+                cursor.executemany(INSERT_QUERY, rows[start:start + batch_size])
+            local.connection.commit()
+        finally:
+            cursor.close()
+        checkpoint.mark(number)
+        with progress_lock:
+            progress['rows'] += len(rows)
+            progress['chunks'] += 1
+            elapsed = time.perf_counter() - start_time
+            print(f"Chunk {number} committed, {progress['rows']} rows in {elapsed:.1f} s ({progress['rows'] / elapsed:.0f} rows/s)")
+
     try:
-        cursor.executemany(insert_query, values)
-    except mysql.connector.DataError as e:
-        print(f"Error inserting row: {row}")
-        raise e
-    db.commit()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = []
+            try:
+                for number, chunk in enumerate(chunks):
+                    if number in checkpoint.done:
+                        continue
+                    pending.append(executor.submit(write, number, chunk))
+                    if len(pending) >= 2 * workers: # Bound the chunks held in memory
+                        pending.pop(0).result()
+                for future in pending:
+                    future.result()
+            except BaseException:
+                executor.shutdown(cancel_futures=True) # Chunks already being written still commit
+                raise
+    finally:
+        for connection in connections:
+            connection.close()
+    return progress['rows']
 
 
 def check_row_count(cursor, table_name):
     cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
     row_count = cursor.fetchone()[0]
     return row_count
+
+
 def main():
-    df = pd.read_csv('data/datasets/rec_dataset.csv')
-    
+    parser = argparse.ArgumentParser(description="Load the rec_dataset CSV into MySQL")
+    parser.add_argument('--csv', default=CSV_PATH)
+    parser.add_argument('--checkpoint', default=CHECKPOINT_PATH)
+    parser.add_argument('--workers', type=int, default=4, help="Parallel connections")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="CSV rows per committed chunk")
+    parser.add_argument('--restart', action='store_true', help="Ignore the checkpoint and load every chunk")
+    args = parser.parse_args()
 
+    db = connect()
     cursor = db.cursor()
-    # row_count = check_row_count(cursor, 'rec_dataset')
-    # print(f"Number of rows in table: {row_count}")
+    create_table(cursor)
+    cursor.close()
+    db.close()
 
-    create_table_query(cursor, df)
+    checkpoint = Checkpoint(args.checkpoint, args.chunk_size)
+    if args.restart:
+        checkpoint.clear()
+    elif checkpoint.done:
+        print(f"Resuming, {len(checkpoint.done)} chunks already loaded")
+
+    start_time = time.perf_counter()
+    chunks = pd.read_csv(args.csv, usecols=COLUMNS, chunksize=args.chunk_size)
+    rows = load(chunks, checkpoint, workers=args.workers)
+    elapsed = time.perf_counter() - start_time
+    print(f"Loaded {rows} rows in {elapsed:.1f} s ({rows / max(elapsed, 1e-9):.0f} rows/s)")
+
+    db = connect()
+    cursor = db.cursor()
+    print(f"Number of rows in table: {check_row_count(cursor, 'rec_dataset')}")
     cursor.close()
     db.close()
+    checkpoint.clear() # Complete, the next run starts from scratch
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,111 @@
+import numpy as np
+import time
+
+import utils as utils
+from feature_schema import GENRES, KEY_OFFSET, NUM_SCORED
+from scoring import top_k
+
+
+class TrackIndex:
+    """
+    Optional IVF (inverted file) index over the feature store's encoded tracks, partitioned by genre.
+
+    Every genre is clustered on its own with spherical k-means over the non-genre scored features, which is what
+    ranks tracks inside a genre. A query only visits the nprobe clusters whose centroids are closest to it, the
+    rows found there are scored exactly as before, so the index only prunes candidates.
+    nprobe trades recall for latency: nprobe >= the number of lists of a genre gives the exact result.
+    See benchmarks/eval_ann.py for recall@k against the exact scorer.
+    """
+
+    def __init__(self, store, list_size=64, nprobe=8, iterations=8, seed=0):
+        """
+        Args:
+            store (FeatureStore): Store to index, rows returned by the index are rows of this store.
+            list_size (int): Target number of tracks per cluster, each genre gets len(genre) // list_size clusters.
+            nprobe (int): Default number of clusters visited per genre and query.
+            iterations (int): k-means iterations.
+            seed (int): Seed for the k-means initialization.
+        """
+        self.store = store
+        self.list_size = list_size
+        self.nprobe = nprobe
+        self.version = store.version
+        self._centroids = {}
+        self._order = {}
+        self._bounds = {}
+
+        rng = np.random.default_rng(seed)
+        start_time = time.time()
+        with utils.track_memory_usage("build track index"):
+            for genre in GENRES:
+                rows = store.genre_rows(genre)
+                if len(rows):
+                    self._build_genre(genre, rows, iterations, rng)
+        print(f"Track index built in {time.time() - start_time:.2f} s: {len(self._centroids)} genres, {self.num_lists} lists")
+
+    @property
+    def num_lists(self):
+        return sum(len(centroids) for centroids in self._centroids.values())
+
+    @staticmethod
+    def _unit_rows(matrix):
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+    def _build_genre(self, genre, rows, iterations, rng):
+        points = self._unit_rows(self.store.encoded[rows, KEY_OFFSET:NUM_SCORED])
+        num_lists = max(1, len(rows) // self.list_size)
+        centroids = points[rng.choice(len(rows), num_lists, replace=False)]
+
+        for _ in range(iterations):
+            assignment = np.argmax(points @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, points)
+            filled = np.bincount(assignment, minlength=num_lists) > 0
+            centroids[filled] = self._unit_rows(sums[filled]) # Empty clusters keep their previous centroid
+
+        assignment = np.argmax(points @ centroids.T, axis=1)
+        order = np.argsort(assignment, kind='stable')
+        self._centroids[genre] = centroids
+        self._order[genre] = rows[order]
+        self._bounds[genre] = np.searchsorted(assignment[order], np.arange(num_lists + 1))
+
+    def genre_rows(self, genre, vector, nprobe=None, min_rows=0):
+        """
+        Candidate rows of one genre for a query vector.
+
+        Args:
+            genre (str): Genre name, genres without an index return every row of the genre.
+            vector (numpy.ndarray): Query vector in the feature_schema layout (scored part or full).
+            nprobe (int, optional): Clusters to visit, defaults to the index's nprobe.
+            min_rows (int): Keep visiting clusters until at least this many rows are found.
+        Returns:
+            numpy.ndarray: Store row indices, ascending.
+        """
+        if genre not in self._centroids:
+            return self.store.genre_rows(genre)
+
+        centroids, order, bounds = self._centroids[genre], self._order[genre], self._bounds[genre]
+        query = self._unit_rows(np.asarray(vector, dtype=centroids.dtype)[KEY_OFFSET:NUM_SCORED])
+        nprobe = self.nprobe if nprobe is None else nprobe
+
+        found = []
+        num_found = 0
+        for probed, cluster in enumerate(top_k(centroids @ query, len(centroids))):
+            if probed >= nprobe and num_found >= min_rows:
+                break
+            found.append(order[bounds[cluster]:bounds[cluster + 1]])
+            num_found += len(found[-1])
+
+        rows = np.concatenate(found)
+        rows.sort()
+        return rows
+
+    def candidate_rows(self, genres, vector, nprobe=None, min_rows=0):
+        """Union of genre_rows over several genres, min_rows applies per genre."""
+        if isinstance(genres, str):
+            genres = [genres]
+        if not len(genres):
+            return np.empty(0, dtype=np.int32)
+        rows = np.concatenate([self.genre_rows(genre, vector, nprobe, min_rows) for genre in genres])
+        return np.unique(rows)
@@ -20,6 +20,14 @@ from dotenv import load_dotenv
 import os
 from sql_work import SQLWork
 from session_store import SessionStore
+from feature_store import FeatureStore
+from ann_index import TrackIndex
+from playlist_refresh import PlaylistVectorRefresher
+from precompute import PrecomputedRecs, DEFAULT_PATH as PRECOMPUTED_PATH
+from user_sync import UserSyncWorker
+from track_cache import TrackFeatureCache
+from spotify_fetch import RATE_LIMIT as SPOTIFY_RATE_LIMIT
+from feature_schema import to_vector
 from load_gc import load_model
 import csv
 
@@ -50,19 +58,35 @@ app.secret_key = os.getenv('FLASK_SECRET_KEY')
 @utils.log_memory_usage
 def create_app():
     # global rec_dataset
-    global playlist_vectors # Set up how to intermittently update during production runtime e.g. use Celery
+    global playlist_vectors, playlist_refresher # Refreshed from the playlist vector stream while serving requests
+    global precomputed_recs # Built offline by precompute.py, None when missing or built from another dataset
+    global user_sync # Saves login data off the request path when USER_SYNC_BACKGROUND is set, else None
+    global track_cache # Audio features and predicted genres shared by every SpotifyClient, None when TRACK_CACHE is off
 
     sql_work = SQLWork()
 
     session_store = SessionStore()
     
-    playlist_vectors = sql_work.get_playlist_vectors()
+    playlist_refresher = PlaylistVectorRefresher.load(session_store, sql_work, interval=float(os.getenv('PLAYLIST_REFRESH_INTERVAL', 5)))
+    playlist_vectors = playlist_refresher.index
+
+    feature_store = FeatureStore.load(sql_work) # Resident rec_dataset, loaded once before workers fork
+    if os.getenv('ANN_INDEX') == 'True':
+        # Approximate candidate selection, ANN_NPROBE trades recall for latency
+        feature_store.track_index = TrackIndex(
+            feature_store,
+            list_size=int(os.getenv('ANN_LIST_SIZE', 64)),
+            nprobe=int(os.getenv('ANN_NPROBE', 8))
+        )
+    precomputed_recs = PrecomputedRecs.load_for(feature_store, os.getenv('PRECOMPUTED_RECS', PRECOMPUTED_PATH))
+    user_sync = UserSyncWorker(sql_work.sync_user_data, session_store) if os.getenv('USER_SYNC_BACKGROUND') == 'True' else None
 
     class_items = load_model()
+    track_cache = TrackFeatureCache.from_env(class_items['version'], session_store.redis)
 
-    return app, sql_work, session_store, class_items
+    return app, sql_work, session_store, feature_store, class_items
 
-app, sql_work, session_store, class_items = create_app()
+app, sql_work, session_store, feature_store, class_items = create_app()
 
 
 # Generate a random state string
@@ -121,7 +145,7 @@ def auth_demo():
         session['refresh_token'] = token_info.get('refresh_token')
         session['token_expires'] = datetime.now().timestamp() + token_info.get('expires_in')
 
-        sp = SpotifyClient(Spotify(auth=session.get('access_token')))
+        sp = SpotifyClient(Spotify(auth=session.get('access_token')), track_cache)
         session['unique_id'], session['display_name'] = "31bv2bralifp3lgy4p5zvikjghki", "Demo User"
         unique_id = session.get('unique_id')    
 
@@ -175,16 +199,18 @@ def auth_callback():
 
         start_time = time.time()
         
-        sp = SpotifyClient(Spotify(auth=session.get('access_token')))
-        unique_id, display_name = sql_work.get_user_data(sp)    
+        sp = SpotifyClient(Spotify(auth=session.get('access_token')), track_cache)
+        unique_id, display_name = sql_work.get_user_data(sp, user_sync)
         session['unique_id'] = unique_id
         print(unique_id, "stored in session")
         session['display_name'] = display_name
 
-        re = RecEngine(sp, unique_id, sql_work)
+        if user_sync is None:
+            re = RecEngine(sp, unique_id, sql_work)
 
-        # Check from SQL
-        user_top_tracks, user_top_artists = check_user_top_data_session(unique_id, re)
+            # Check from SQL
+            user_top_tracks, user_top_artists = check_user_top_data_session(unique_id, re)
+        # else the first request that needs them caches them, once the background sync wrote them
 
         print("Login time:", time.time() - start_time)  
        
@@ -247,8 +273,8 @@ def refresh_token():
         new_token_info = response.json()
         session['access_token'] = new_token_info.get('access_token')
         session['token_expires'] = datetime.now().timestamp() + new_token_info.get('expires_in')
-        sp = SpotifyClient(Spotify(auth=session.get('access_token')))
-        unique_id, display_name = sql_work.get_user_data(sp)
+        sp = SpotifyClient(Spotify(auth=session.get('access_token')), track_cache)
+        unique_id, display_name = sql_work.get_user_data(sp, user_sync)
         session['unique_id'] = unique_id
         session['display_name'] = display_name
 
@@ -277,14 +303,37 @@ def refresh_token():
     else:
         return False
 
-def check_user_top_data_session(unique_id, re):
+USER_SYNC_WAIT = float(os.getenv('USER_SYNC_WAIT', 5)) # Seconds a cache fill waits for the user's background sync
+
+def session_data(key, reads=None):
+    """key's value from the request's batched reads (session_store.get_many), else read on its own."""
+    if reads is not None and key in reads:
+        return reads[key]
+    return session_store.get_data(key)
+
+def session_read_keys(unique_id, link, type_id, rec_redis_key):
+    """Redis keys a recommend request for link reads, fetched together in one round trip."""
+    keys = [f"{unique_id}:top_tracks", f"{unique_id}:top_artists"]
+    if session.get('last_search') == link:
+        if type_id == 'playlist':
+            keys.append(f"{unique_id}:{link}:{session.get('p_features', {}).get('privacy')}:playlist_vector")
+        elif type_id == 'track':
+            keys.append(f"{unique_id}:{link}:track_vector")
+        keys.append(rec_redis_key)
+    return keys
+
+def check_user_top_data_session(unique_id, re, reads=None):
     redis_key_top_tracks = f"{unique_id}:top_tracks"
     redis_key_top_artists = f"{unique_id}:top_artists"
     
     with utils.track_memory_usage("user_top_tracks memory"):
-        user_top_tracks = session_store.get_data(redis_key_top_tracks)
+        user_top_tracks = session_data(redis_key_top_tracks, reads)
     with utils.track_memory_usage("user_top_artists memory"):
-        user_top_artists = session_store.get_data(redis_key_top_artists)
+        user_top_artists = session_data(redis_key_top_artists, reads)
+    synced = True
+    if (not user_top_tracks or not user_top_artists) and user_sync is not None:
+        # Read what this login saved, not the previous one, whichever worker process runs its sync
+        synced = user_sync.wait(unique_id, timeout=USER_SYNC_WAIT)
     if user_top_tracks:
         print("User top tracks found")
         ##Add recache function here
@@ -292,16 +341,19 @@ def check_user_top_data_session(unique_id, re):
         print("User top tracks not found")
         with utils.track_memory_usage("re.get_user_top_tracks memory"):
             user_top_tracks = re.get_user_top_tracks()
-        session_store.set_user_top_data(redis_key_top_tracks, user_top_tracks)
-        print("User top tracks saved")
+        # Rows read while the sync may still be running (or only rank placeholders) aren't cached for the day
+        if synced and any(user_top_tracks):
+            session_store.set_user_top_data(redis_key_top_tracks, user_top_tracks)
+            print("User top tracks saved")
     if user_top_artists:
         print("User top artists found")
     else:
         print("User top artists not found")
         with utils.track_memory_usage("re.get_user_top_artists memory"):
             user_top_artists = re.get_user_top_artists()
-        session_store.set_user_top_data(redis_key_top_artists, user_top_artists)
-        print("User top artists saved")
+        if synced and user_top_artists:
+            session_store.set_user_top_data(redis_key_top_artists, user_top_artists)
+            print("User top artists saved")
     return user_top_tracks, user_top_artists
 
 # Append Data to rec_dataset
@@ -322,26 +374,32 @@ def append_to_dataset(data, choice):
     if append:
         session['append_counter'] = 0 
 
-def get_playlist_data_session(unique_id,link):
+def get_playlist_data_session(unique_id, link, reads=None):
     if session.get('last_search') == link:
         p_features = session.get('p_features', {})
         if_public = p_features['privacy']
         redis_key_playlist = f"{unique_id}:{link}:{if_public}:playlist_vector"
-        p_vector = session_store.get_data(redis_key_playlist)
+        p_vector = session_data(redis_key_playlist, reads)
+        if p_vector is None: # Expired, rebuild from the playlist
+            return None
+        p_vector = to_vector(p_vector) # Older sessions cached DataFrame vectors
         top_genres = session.get('top_genres')
         top_ratios = session.get('top_ratios')
         return p_vector, p_features, top_genres, top_ratios
     return None
 
-def get_track_data_session(unique_id, link):
+def get_track_data_session(unique_id, link, reads=None):
     if session.get('last_search') == link:
         redis_key_track = f"{unique_id}:{link}:track_vector"
-        t_vector = session_store.get_data(redis_key_track)
+        t_vector = session_data(redis_key_track, reads)
+        if t_vector is None:
+            return None
+        t_vector = to_vector(t_vector)
         t_features = session.get('t_features', {})
         return t_vector, t_features
     return None
 
-def save_playlist_data_session(unique_id, playlist, p_features, link, if_public, re, sp):
+def build_playlist_data(playlist, p_features, link, if_public, re):
     p_vector = re.playlist_vector(playlist) # Get playlist vector
     # p_vector.to_csv('p_vector.csv', index=False)
     top_genres, top_ratios = re.get_top_genres(p_vector) # Getting from playlist vector returns weighted genre weights based on date added
@@ -350,15 +408,21 @@ def save_playlist_data_session(unique_id, playlist, p_features, link, if_public,
         'display_genres': display_genres,
         'privacy': if_public
     })
-    # Save playlist data to session
-    redis_key_playlist = f"{unique_id}:{link}:{if_public}:playlist_vector"
-    print(redis_key_playlist)
 
     if if_public == 'public':
         start_time = time.time()
         sql_work.add_vector_to_db(p_vector, link)
+        session_store.publish_playlist_vector(link, p_vector) # Other workers pick it up on their next refresh
         print("Time to add vector to db:", time.time() - start_time)
 
+    return p_vector, p_features, top_genres, top_ratios
+
+def save_playlist_data_session(unique_id, playlist, p_features, link, if_public, re, sp):
+    p_vector, p_features, top_genres, top_ratios = build_playlist_data(playlist, p_features, link, if_public, re)
+
+    # Save playlist data to session
+    redis_key_playlist = f"{unique_id}:{link}:{if_public}:playlist_vector"
+    print(redis_key_playlist)
     session_store.set_vector(redis_key_playlist, p_vector)
     session['top_genres'] = top_genres # To send as names to front end 
     session['top_ratios'] = top_ratios
@@ -441,10 +505,11 @@ def recommend():
         if not refresh_token():
             return redirect('/auth/login')
 
-    sp = SpotifyClient(Spotify(auth=session.get('access_token'))) # Initialize SpotifyClient
+    sp = SpotifyClient(Spotify(auth=session.get('access_token')), track_cache) # Initialize SpotifyClient
     unique_id = session.get('unique_id')
 
-    re = RecEngine(sp, unique_id, sql_work)
+    re = RecEngine(sp, unique_id, sql_work, feature_store)
+    playlist_refresher.refresh() # Pick up playlist vectors stored by other workers
   
 
     saved_playlists_ids = request.json.get('userPlaylistIds')
@@ -479,16 +544,18 @@ def recommend():
 
     rec_redis_key = f'{unique_id}:{link}:{type_id}'
     # print(rec_redis_key)
-    
-    user_top_tracks, user_top_artists = check_user_top_data_session(unique_id, re)
+
+    # Every Redis read of a repeat request in one round trip, the writes after scoring in another
+    reads = session_store.get_many(session_read_keys(unique_id, link, type_id, rec_redis_key))
+    user_top_tracks, user_top_artists = check_user_top_data_session(unique_id, re, reads)
 
     if type_id == 'playlist':
         # Check if playlist data exists in session
-        playlist_data = get_playlist_data_session(unique_id, link)
+        playlist_data = get_playlist_data_session(unique_id, link, reads)
         if playlist_data:
             print('Playlist data exists')
             p_vector, p_features, top_genres, top_ratios = playlist_data
-            stored_recommendations = session_store.get_data(rec_redis_key)
+            stored_recommendations = session_data(rec_redis_key, reads)
             track_ids = stored_recommendations['track_ids']
             previously_recommended = stored_recommendations['recommended_ids']
             prev_p_rec_ids = stored_recommendations['playlist_rec_ids']
@@ -521,19 +588,32 @@ def recommend():
                 # trending_genres = session_store.get_trending_genres()
                 # print(trending_genres)
 
-        recommended_ids = re.recommend_by_playlist(p_vector, track_ids, user_top_tracks, user_top_artists, class_items, top_genres, top_ratios, previously_recommended)
-            
+        # Cold requests for precomputed playlists are served from the lookup table, everything else is scored live
+        precomputed = None
+        if precomputed_recs is not None and not previously_recommended:
+            precomputed = precomputed_recs.lookup(link, p_vector)
+
+        if precomputed is not None:
+            start_time = time.time()
+            rows, similarity, neighbour_ids = precomputed
+            recommended_ids = re.recommend_precomputed(rows, similarity, track_ids, top_genres, top_ratios)
+            playlist_rec_ids = [playlist_id for playlist_id in neighbour_ids if playlist_id not in saved_playlists_ids and playlist_id in playlist_vectors][:9]
+            print("Time taken to serve precomputed recommendations:", time.time() - start_time)
+        else:
+            recommended_ids = re.recommend_by_playlist(p_vector, track_ids, user_top_tracks, user_top_artists, class_items, top_genres, top_ratios, previously_recommended)
+
         print("Length of user saved playlist ids:", len(saved_playlists_ids)) # Why is nothing here? 
-        playlist_rec_ids = re.recommend_playist_to_playlist(link, p_vector, playlist_vectors, saved_playlists_ids, prev_p_rec_ids)
+        if precomputed is None or len(playlist_rec_ids) < 9: # Saved or removed playlists used up the precomputed neighbours
+            playlist_rec_ids = re.recommend_playist_to_playlist(link, p_vector, playlist_vectors, saved_playlists_ids, prev_p_rec_ids)
 
 
     elif type_id == 'track':
         # Check if track data exists in session
-        track_data = get_track_data_session(unique_id, link)
+        track_data = get_track_data_session(unique_id, link, reads)
         if track_data:
             print('Track data exists')
             t_vector, t_features = track_data
-            stored_recommendations = session_store.get_data(rec_redis_key)
+            stored_recommendations = session_data(rec_redis_key, reads)
             track_ids = stored_recommendations['track_ids']
             previously_recommended = stored_recommendations['recommended_ids']
             prev_p_rec_ids = stored_recommendations['playlist_rec_ids']
@@ -565,19 +645,10 @@ def recommend():
         print("Time taken to get playlist recommendations:", time.time() - start_time)
 
     # Update recommended songs in session
-    updated_recommendations = set(previously_recommended).union(set(recommended_ids))
-    print("Length of updated_recommendations:", len(updated_recommendations))
-
-
-    updated_playlist_recommendations = set(prev_p_rec_ids).union(set(playlist_rec_ids))
-    prev_rec = {
-        'track_ids': list(track_ids),
-        'recommended_ids': list(updated_recommendations),
-        'playlist_rec_ids': list(updated_playlist_recommendations),
-    }
-    session_store.set_prev_rec(rec_redis_key, prev_rec) # Update prev rec for user
-
-    session_store.set_random_recs(list(updated_recommendations)) # Update random recs app wide
+    start_time = time.time()
+    with session_store.writes() as writes:
+        save_recommendation_history(rec_redis_key, track_ids, previously_recommended, recommended_ids, prev_p_rec_ids, playlist_rec_ids, writes)
+        writes.update_total_recs(len(recommended_ids))
     # memory_usage = session_store.get_memory_usage(rec_redis_key)
     # print("Memory usage:", memory_usage, "bytes") 
     # stored_recommendations = session_store.get_data(rec_redis_key)
@@ -592,30 +663,143 @@ def recommend():
     #     print("Length of playlist rec ids:", len(updated_playlist_recommendations))
     # else:
     #     print("Stored recommendations not found")
-        
-    start_time = time.time()
-    session_store.update_total_recs(len(recommended_ids))
 
-
-    print("Time taken to update user recommendation count:", time.time() - start_time)
+    print("Time taken to save recommendation history and count:", time.time() - start_time)
     print("Time taken to get recommendations:", time.time() - start_finish_time)
 
 
     if type_id == 'playlist':
-        return jsonify({
-            'p_features': p_features,
+        return jsonify(recommendation_response(type_id, link, p_features, recommended_ids, playlist_rec_ids, top_genres))
+    elif type_id == 'track':
+        return jsonify(recommendation_response(type_id, link, t_features, recommended_ids, playlist_rec_ids))
+
+
+def save_recommendation_history(rec_redis_key, track_ids, previously_recommended, recommended_ids, prev_p_rec_ids, playlist_rec_ids, writes):
+    updated_recommendations = set(previously_recommended).union(set(recommended_ids))
+    print("Length of updated_recommendations:", len(updated_recommendations))
+
+    updated_playlist_recommendations = set(prev_p_rec_ids).union(set(playlist_rec_ids))
+    prev_rec = {
+        'track_ids': list(track_ids),
+        'recommended_ids': list(updated_recommendations),
+        'playlist_rec_ids': list(updated_playlist_recommendations),
+    }
+    writes.set_prev_rec(rec_redis_key, prev_rec) # Update prev rec for user
+
+    writes.set_random_recs(list(updated_recommendations)) # Update random recs app wide
+
+
+def recommendation_response(type_id, link, features, recommended_ids, playlist_rec_ids, top_genres=None):
+    if type_id == 'playlist':
+        return {
+            'p_features': features,
             'top_genres': top_genres,
             'recommended_ids': recommended_ids,
             'playlist_rec_ids': playlist_rec_ids,
             'id': link,
+        }
+    return {
+        't_features': features,
+        'recommended_ids': recommended_ids,
+        'playlist_rec_ids': playlist_rec_ids,
+        'id': link
+    }
+
+
+MAX_BATCH_SEEDS = 20 # Scores are a (candidates x seeds) float32 matrix, keep it bounded
+
+def load_batch_seed(unique_id, link, sp, re):
+    """
+    Build a RecEngine seed for one batch link, without touching the single-search session state.
+
+    Returns:
+        dict: The seed plus 'id', 'features', 'rec_redis_key' and 'prev_p_rec_ids' for the response and history.
+    """
+    link = link.split('/')[-1].split('?')[0]
+    type_id, data = sp.get_id_type(link)
+    rec_redis_key = f'{unique_id}:{link}:{type_id}'
+
+    stored_recommendations = session_store.get_data(rec_redis_key) or {}
+    seed = {
+        'type': type_id,
+        'id': link,
+        'rec_redis_key': rec_redis_key,
+        'recommended_ids': stored_recommendations.get('recommended_ids', []),
+        'prev_p_rec_ids': stored_recommendations.get('playlist_rec_ids', []),
+    }
+
+    if type_id == 'playlist':
+        p_features = sp.playlist_base_features(data)
+        playlist = sp.predict(data, type_id, class_items)
+        seed['track_ids'] = set(playlist['id'])
+        p_features.update({
+            'num_tracks': len(seed['track_ids']),
+            'total_duration_ms': int(playlist['duration_ms'].sum()),
+            'avg_popularity': playlist['popularity'].mean(),
         })
+        if_public = 'public' if data['public'] else 'private'
+        seed['vector'], seed['features'], seed['top_genres'], seed['top_ratios'] = build_playlist_data(playlist, p_features, link, if_public, re)
     elif type_id == 'track':
-        return jsonify({
-            't_features': t_features,
-            'recommended_ids': recommended_ids,
-            'playlist_rec_ids': playlist_rec_ids,
-            'id': link
+        track, t_features = sp.track_base_features(data, link)
+        track = sp.predict(track, type_id, class_items)
+        t_features.update({
+            'total_duration_ms': int(track['duration_ms']),
         })
+        seed['track_ids'] = [link]
+        seed['vector'], seed['features'] = re.track_vector(track), t_features
+    else:
+        raise ValueError(f"Unsupported link type: {type_id}")
+    return seed
+
+
+@app.route('/t4/recommend/batch', methods=['POST'])
+@utils.log_memory_usage
+def recommend_batch():
+    """
+    Recommendations for several playlist / track links in one call.
+    Body: {"links": [...], "userPlaylistIds": [...]}. Returns one /t4/recommend response per link, in order,
+    or {"id": link, "error": ...} for a link that could not be loaded.
+    """
+    start_finish_time = time.time()
+    if is_token_expired():
+        if not refresh_token():
+            return redirect('/auth/login')
+
+    links = request.json.get('links') or []
+    saved_playlists_ids = request.json.get('userPlaylistIds') or []
+    if not links:
+        return jsonify({'error': 'No links provided'}), 400
+    if len(links) > MAX_BATCH_SEEDS:
+        return jsonify({'error': f'At most {MAX_BATCH_SEEDS} links per batch'}), 400
+
+    sp = SpotifyClient(Spotify(auth=session.get('access_token')), track_cache)
+    unique_id = session.get('unique_id')
+    re = RecEngine(sp, unique_id, sql_work, feature_store)
+    playlist_refresher.refresh()
+
+    user_top_tracks, user_top_artists = check_user_top_data_session(unique_id, re)
+
+    responses = [None] * len(links)
+    seeds = []
+    for i, link in enumerate(links):
+        try:
+            seeds.append((i, load_batch_seed(unique_id, link, sp, re)))
+        except Exception as e:
+            print(f"Error loading batch seed {link}: {e}")
+            responses[i] = {'id': link, 'error': str(e)}
+
+    if seeds:
+        recommended = re.recommend_many([seed for _, seed in seeds], user_top_tracks, user_top_artists, class_items)
+        playlist_recommended = re.recommend_playlists_many([seed for _, seed in seeds], playlist_vectors, saved_playlists_ids)
+
+        with session_store.writes() as writes:
+            for (i, seed), recommended_ids, playlist_rec_ids in zip(seeds, recommended, playlist_recommended):
+                save_recommendation_history(seed['rec_redis_key'], seed['track_ids'], seed['recommended_ids'], recommended_ids, seed['prev_p_rec_ids'], playlist_rec_ids, writes)
+                responses[i] = recommendation_response(seed['type'], seed['id'], seed['features'], recommended_ids, playlist_rec_ids, seed.get('top_genres'))
+            writes.update_total_recs(sum(len(recommended_ids) for recommended_ids in recommended))
+
+    print(f"Time taken to get batch recommendations for {len(links)} links:", time.time() - start_finish_time)
+    return jsonify(responses)
 
 @app.route('/t4/search', methods=['GET'])
 def autocomplete_playlist():
@@ -647,6 +831,24 @@ def get_trending_genres():
         trending_genres = None
     return jsonify(trending_genres)
 
+@app.route('/t4/metrics', methods=['GET'])
+def get_metrics():
+    # Internal pool and cache stats, for logged in sessions only
+    if is_token_expired():
+        if not refresh_token():
+            return redirect('/auth/login')
+
+    return jsonify({
+        'playlist_index': playlist_refresher.stats(),
+        'precomputed_recs': precomputed_recs.stats() if precomputed_recs is not None else None,
+        'mysql_pool': sql_work.pool.stats(),
+        'user_sync': user_sync.stats() if user_sync is not None else None,
+        'spotify_rate_limit': SPOTIFY_RATE_LIMIT.stats(),
+        'track_cache': track_cache.stats() if track_cache is not None else None,
+        'near_cache': session_store.cache.stats(),
+        'near_cache_invalidation': session_store.invalidation.stats() if session_store.invalidation is not None else None,
+    })
+
 
 def populate_seed_playlist_recs(sp, re):
     seed_playlists = []
@@ -667,6 +869,7 @@ def populate_seed_playlist_recs(sp, re):
         p_vector = re.playlist_vector(playlist) # Get playlist vector
         start_time = time.time()
         sql_work.add_vector_to_db(p_vector, link)
+        session_store.publish_playlist_vector(link, p_vector)
         print(f"Time to add {link}-vector to db:", time.time() - start_time)
     
 
@@ -0,0 +1,64 @@
+"""
+Serialized forms of the values SessionStore keeps in Redis.
+
+Vectors are a 12 byte header (magic, codec version, schema version, length) followed by the raw little-endian
+float32 buffer, decoded with np.frombuffer as a read-only view of the payload, no copy. Everything else is JSON,
+encoded with orjson. Nothing is pickled: a payload that is neither (e.g. a vector pickled by an older release)
+is rejected with a ValueError, and callers treat it as missing.
+"""
+import struct
+import numpy as np
+import orjson
+from feature_schema import SCHEMA_VERSION, NUM_FEATURES, to_vector
+
+VECTOR_MAGIC = b'FV'
+VECTOR_CODEC_VERSION = 1
+VECTOR_HEADER = struct.Struct('<2sHII') # magic, codec version, schema version (crc32), length; 12 bytes keep the floats aligned
+WIRE_DTYPE = np.dtype('<f4')
+
+JSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY # Parity with json.dumps on int keys and numpy values
+
+
+def encode_vector(vector):
+    """bytes of a vector (ndarray, or anything to_vector takes) in the FEATURES layout."""
+    vector = to_vector(vector).astype(WIRE_DTYPE, copy=False)
+    return VECTOR_HEADER.pack(VECTOR_MAGIC, VECTOR_CODEC_VERSION, SCHEMA_VERSION, len(vector)) + vector.tobytes()
+
+
+def is_vector(payload):
+    return payload[:len(VECTOR_MAGIC)] == VECTOR_MAGIC
+
+
+def decode_vector(payload):
+    """
+    Read-only float32 view of an encoded vector.
+
+    Raises:
+        ValueError: Not a vector of this codec and schema version.
+    """
+    if len(payload) < VECTOR_HEADER.size:
+        raise ValueError("Truncated vector payload")
+    magic, codec_version, schema_version, length = VECTOR_HEADER.unpack_from(payload)
+    if magic != VECTOR_MAGIC or codec_version != VECTOR_CODEC_VERSION:
+        raise ValueError(f"Not a vector payload (codec version {codec_version})")
+    if schema_version != SCHEMA_VERSION or length != NUM_FEATURES:
+        raise ValueError(f"Vector of schema {schema_version} with {length} features, expected schema {SCHEMA_VERSION}")
+    if len(payload) != VECTOR_HEADER.size + length * WIRE_DTYPE.itemsize:
+        raise ValueError("Vector payload length doesn't match its header")
+    return np.frombuffer(payload, dtype=WIRE_DTYPE, count=length, offset=VECTOR_HEADER.size)
+
+
+def encode_json(data):
+    return orjson.dumps(data, option=JSON_OPTIONS)
+
+
+def decode(payload):
+    """
+    A vector or JSON value from its payload.
+
+    Raises:
+        ValueError: Neither (orjson.JSONDecodeError is a ValueError).
+    """
+    if is_vector(payload):
+        return decode_vector(payload)
+    return orjson.loads(payload)
@@ -0,0 +1,249 @@
+"""
+MySQL connection management for SQLWork.
+
+Sizing comes from gunicorn.conf.py, every request thread of a worker can hold one connection at once (plus spare
+connections for work outside requests, e.g. playlist vector refreshes). Checkouts wait at most a checkout timeout
+for a free connection instead of failing as soon as the pool is exhausted, and retried operations back off
+exponentially with full jitter under one total deadline, kept well below gunicorn's worker timeout.
+"""
+import os
+import random
+import runpy
+import threading
+import time
+import mysql.connector
+import mysql.connector.pooling
+from mysql.connector import errors
+
+GUNICORN_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn.conf.py')
+POOL_MAX_SIZE = mysql.connector.pooling.CNX_POOL_MAXSIZE
+
+# Errors worth retrying: lost / refused connections, a failed reconnect on checkout and checkout timeouts
+TRANSIENT_ERRORS = (errors.OperationalError, errors.InterfaceError, errors.PoolError)
+
+
+class PoolTimeout(errors.PoolError):
+    """No pooled connection was free within the checkout timeout."""
+
+
+def gunicorn_config(path=GUNICORN_CONFIG_PATH):
+    """Settings of gunicorn.conf.py (workers, threads, timeout), empty when it can't be read."""
+    try:
+        return runpy.run_path(path)
+    except (OSError, SyntaxError) as e:
+        print(f"Could not read gunicorn config at {path}: {e}")
+        return {}
+
+
+def pool_size_for(config, spare=1):
+    """
+    Connections per worker process: one per request thread plus spare ones, capped at mysql-connector's maximum.
+    The whole deployment opens workers * pool size connections, MySQL's max_connections has to allow for that.
+    """
+    return min(int(config.get('threads', 1)) + spare, POOL_MAX_SIZE)
+
+
+def deadline_for(config, fraction=1 / 3):
+    """Total time a request may spend retrying the database, a fraction of gunicorn's worker timeout."""
+    return float(config.get('timeout', 30)) * fraction
+
+
+class ManagedConnection:
+    """
+    A checked out pooled connection, closing it returns it to the pool and frees its checkout slot.
+    Everything else is delegated, so existing connection.cursor() / commit() / close() code keeps working.
+    """
+
+    def __init__(self, connection, release):
+        self._connection = connection
+        self._release = release
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def close(self):
+        if self._release is None:
+            return
+        release, self._release = self._release, None
+        try:
+            self._connection.close()
+        finally:
+            release()
+
+
+class ConnectionManager:
+    """
+    Per-process MySQL connection pool with bounded checkouts and retries.
+
+    The mysql-connector pool is built lazily in the process that uses it: with preload_app the app is created
+    in gunicorn's master, and connections opened there must not be shared by the forked workers. A pool whose
+    process id doesn't match is replaced on the next checkout.
+    Checkout pings the connection and reconnects it if the server dropped it (mysql-connector's health check);
+    a failed reconnect is a transient error, retried by run(). Checkouts inside run() never wait past its deadline.
+    """
+
+    def __init__(self, pool_size=None, checkout_timeout=None, deadline=None, base_delay=0.05, max_delay=2.0,
+                 pool_factory=None, **cnx_config):
+        """
+        Args:
+            pool_size (int, optional): Connections per process, defaults to gunicorn threads + 1.
+            checkout_timeout (float, optional): Seconds to wait for a free connection, defaults to the deadline.
+            deadline (float, optional): Total seconds run() may take, defaults to a third of gunicorn's timeout.
+            base_delay (float), max_delay (float): Backoff before retry n is uniform in [0, min(max_delay, base_delay * 2**n)].
+            pool_factory (callable, optional): Builds the underlying pool from (pool_size, **cnx_config),
+                defaults to mysql.connector.pooling.MySQLConnectionPool.
+            cnx_config: Connection arguments (host, port, user, passwd, database, ...).
+        """
+        config = gunicorn_config() if pool_size is None or deadline is None else {}
+        self.pool_size = pool_size or pool_size_for(config)
+        self.deadline = deadline if deadline is not None else deadline_for(config)
+        self.checkout_timeout = checkout_timeout if checkout_timeout is not None else self.deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._pool_factory = pool_factory or self._mysql_pool
+        self._cnx_config = cnx_config
+
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+        self._slots = threading.BoundedSemaphore(self.pool_size)
+        self._stale_pools = [] # Inherited across a fork, kept referenced so their sockets are never closed from here
+        self._run_state = threading.local() # give_up_at of the run() the calling thread is in, if any
+        self._metrics_lock = threading.Lock() # Request threads and background workers update metrics concurrently
+        self.metrics = {
+            'checkouts': 0,
+            'checkout_waits': 0,
+            'checkout_timeouts': 0,
+            'total_wait_ms': 0.0,
+            'max_wait_ms': 0.0,
+            'in_use': 0,
+            'max_in_use': 0,
+            'retries': 0,
+            'failures': 0,
+            'pool_builds': 0,
+        }
+
+    @staticmethod
+    def _mysql_pool(pool_size, **cnx_config):
+        return mysql.connector.pooling.MySQLConnectionPool(pool_name="pool", pool_size=pool_size, **cnx_config)
+
+    def _get_pool(self):
+        if self._pool is not None and self._pid == os.getpid():
+            return self._pool
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                if self._pool is not None:
+                    self._stale_pools.append(self._pool)
+                    self._slots = threading.BoundedSemaphore(self.pool_size) # Checkouts of the parent don't carry over
+                    with self._metrics_lock:
+                        self.metrics['in_use'] = 0
+                self._pool = self._pool_factory(self.pool_size, **self._cnx_config)
+                self._pid = os.getpid()
+                self._count('pool_builds')
+                print(f"MySQL pool of {self.pool_size} connections created in process {self._pid}")
+        return self._pool
+
+    def get_connection(self, timeout=None):
+        """
+        Check out a connection, waiting up to timeout (defaults to checkout_timeout) for a free one,
+        and no longer than the deadline of the run() it is called in.
+
+        Raises:
+            PoolTimeout: No connection was returned to the pool in time.
+        """
+        timeout = self.checkout_timeout if timeout is None else timeout
+        give_up_at = getattr(self._run_state, 'give_up_at', None)
+        if give_up_at is not None:
+            timeout = min(timeout, give_up_at - time.monotonic())
+        pool = self._get_pool()
+        slots = self._slots
+
+        start_time = time.perf_counter()
+        if not slots.acquire(blocking=False):
+            self._count('checkout_waits')
+            if not slots.acquire(timeout=max(timeout, 0)):
+                self._count('checkout_timeouts')
+                self._record_wait(start_time)
+                raise PoolTimeout(f"No MySQL connection free within {timeout:.2f} s ({self.pool_size} in use)")
+        self._record_wait(start_time)
+
+        try:
+            connection = pool.get_connection()
+        except BaseException:
+            slots.release()
+            raise
+
+        with self._metrics_lock:
+            self.metrics['checkouts'] += 1
+            self.metrics['in_use'] += 1
+            self.metrics['max_in_use'] = max(self.metrics['max_in_use'], self.metrics['in_use'])
+        return ManagedConnection(connection, lambda: self._release(slots))
+
+    def _record_wait(self, start_time):
+        waited = (time.perf_counter() - start_time) * 1000
+        with self._metrics_lock:
+            self.metrics['total_wait_ms'] += waited
+            self.metrics['max_wait_ms'] = max(self.metrics['max_wait_ms'], waited)
+
+    def _release(self, slots):
+        if slots is self._slots:
+            self._count('in_use', -1)
+        slots.release()
+
+    def _count(self, name, amount=1):
+        with self._metrics_lock:
+            self.metrics[name] += amount
+
+    def run(self, operation, deadline=None):
+        """
+        Call operation() until it doesn't raise a transient error, backing off with full jitter between attempts.
+
+        Args:
+            operation (callable): Checks out its own connection(s), so every attempt starts from a fresh checkout.
+            deadline (float, optional): Total seconds for every attempt and backoff, defaults to self.deadline.
+                Checkouts of an attempt wait at most the time left, a nested run() at most its caller's.
+        Returns:
+            Whatever operation returns.
+        Raises:
+            The last transient error once the deadline has passed, any other error right away.
+        """
+        deadline = self.deadline if deadline is None else deadline
+        outer_give_up_at = getattr(self._run_state, 'give_up_at', None)
+        give_up_at = time.monotonic() + deadline
+        if outer_give_up_at is not None:
+            give_up_at = min(give_up_at, outer_give_up_at)
+        self._run_state.give_up_at = give_up_at
+        attempt = 0
+        try:
+            while True:
+                try:
+                    return operation()
+                except TRANSIENT_ERRORS as e:
+                    delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                    remaining = give_up_at - time.monotonic()
+                    if remaining <= delay:
+                        self._count('failures')
+                        print(f"Giving up on MySQL after {attempt + 1} attempts: {e}")
+                        raise
+                    print(f"Transient MySQL error, retrying in {delay:.2f} s: {e}")
+                    self._count('retries')
+                    attempt += 1
+                    time.sleep(delay)
+        finally:
+            self._run_state.give_up_at = outer_give_up_at
+
+    def closeall(self):
+        if self._pool is not None and self._pid == os.getpid():
+            self._pool._remove_connections()
+
+    def stats(self):
+        with self._metrics_lock:
+            metrics = dict(self.metrics)
+        checkouts = metrics['checkouts']
+        return {
+            **metrics,
+            'pool_size': self.pool_size,
+            'avg_wait_ms': metrics['total_wait_ms'] / checkouts if checkouts else 0.0,
+            'deadline_s': self.deadline,
+            'checkout_timeout_s': self.checkout_timeout,
+        }
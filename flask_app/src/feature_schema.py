@@ -0,0 +1,129 @@
+"""
+Fixed feature layout shared by RecEngine, SQLWork, SpotifyClient and the feature store.
+
+Every vector (playlist, track, personalized, stored playlist vector) is a float32 ndarray of length
+NUM_FEATURES in FEATURES order, so vectors and the encoded candidate matrix can be compared directly
+without column intersection or reindexing.
+Layout: genres (genre_counts.csv order), key_0..11, mode_0..1, audio features, then popularity and duration_ms.
+Only the first NUM_SCORED features take part in similarity scoring.
+"""
+import os
+import re
+import zlib
+import numpy as np
+import pandas as pd
+
+GENRE_COUNTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'datasets', 'genre_counts.csv')
+GENRES = pd.read_csv(GENRE_COUNTS_PATH)['track_genre'].tolist()
+
+GENRE_COLUMNS = [f'track_genre_{genre}' for genre in GENRES]
+KEY_COLUMNS = [f'key_{i}' for i in range(12)]
+MODE_COLUMNS = [f'mode_{i}' for i in range(2)]
+AUDIO_COLUMNS = ['danceability', 'energy', 'loudness', 'speechiness', 'acousticness', 'instrumentalness',
+                 'liveness', 'valence', 'tempo', 'time_signature']
+UNSCORED_COLUMNS = ['popularity', 'duration_ms'] # Stored with playlist vectors, never scored
+
+FEATURES = GENRE_COLUMNS + KEY_COLUMNS + MODE_COLUMNS + AUDIO_COLUMNS + UNSCORED_COLUMNS
+FEATURE_INDEX = {name: i for i, name in enumerate(FEATURES)}
+NUM_FEATURES = len(FEATURES)
+
+GENRE_OFFSET = 0
+KEY_OFFSET = GENRE_OFFSET + len(GENRE_COLUMNS)
+MODE_OFFSET = KEY_OFFSET + len(KEY_COLUMNS)
+AUDIO_OFFSET = MODE_OFFSET + len(MODE_COLUMNS)
+UNSCORED_OFFSET = AUDIO_OFFSET + len(AUDIO_COLUMNS)
+
+GENRE_SLICE = slice(GENRE_OFFSET, KEY_OFFSET)
+NUM_SCORED = UNSCORED_OFFSET
+SCORED = slice(0, NUM_SCORED)
+SCORED_COLUMNS = FEATURES[SCORED]
+
+VECTOR_DTYPE = np.float32
+
+# Column order of the track DataFrames SpotifyClient builds before genre prediction
+TRACK_COLUMNS = ['artist', 'name', 'id', 'date_added', 'popularity', 'duration_ms', 'danceability', 'energy', 'key',
+                 'loudness', 'mode', 'speechiness', 'acousticness', 'instrumentalness',
+                 'liveness', 'valence', 'tempo', 'time_signature']
+
+
+def sql_column(name):
+    """MySQL safe column name for a feature (track_genre_R&B -> track_genre_R_B)."""
+    return re.sub(r'[^0-9A-Za-z_]', '_', name)
+
+
+SQL_COLUMNS = [sql_column(name) for name in FEATURES]
+SQL_TO_FEATURE = {sql_column(name): name for name in FEATURES}
+
+# Changes whenever the layout does, e.g. a genre is added to genre_counts.csv
+SCHEMA_VERSION = zlib.crc32(','.join(FEATURES).encode())
+
+
+def encode_features(genre_index, keys, modes, numeric):
+    """
+    One-hot encode tracks into the FEATURES layout.
+
+    Args:
+        genre_index (numpy.ndarray): Index into GENRES per track, -1 for unknown genres.
+        keys (numpy.ndarray): Pitch class per track (0-11).
+        modes (numpy.ndarray): Mode per track (0-1).
+        numeric (numpy.ndarray): Leading columns of AUDIO_COLUMNS + UNSCORED_COLUMNS, shape (n, m).
+    Returns:
+        numpy.ndarray: float32 matrix of shape (n, AUDIO_OFFSET + m).
+    """
+    numeric = np.asarray(numeric, dtype=VECTOR_DTYPE)
+    num_tracks = len(genre_index)
+    encoded = np.zeros((num_tracks, AUDIO_OFFSET + numeric.shape[1]), dtype=VECTOR_DTYPE)
+    rows = np.arange(num_tracks)
+
+    for offset, values, size in ((GENRE_OFFSET, genre_index, len(GENRE_COLUMNS)),
+                                 (KEY_OFFSET, keys, len(KEY_COLUMNS)),
+                                 (MODE_OFFSET, modes, len(MODE_COLUMNS))):
+        values = np.asarray(values)
+        valid = (values >= 0) & (values < size) # Unknown categories stay all-zero, like a missing dummy column
+        encoded[rows[valid], offset + values[valid].astype(np.intp)] = 1
+
+    encoded[:, AUDIO_OFFSET:] = np.nan_to_num(numeric, nan=0.0)
+    return encoded
+
+
+def encode_frame(df, scored_only=False):
+    """
+    Encode a track DataFrame (track_genre, key, mode and numeric columns) into the FEATURES layout.
+
+    Args:
+        df (pandas.DataFrame): Tracks, e.g. a predicted playlist or user top tracks.
+        scored_only (bool): Only return the NUM_SCORED scored features.
+    Returns:
+        numpy.ndarray: float32 matrix, one row per track.
+    """
+    numeric_columns = AUDIO_COLUMNS if scored_only else AUDIO_COLUMNS + UNSCORED_COLUMNS
+    genre_index = pd.Categorical(df['track_genre'], categories=GENRES).codes
+    keys = pd.to_numeric(df['key'], errors='coerce').fillna(-1).to_numpy()
+    modes = pd.to_numeric(df['mode'], errors='coerce').fillna(-1).to_numpy()
+    numeric = df.reindex(columns=numeric_columns, fill_value=0).apply(pd.to_numeric, errors='coerce')
+    return encode_features(genre_index, keys, modes, numeric.to_numpy(dtype=VECTOR_DTYPE))
+
+
+def to_vector(data):
+    """
+    Coerce a vector into the FEATURES layout.
+
+    Accepts an ndarray already in layout, or the older one-row DataFrame / Series / dict keyed by
+    feature or SQL column names (e.g. vectors cached before the schema existed).
+    """
+    if isinstance(data, np.ndarray):
+        vector = data.astype(VECTOR_DTYPE, copy=False).reshape(-1)
+        if len(vector) != NUM_FEATURES:
+            raise ValueError(f"Expected a vector of {NUM_FEATURES} features, got {len(vector)}")
+        return vector
+    if isinstance(data, pd.DataFrame):
+        data = data.iloc[0]
+    series = pd.Series(data).rename(index=SQL_TO_FEATURE)
+    series = pd.to_numeric(series.reindex(FEATURES), errors='coerce').fillna(0)
+    return series.to_numpy(dtype=VECTOR_DTYPE)
+
+
+def vector_genre(vector):
+    """Genre name of a single track vector, None if it has no genre."""
+    genres = np.flatnonzero(vector[GENRE_SLICE] == 1)
+    return GENRES[genres[0]] if len(genres) else None
@@ -0,0 +1,215 @@
+import zlib
+import numpy as np
+import pandas as pd
+import time
+
+import utils as utils
+from feature_schema import GENRES, AUDIO_COLUMNS, KEY_OFFSET, encode_features
+from scoring import weighted_cosine_many
+
+# Columns of rec_dataset, in table order
+DATASET_COLUMNS = ['artists', 'track_name', 'track_id', 'popularity', 'duration_ms', 'danceability', 'energy', 'key',
+                   'loudness', 'mode', 'speechiness', 'acousticness', 'instrumentalness', 'liveness', 'valence',
+                   'tempo', 'time_signature', 'track_genre']
+
+# Numeric columns held in the resident float32 matrix
+FEATURE_COLUMNS = ['popularity', 'duration_ms', 'danceability', 'energy', 'key', 'loudness', 'mode',
+                   'speechiness', 'acousticness', 'instrumentalness', 'liveness', 'valence', 'tempo', 'time_signature']
+
+# Columns frame() returns as int64, the integer columns get_dataset reads from MySQL, so recommendations served
+# from the store carry the same values (key 5, not 5.0) as before
+INT_COLUMNS = ['popularity', 'duration_ms', 'key', 'mode']
+
+# Candidate rows scored per chunk, bounds the per-request slice of the encoded matrix and the score matrix
+SCORE_CHUNK_SIZE = 16384
+
+# Column dtypes of SQLWork's columnar fetch: float32 features, small integers, categorical genre and artist
+DATASET_DTYPES = {column: np.float32 for column in DATASET_COLUMNS}
+DATASET_DTYPES.update({
+    'artists': 'category',
+    'track_name': object,
+    'track_id': object,
+    'popularity': np.int8,
+    'duration_ms': np.int32,
+    'key': np.int8,
+    'mode': np.int8,
+    'track_genre': 'category',
+})
+
+class FeatureStore:
+    """
+    Process-wide, read-only copy of rec_dataset.
+
+    Numeric features live in one contiguous float32 matrix, genres and artists are stored as integer codes
+    with precomputed row-index lists, so candidate selection never has to go back to MySQL.
+    The encoded candidate matrix (the scored features of feature_schema) is built once per dataset version,
+    requests only slice rows out of it.
+    Loaded once in create_app; with gunicorn's preload_app the workers share it copy-on-write.
+    """
+
+    def __init__(self, dataset):
+        self._build(dataset)
+        self.track_index = None # Optional ann_index.TrackIndex, only used while its version matches the store
+
+    @classmethod
+    @utils.log_memory_usage
+    def load(cls, sql_cnx):
+        print("-> fs:load()")
+        start_time = time.time()
+
+        dataset = sql_cnx.get_rec_dataset()
+        if dataset is None or dataset.empty:
+            raise RuntimeError("rec_dataset could not be loaded into the feature store")
+        store = cls(dataset)
+
+        print(f"Feature store loaded {len(store)} tracks in {time.time() - start_time:.2f} s")
+        print("<- fs:load()")
+        return store
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    def _build(self, dataset):
+        # rec_dataset has one row per (track, genre), every row is kept so each genre sees all of its tracks
+        dataset = dataset.reset_index(drop=True)
+
+        self.track_ids = dataset['track_id'].to_numpy(dtype=object)
+        self.track_names = dataset['track_name'].to_numpy(dtype=object)
+        self.track_codes, unique_track_ids = self._factorize(dataset['track_id'])
+        self.track_lookup = {track_id: code for code, track_id in enumerate(unique_track_ids)}
+
+        # Categorical columns as integer codes plus a name -> code lookup
+        self.genre_codes, self.genres = self._factorize(dataset['track_genre'])
+        self.artist_codes, self.artists = self._factorize(dataset['artists'])
+        self.genre_lookup = {genre: code for code, genre in enumerate(self.genres)}
+        self.artist_lookup = {artist: code for code, artist in enumerate(self.artists)}
+
+        features = dataset[FEATURE_COLUMNS].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float32)
+        self.features = np.ascontiguousarray(np.nan_to_num(features, nan=0.0))
+
+        # Row-index lists per code, rows stay in table order within each group
+        self._genre_order, self._genre_bounds = self._group_rows(self.genre_codes, len(self.genres))
+        self._artist_order, self._artist_bounds = self._group_rows(self.artist_codes, len(self.artists))
+
+        # Store genre codes -> position in GENRES, unknown genres map to -1
+        canonical_genre = np.array([GENRES.index(genre) if genre in GENRES else -1 for genre in self.genres], dtype=np.int16)
+        self.schema_genre_codes = canonical_genre[self.genre_codes]
+
+        with utils.track_memory_usage("encode feature store"):
+            self.encoded = self._encode()
+        # Squared norm of the non-genre scored features, genre weights vary per request so they're added at scoring time
+        self.feature_sqnorms = np.einsum('ij,ij->i', self.encoded[:, KEY_OFFSET:], self.encoded[:, KEY_OFFSET:])
+        self.version = self._dataset_version()
+
+        print(f"Feature store memory usage: {self.nbytes / 1024**2:.2f} MB")
+
+    def _encode(self):
+        column = {name: i for i, name in enumerate(FEATURE_COLUMNS)}
+        return encode_features(
+            self.schema_genre_codes,
+            self.features[:, column['key']],
+            self.features[:, column['mode']],
+            self.features[:, [column[name] for name in AUDIO_COLUMNS]]
+        )
+
+    def _dataset_version(self):
+        # Changes whenever tracks are added, removed or reordered
+        checksum = zlib.crc32('\n'.join(self.track_ids.astype(str)).encode())
+        return f'{len(self.track_ids)}-{checksum:08x}'
+
+    @staticmethod
+    def _factorize(column):
+        if isinstance(column.dtype, pd.CategoricalDtype) and '' not in column.cat.categories:
+            column = column.cat.add_categories('') # Columnar fetch, '' is the missing value as for object columns
+        codes, uniques = pd.factorize(column.fillna(''), sort=False)
+        return codes.astype(np.int32), np.asarray(uniques, dtype=object)
+
+    @staticmethod
+    def _group_rows(codes, num_groups):
+        order = np.argsort(codes, kind='stable').astype(np.int32)
+        bounds = np.searchsorted(codes[order], np.arange(num_groups + 1))
+        return order, bounds
+
+    @property
+    def nbytes(self):
+        return (self.features.nbytes + self.encoded.nbytes + self.feature_sqnorms.nbytes
+                + self.genre_codes.nbytes + self.schema_genre_codes.nbytes + self.artist_codes.nbytes
+                + self.track_codes.nbytes)
+
+    # Row selection
+    def genre_rows(self, genres):
+        """Row indices (ascending) of every track in any of the given genres."""
+        if isinstance(genres, str):
+            genres = [genres]
+        codes = [self.genre_lookup[genre] for genre in genres if genre in self.genre_lookup]
+        return self._rows_for_codes(codes, self._genre_order, self._genre_bounds)
+
+    def artist_rows(self, artists):
+        """Row indices (ascending) of every track by any of the given artist names."""
+        codes = [self.artist_lookup[artist] for artist in artists if artist in self.artist_lookup]
+        return self._rows_for_codes(codes, self._artist_order, self._artist_bounds)
+
+    def _rows_for_codes(self, codes, order, bounds):
+        if not codes:
+            return np.empty(0, dtype=np.int32)
+        rows = np.concatenate([order[bounds[code]:bounds[code + 1]] for code in codes])
+        rows.sort()
+        return rows
+
+    def exclude_tracks(self, rows, track_ids):
+        """Drop rows whose track id is in track_ids, in every genre the track is listed under."""
+        excluded = np.fromiter((self.track_lookup[track_id] for track_id in track_ids if track_id in self.track_lookup), dtype=np.int32)
+        if len(excluded) == 0:
+            return rows
+        return rows[~np.isin(self.track_codes[rows], excluded)]
+
+    def artist_mask(self, artists):
+        codes = [self.artist_lookup[artist] for artist in artists if artist in self.artist_lookup]
+        return np.isin(self.artist_codes, codes)
+
+    # Scoring
+    def score_chunks(self, rows, genre_weights, queries, chunk_size=SCORE_CHUNK_SIZE):
+        """
+        Score rows against queries chunk by chunk, with weighted_cosine_many.
+
+        Only one chunk of the encoded matrix and its (chunk x queries) scores exist at a time, so a request's
+        scoring memory is bounded by chunk_size however many candidate rows it has.
+
+        Args:
+            rows (numpy.ndarray): Candidate row indices, ascending.
+            genre_weights (numpy.ndarray), queries (numpy.ndarray): As in weighted_cosine_many.
+        Yields:
+            tuple: (start, chunk rows, float32 scores of shape (len(chunk rows), q)), start is the chunk's offset into rows.
+        """
+        for start in range(0, len(rows), chunk_size):
+            chunk_rows = rows[start:start + chunk_size]
+            yield start, chunk_rows, weighted_cosine_many(
+                self.encoded[chunk_rows],
+                self.feature_sqnorms[chunk_rows],
+                self.schema_genre_codes[chunk_rows],
+                genre_weights,
+                queries
+            )
+
+    # Materialization
+    def frame(self, rows):
+        """
+        Build a rec_dataset shaped DataFrame for the given rows.
+
+        Args:
+            rows (numpy.ndarray): Row indices into the store.
+        Returns:
+            pandas.DataFrame: Same columns and dtypes get_dataset returns, indexed by store row
+            so genre_codes / artist_codes can be looked up for any subset of it.
+        """
+        features = self.features[rows]
+        data = {
+            'artists': self.artists[self.artist_codes[rows]],
+            'track_name': self.track_names[rows],
+            'track_id': self.track_ids[rows],
+        }
+        for i, column in enumerate(FEATURE_COLUMNS):
+            data[column] = features[:, i].astype(np.int64) if column in INT_COLUMNS else features[:, i]
+        data['track_genre'] = self.genres[self.genre_codes[rows]]
+
+        return pd.DataFrame(data, columns=DATASET_COLUMNS, index=pd.Index(rows, name='row'))
@@ -1,10 +1,24 @@
+import zlib
 import joblib
+from feature_schema import SCHEMA_VERSION
+
+MODEL_FILES = [
+    '../data/models/GenreClassModel/xgboost_model.joblib',  # Filename for xg_boost
+    '../data/models/GenreClassModel/scaler.joblib',  # Filename for scaler
+    '../data/models/GenreClassModel/label_encoder.joblib',  # Filename for label encoder
+    '../data/models/GenreClassModel/feature_set.joblib',  # Filename for features
+]
+
+def model_version(filenames=MODEL_FILES):
+    """crc32 of the genre model files and SCHEMA_VERSION, changes whenever the model is retrained"""
+    checksum = zlib.crc32(str(SCHEMA_VERSION).encode())
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            checksum = zlib.crc32(f.read(), checksum)
+    return checksum
 
 def load_model():
-    model_filename = '../data/models/GenreClassModel/xgboost_model.joblib'  # Filename for xg_boost
-    scaler_filename = '../data/models/GenreClassModel/scaler.joblib'  # Filename for scaler
-    encoder_filename = '../data/models/GenreClassModel/label_encoder.joblib'  # Filename for label encoder
-    features_filename = '../data/models/GenreClassModel/feature_set.joblib'  # Filename for features
+    model_filename, scaler_filename, encoder_filename, features_filename = MODEL_FILES
     xgboost_model = joblib.load(model_filename)  # Load the selected model
     xgboost_model.verbose = 0
     standard_scaler = joblib.load(scaler_filename)  # Load the scaler
@@ -15,5 +29,6 @@ def load_model():
         'scaler': standard_scaler,
         'label_encoder': label_encoder_final,
         'feature_set': feature_set,
+        'version': model_version(),
     }
-    return class_items
\ No newline at end of file
+    return class_items
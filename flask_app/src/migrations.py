@@ -0,0 +1,237 @@
+"""
+Versioned schema migrations for the indexes behind the hot queries in sql_work.
+
+migrate_sql.py creates rec_dataset with nothing but its id primary key, so every get_dataset call, artist lookup
+and append merge scans the whole catalogue. Each migration adds named secondary indexes, skipping any whose
+leading columns an existing index (a primary or unique key, say) already covers, and records its version in
+schema_migrations. MySQL commits DDL right away, so apply and rollback check every index before touching it and
+can simply be run again after a failure part way through.
+
+Run from flask_app/src against the database in .env:
+
+    python migrations.py status
+    python migrations.py apply [--to VERSION]
+    python migrations.py rollback [--to VERSION]
+    python migrations.py explain # Fails if a hot query still scans a whole table
+"""
+import argparse
+import sys
+
+MIGRATIONS_TABLE = 'schema_migrations'
+
+
+class Index:
+    def __init__(self, table, name, columns):
+        self.table = table
+        self.name = name
+        self.columns = tuple(columns)
+
+    def __repr__(self):
+        return f"{self.table}.{self.name}({', '.join(self.columns)})"
+
+
+class Migration:
+    def __init__(self, version, description, indexes):
+        self.version = version
+        self.description = description
+        self.indexes = indexes
+
+
+MIGRATIONS = [
+    Migration(1, "rec_dataset lookup indexes", [
+        # get_dataset(track=True) and the genre half of the artists-or-genres query
+        Index('rec_dataset', 'idx_rec_dataset_genre_artists', ['track_genre', 'artists']),
+        # get_tracks_by_artists, get_dataset(artist_rec=True) (the genre filter is checked in the index) and the
+        # artist half of the artists-or-genres query, merged with the genre index
+        Index('rec_dataset', 'idx_rec_dataset_artists_genre', ['artists', 'track_genre']),
+        # append_tracks' anti-join, answered from the index alone
+        Index('rec_dataset', 'idx_rec_dataset_track_id', ['track_id']),
+    ]),
+    Migration(2, "per-user lookup indexes", [
+        Index('users', 'idx_users_unique_id', ['unique_id']),
+        Index('user_top_tracks', 'idx_user_top_tracks_unique_id', ['unique_id']),
+        Index('user_top_artists', 'idx_user_top_artists_unique_id', ['unique_id']),
+        Index('recently_played', 'idx_recently_played_unique_id', ['unique_id']),
+        # get_unique_user_playlist, plus sync_user_data's delete of the playlists a user no longer has
+        Index('playlists', 'idx_playlists_unique_id_playlist_id', ['unique_id', 'playlist_id']),
+    ]),
+]
+
+# (description, query, params, tables it may read in full). Parameters are placeholders: the plan only depends
+# on the shape of the query and the table statistics.
+HOT_QUERIES = [
+    ("get_dataset: top artists or top genres",
+     "SELECT * FROM rec_dataset WHERE artists IN (%s, %s) OR track_genre IN (%s, %s)",
+     ['artist_0', 'artist_1', 'genre_0', 'genre_1'], ()),
+    ("get_dataset: top artists outside the top genres",
+     "SELECT * FROM rec_dataset WHERE artists IN (%s, %s) AND track_genre NOT IN (%s, %s)",
+     ['artist_0', 'artist_1', 'genre_0', 'genre_1'], ()),
+    ("get_dataset: one genre",
+     "SELECT * FROM rec_dataset WHERE track_genre = %s", ['genre_0'], ()),
+    ("get_tracks_by_artists",
+     "SELECT * FROM rec_dataset WHERE artists IN (%s, %s)", ['artist_0', 'artist_1'], ()),
+    # The staging table is read in full by design, rec_dataset only probed
+    ("append_tracks: anti-join merge",
+     "SELECT a.track_id FROM append_data a LEFT JOIN rec_dataset r ON r.track_id = a.track_id WHERE r.track_id IS NULL",
+     [], ('append_data',)),
+    ("sync_user_data: profile insert-if-missing",
+     "SELECT 1 FROM users WHERE unique_id = %s", ['user_0'], ()),
+    ("get_user_top_tracks",
+     "SELECT * FROM user_top_tracks WHERE unique_id = %s", ['user_0'], ()),
+    ("get_user_top_artists",
+     "SELECT * FROM user_top_artists WHERE unique_id = %s", ['user_0'], ()),
+    ("get_user_recently_played",
+     "SELECT * FROM recently_played WHERE unique_id = %s", ['user_0'], ()),
+    ("get_unique_user_playlist",
+     "SELECT name, playlist_id, image_url, unique_id, owner_id FROM playlists WHERE unique_id = %s "
+     "ORDER BY CASE WHEN owner_id = %s THEN 0 ELSE 1 END", ['user_0', 'user_0'], ()),
+]
+
+FULL_SCANS = ('ALL', 'index') # EXPLAIN access types reading every row of a table or of a whole index
+
+
+def ensure_migrations_table(cursor):
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE} (
+            version INT PRIMARY KEY,
+            description VARCHAR(255),
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def applied_versions(cursor):
+    ensure_migrations_table(cursor)
+    cursor.execute(f"SELECT version FROM {MIGRATIONS_TABLE}")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def table_indexes(cursor, table):
+    """{index name: (column, ...)} of a table in the current database."""
+    cursor.execute("""
+        SELECT index_name, column_name FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = %s
+        ORDER BY index_name, seq_in_index
+    """, (table,))
+    indexes = {}
+    for name, column in cursor.fetchall():
+        indexes.setdefault(name, []).append(column)
+    return {name: tuple(columns) for name, columns in indexes.items()}
+
+
+def covering_index(cursor, index):
+    """Name of an existing index whose leading columns are index.columns (possibly index itself), else None."""
+    for name, columns in table_indexes(cursor, index.table).items():
+        if columns[:len(index.columns)] == index.columns:
+            return name
+    return None
+
+
+def apply(cursor, target=None, migrations=MIGRATIONS):
+    """
+    Apply every migration up to target (default: all) that isn't recorded in schema_migrations.
+
+    Returns:
+        list: Versions applied by this call.
+    """
+    done = applied_versions(cursor)
+    applied = []
+    for migration in migrations:
+        if migration.version in done or (target is not None and migration.version > target):
+            continue
+        for index in migration.indexes:
+            existing = covering_index(cursor, index)
+            if existing is not None:
+                print(f"{index} covered by {index.table}.{existing}, skipped")
+                continue
+            columns = ', '.join(f'`{column}`' for column in index.columns)
+            # Online DDL, reads and writes to the table carry on while the index builds
+            cursor.execute(f"ALTER TABLE `{index.table}` ADD INDEX `{index.name}` ({columns}), ALGORITHM=INPLACE, LOCK=NONE")
+            print(f"Created {index}")
+        cursor.execute(f"INSERT INTO {MIGRATIONS_TABLE} (version, description) VALUES (%s, %s)",
+                       (migration.version, migration.description))
+        cursor.execute("COMMIT")
+        applied.append(migration.version)
+        print(f"Applied migration {migration.version}: {migration.description}")
+    return applied
+
+
+def rollback(cursor, target=0, migrations=MIGRATIONS):
+    """
+    Roll back every applied migration above target (default: all), newest first. Only the indexes a migration
+    created are dropped, indexes it found already covered are left alone.
+
+    Returns:
+        list: Versions rolled back by this call.
+    """
+    done = applied_versions(cursor)
+    rolled_back = []
+    for migration in sorted(migrations, key=lambda migration: migration.version, reverse=True):
+        if migration.version not in done or migration.version <= target:
+            continue
+        for index in migration.indexes:
+            if index.name in table_indexes(cursor, index.table):
+                cursor.execute(f"ALTER TABLE `{index.table}` DROP INDEX `{index.name}`, ALGORITHM=INPLACE, LOCK=NONE")
+                print(f"Dropped {index}")
+        cursor.execute(f"DELETE FROM {MIGRATIONS_TABLE} WHERE version = %s", (migration.version,))
+        cursor.execute("COMMIT")
+        rolled_back.append(migration.version)
+        print(f"Rolled back migration {migration.version}: {migration.description}")
+    return rolled_back
+
+
+def explain(cursor, queries=HOT_QUERIES):
+    """
+    EXPLAIN every hot query.
+
+    Returns:
+        list: (description, table, access type, key, rows) per table in each plan.
+        list: (description, table) of every full table or index scan outside the query's allowed tables.
+    """
+    plans, full_scans = [], []
+    for description, query, params, allowed in queries:
+        cursor.execute("EXPLAIN " + query, params)
+        names = [column[0] for column in cursor.description]
+        for row in cursor.fetchall():
+            row = dict(zip(names, row))
+            plans.append((description, row['table'], row['type'], row['key'], row['rows']))
+            if row['type'] in FULL_SCANS and row['table'] not in allowed:
+                full_scans.append((description, row['table']))
+    return plans, full_scans
+
+
+def main():
+    from sql_work import SQLWork
+
+    parser = argparse.ArgumentParser(description="Apply or roll back the sql_work index migrations")
+    parser.add_argument('command', choices=['status', 'apply', 'rollback', 'explain'])
+    parser.add_argument('--to', type=int, default=None, help="Target version (apply: highest to apply, rollback: version to keep)")
+    args = parser.parse_args()
+
+    sql_work = SQLWork()
+    connection = sql_work.pool.get_connection()
+    cursor = connection.cursor()
+    try:
+        if args.command == 'apply':
+            apply(cursor, args.to)
+        elif args.command == 'rollback':
+            rollback(cursor, args.to or 0)
+        elif args.command == 'status':
+            done = applied_versions(cursor)
+            for migration in MIGRATIONS:
+                print(f"{migration.version:>3} {'applied' if migration.version in done else 'pending':>8}  {migration.description}")
+        else:
+            plans, full_scans = explain(cursor)
+            for description, table, access, key, rows in plans:
+                print(f"{description:<50} {table:<18} {access:<12} {str(key):<40} {rows}")
+            if full_scans:
+                print(f"Full scans: {full_scans}")
+                sys.exit(1)
+    finally:
+        cursor.close()
+        connection.close()
+        sql_work.close_sql()
+
+
+if __name__ == '__main__':
+    main()
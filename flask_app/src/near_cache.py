@@ -0,0 +1,261 @@
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+MAX_BYTES = int(os.getenv('NEAR_CACHE_BYTES', 64 * 1024 * 1024)) # Per worker process
+POLICY = os.getenv('NEAR_CACHE_POLICY', 'lru') # 'lru' or 'lfu'
+INVALIDATE_CHANNEL = '__redis__:invalidate'
+PING_INTERVAL = 5 # Seconds between checks that the tracking connection is still alive
+
+MISSING = object()
+
+
+class NearCache:
+    """
+    Bounded in-process copy of Redis values, in front of SessionStore's Redis reads.
+
+    Entries are sized by their serialized length (what was written to / read from Redis) and evicted least
+    recently (lru) or least frequently (lfu, least recently among equals) used once the byte budget is exceeded.
+    Each entry expires with the TTL its Redis key had, so the near cache never serves a value Redis already dropped.
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES, policy=POLICY):
+        if policy not in ('lru', 'lfu'):
+            raise ValueError(f"Unknown near cache policy: {policy}")
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self._entries = OrderedDict() # key -> [value, size, expires_at or None, hits], least recently used first
+        self._frequencies = defaultdict(OrderedDict) # lfu: hits -> keys, least recently used first
+        self._bytes = 0
+        self._filling = {} # key -> [loads in progress, invalidated during one of them]
+        self._lock = threading.Lock()
+        self.metrics = {
+            'hits': 0,
+            'misses': 0,
+            'expired': 0,
+            'evictions': 0,
+            'invalidations': 0,
+            'oversized': 0,
+        }
+
+    def get(self, key):
+        """The cached value of key, MISSING when absent or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] <= time.monotonic():
+                self._remove(key)
+                self.metrics['expired'] += 1
+                entry = None
+            if entry is None:
+                self.metrics['misses'] += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            if self.policy == 'lfu':
+                self._count_hit(key, entry)
+            self.metrics['hits'] += 1
+            return entry[0]
+
+    def set(self, key, value, size, ttl=None):
+        """
+        Args:
+            size (int): Bytes the value accounts for, its serialized length.
+            ttl (float, optional): Seconds until the entry expires, the Redis key's TTL. None for no expiry.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if size > self.max_bytes:
+                self.metrics['oversized'] += 1
+                return
+            entry = [value, size, time.monotonic() + ttl if ttl is not None else None, 0]
+            self._entries[key] = entry
+            self._bytes += size
+            if self.policy == 'lfu':
+                self._frequencies[0][key] = None
+            while self._bytes > self.max_bytes:
+                self._remove(self._victim(key))
+                self.metrics['evictions'] += 1
+
+    def fill_many(self, keys, load):
+        """
+        Values of keys loaded with load(keys) -> {key: (value, size, ttl)} for the keys Redis has, each cached
+        unless it was invalidated while loading (the loaded value may predate that change).
+
+        Returns:
+            dict: key -> value, None for the keys load didn't return.
+        """
+        with self._lock:
+            fillings = [self._filling.setdefault(key, [0, False]) for key in keys]
+            for filling in fillings:
+                filling[0] += 1
+        try:
+            loaded = load(keys)
+        finally:
+            with self._lock:
+                for key, filling in zip(keys, fillings):
+                    filling[0] -= 1
+                    if not filling[0]:
+                        del self._filling[key]
+        values = {}
+        for key, filling in zip(keys, fillings):
+            if key not in loaded:
+                values[key] = None
+                continue
+            value, size, ttl = loaded[key]
+            if not filling[1]:
+                self.set(key, value, size, ttl)
+            values[key] = value
+        return values
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+                return True
+            return False
+
+    def delete_prefix(self, prefix):
+        """Drop every entry whose key starts with prefix, returning how many."""
+        with self._lock:
+            keys = [key for key in self._entries if key.startswith(prefix)]
+            for key in keys:
+                self._remove(key)
+        return len(keys)
+
+    def invalidate(self, keys):
+        """Drop keys another client changed, every entry when keys is None (the database was flushed)."""
+        with self._lock:
+            for key, filling in self._filling.items():
+                if keys is None or key in keys:
+                    filling[1] = True
+        if keys is None:
+            self.clear()
+            self.metrics['invalidations'] += 1
+            return
+        for key in keys:
+            if self.delete(key):
+                self.metrics['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._frequencies.clear()
+            self._bytes = 0
+
+    def _count_hit(self, key, entry):
+        hits = entry[3]
+        del self._frequencies[hits][key]
+        if not self._frequencies[hits]:
+            del self._frequencies[hits]
+        entry[3] = hits + 1
+        self._frequencies[hits + 1][key] = None
+
+    def _victim(self, new_key):
+        """Entry to evict for new_key, never new_key itself (with lfu it would always have the fewest hits)."""
+        if self.policy == 'lfu':
+            for hits in sorted(self._frequencies):
+                for key in self._frequencies[hits]:
+                    if key != new_key:
+                        return key
+        return next(iter(self._entries))
+
+    def _remove(self, key):
+        _, size, _, hits = self._entries.pop(key)
+        self._bytes -= size
+        if self.policy == 'lfu':
+            del self._frequencies[hits][key]
+            if not self._frequencies[hits]:
+                del self._frequencies[hits]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key) is not MISSING
+
+    def stats(self):
+        lookups = self.metrics['hits'] + self.metrics['misses']
+        return {
+            **self.metrics,
+            'policy': self.policy,
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'max_bytes': self.max_bytes,
+            'hit_rate': self.metrics['hits'] / lookups if lookups else 0.0,
+        }
+
+
+class RedisInvalidation:
+    """
+    Redis client side tracking for a NearCache: entries whose key any client changes are dropped.
+
+    Tracking runs in broadcasting mode (BCAST) on a connection of its own, with notifications redirected to a
+    listener connection subscribed to __redis__:invalidate, both owned by one daemon thread per process (started by
+    the first ensure_running, after the gunicorn fork). Redis can't say who changed a key, so a worker's own write
+    also drops its fresh entry, the next read goes to Redis once. Whenever the connections are lost the whole near
+    cache is cleared, invalidations may have been missed meanwhile.
+    """
+
+    def __init__(self, redis_client, cache, prefixes=()):
+        self.redis = redis_client
+        self.cache = cache
+        self.prefixes = prefixes
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.metrics = {
+            'messages': 0,
+            'reconnects': 0,
+        }
+
+    def ensure_running(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='near-cache-invalidation', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        delay = 0.1
+        while True:
+            listener = tracker = None
+            try:
+                listener = self.redis.connection_pool.make_connection()
+                listener.send_command('CLIENT', 'ID')
+                listener_id = listener.read_response()
+                listener.send_command('SUBSCRIBE', INVALIDATE_CHANNEL)
+                listener.read_response()
+
+                tracker = self.redis.connection_pool.make_connection()
+                prefix_args = [arg for prefix in self.prefixes for arg in ('PREFIX', prefix)]
+                tracker.send_command('CLIENT', 'TRACKING', 'ON', 'REDIRECT', listener_id, 'BCAST', *prefix_args)
+                tracker.read_response()
+                self.cache.clear() # Entries cached while not tracking may be stale
+                delay = 0.1
+
+                while True:
+                    if not listener.can_read(timeout=PING_INTERVAL):
+                        tracker.send_command('PING') # Tracking stops with its connection
+                        tracker.read_response()
+                        continue
+                    message = listener.read_response()
+                    if message[0] == b'message' and message[1] == INVALIDATE_CHANNEL.encode():
+                        self.metrics['messages'] += 1
+                        keys = message[2]
+                        self.cache.invalidate(None if keys is None else [key.decode('utf-8') for key in keys])
+            except Exception as e:
+                print(f"Near cache invalidation lost its Redis connection, reconnecting in {delay:.1f} s: {e}")
+                self.metrics['reconnects'] += 1
+                self.cache.clear()
+                time.sleep(delay)
+                delay = min(delay * 2, 10)
+            finally:
+                for connection in (listener, tracker):
+                    if connection is not None:
+                        connection.disconnect()
+
+    def stats(self):
+        return {**self.metrics, 'running': self._thread is not None and self._thread.is_alive()}
@@ -0,0 +1,159 @@
+import threading
+import numpy as np
+
+from feature_schema import SCORED, NUM_FEATURES, NUM_SCORED, VECTOR_DTYPE
+from scoring import top_k
+
+
+class PlaylistVectorIndex:
+    """
+    Stored playlist vectors for playlist-to-playlist recommendations.
+
+    Holds the scored part of every vector as a unit-normalized float32 matrix, so cosine similarity against a
+    query is a single GEMV. Playlist ids map to rows through a dict and removed playlists are tombstoned
+    instead of compacting the matrix. Queries never modify the index: exclusions are applied to the
+    per-request score array only, so one index can be shared by every request thread.
+
+    New playlists are appended into spare capacity and updated playlists are overwritten in place (upsert),
+    so live refreshes never rebuild the matrix. Writers hold a lock, readers only read the row count under it:
+    rows below the count are always fully written.
+    """
+
+    def __init__(self, playlist_ids, vectors):
+        """
+        Args:
+            playlist_ids (numpy.ndarray): Playlist id per vector.
+            vectors (numpy.ndarray): Vectors in the feature_schema layout, one row per playlist.
+        """
+        self._lock = threading.Lock()
+        self.reset(playlist_ids, vectors)
+
+    def reset(self, playlist_ids, vectors):
+        """Replace every row, e.g. after a full reload from MySQL."""
+        playlist_ids = np.asarray(playlist_ids, dtype=object)
+        matrix = self._normalize(np.asarray(vectors, dtype=VECTOR_DTYPE).reshape(len(playlist_ids), NUM_FEATURES)[:, SCORED])
+        with self._lock:
+            self._ids = playlist_ids
+            self._matrix = matrix
+            self._tombstones = np.zeros(len(playlist_ids), dtype=bool)
+            self.row_lookup = {playlist_id: row for row, playlist_id in enumerate(playlist_ids)}
+            self.size = len(playlist_ids)
+
+    def __len__(self):
+        return self.size - int(self.tombstones.sum())
+
+    def __contains__(self, playlist_id):
+        row = self.row_lookup.get(playlist_id)
+        return row is not None and not self._tombstones[row]
+
+    @staticmethod
+    def _normalize(matrix):
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        return np.ascontiguousarray(np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0))
+
+    @property
+    def playlist_ids(self):
+        return self._ids[:self.size]
+
+    @property
+    def matrix(self):
+        return self._matrix[:self.size]
+
+    @property
+    def tombstones(self):
+        return self._tombstones[:self.size]
+
+    @property
+    def nbytes(self):
+        return self._matrix.nbytes + self._tombstones.nbytes
+
+    def rows(self, playlist_ids):
+        """Rows of the given playlist ids that are in the index."""
+        return np.fromiter((self.row_lookup[playlist_id] for playlist_id in playlist_ids if playlist_id in self.row_lookup), dtype=np.intp)
+
+    def remove(self, playlist_id):
+        """Tombstone a playlist, its row is never returned again."""
+        row = self.row_lookup.get(playlist_id)
+        if row is not None:
+            self._tombstones[row] = True
+
+    def upsert(self, playlist_id, vector):
+        """
+        Overwrite a playlist's row in place, or append it when the playlist is new.
+
+        Returns:
+            bool: True if the playlist was appended.
+        """
+        row_vector = self._normalize(np.asarray(vector, dtype=VECTOR_DTYPE)[SCORED].reshape(1, NUM_SCORED))[0]
+        with self._lock:
+            row = self.row_lookup.get(playlist_id)
+            if row is not None:
+                self._matrix[row] = row_vector
+                self._tombstones[row] = False
+                return False
+
+            if self.size == len(self._matrix):
+                self._grow()
+            row = self.size
+            self._matrix[row] = row_vector
+            self._ids[row] = playlist_id
+            self._tombstones[row] = False
+            self.row_lookup[playlist_id] = row
+            self.size += 1 # Only now visible to readers
+            return True
+
+    def _grow(self):
+        # Double the capacity, readers holding the old arrays keep a consistent snapshot
+        capacity = max(2 * len(self._matrix), 64)
+        matrix = np.zeros((capacity, NUM_SCORED), dtype=VECTOR_DTYPE)
+        matrix[:self.size] = self._matrix[:self.size]
+        ids = np.empty(capacity, dtype=object)
+        ids[:self.size] = self._ids[:self.size]
+        tombstones = np.zeros(capacity, dtype=bool)
+        tombstones[:self.size] = self._tombstones[:self.size]
+        self._matrix, self._ids, self._tombstones = matrix, ids, tombstones
+
+    def similar(self, vector, exclude_ids=(), k=9):
+        """
+        Most similar playlists to a vector by cosine similarity.
+
+        Args:
+            vector (numpy.ndarray): Playlist or track vector in the feature_schema layout.
+            exclude_ids (iterable): Playlist ids never to return, e.g. the playlist itself and saved playlists.
+            k (int): Number of playlist ids to return.
+        Returns:
+            list: Up to k playlist ids, most similar first.
+        """
+        return self.similar_many(np.asarray(vector).reshape(1, -1), [exclude_ids], k)[0]
+
+    def similar_many(self, vectors, exclude_ids, k=9):
+        """
+        similar for several vectors at once, scored as one matrix-matrix product.
+
+        Args:
+            vectors (numpy.ndarray): One vector per row, feature_schema layout.
+            exclude_ids (list): One iterable of excluded playlist ids per vector.
+            k (int): Number of playlist ids per vector.
+        Returns:
+            list: A list of up to k playlist ids per vector.
+        """
+        with self._lock:
+            num_rows = self.size
+            matrix, ids, tombstones = self._matrix[:num_rows], self._ids[:num_rows], self._tombstones[:num_rows]
+
+        queries = np.asarray(vectors, dtype=VECTOR_DTYPE)[:, SCORED]
+        similarity = matrix @ queries.T
+        query_norms = np.linalg.norm(queries, axis=1)
+        np.divide(similarity, query_norms, out=similarity, where=query_norms > 0)
+        similarity[tombstones] = -np.inf
+
+        results = []
+        for i, excluded_ids in enumerate(exclude_ids):
+            query_similarity = similarity[:, i]
+            excluded = self.rows(excluded_ids)
+            query_similarity[excluded[excluded < num_rows]] = -np.inf
+
+            top_rows = top_k(query_similarity, k)
+            top_rows = top_rows[query_similarity[top_rows] > -np.inf]
+            results.append(ids[top_rows].tolist())
+        return results
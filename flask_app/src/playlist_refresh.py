@@ -0,0 +1,120 @@
+import threading
+import time
+
+from playlist_index import PlaylistVectorIndex
+
+
+class PlaylistVectorRefresher:
+    """
+    Keeps a worker's PlaylistVectorIndex in sync with playlist vectors stored by any worker.
+
+    Every add_vector_to_db is followed by SessionStore.publish_playlist_vector, which appends the vector to a
+    Redis stream with a sequence number. Workers replay entries after their watermark into the index in place
+    (upsert), at most once per interval and from request threads, so nothing has to survive gunicorn's fork.
+    A missing sequence number means the stream was trimmed past the watermark: the index is then reloaded
+    from MySQL once. Replaying an entry twice is harmless, upserts are idempotent.
+    """
+
+    def __init__(self, index, session_store, sql_cnx, last_id='0-0', last_seq=0, interval=5):
+        """
+        Args:
+            index (PlaylistVectorIndex): Index to keep up to date.
+            session_store (SessionStore): Reads the update stream.
+            sql_cnx (SQLWork): Full reloads.
+            last_id (str), last_seq (int): Watermark the index was loaded at.
+            interval (float): Minimum seconds between polls of the stream.
+        """
+        self.index = index
+        self.session_store = session_store
+        self.sql_cnx = sql_cnx
+        self.last_id = last_id
+        self.last_seq = last_seq
+        self.interval = interval
+        self._last_poll = time.monotonic()
+        self._lock = threading.Lock()
+        self.metrics = {
+            'refreshes': 0,
+            'updates_applied': 0,
+            'playlists_appended': 0,
+            'full_reloads': 0,
+            'refresh_errors': 0,
+            'last_refresh_ms': 0.0,
+            'total_refresh_ms': 0.0,
+            'max_refresh_ms': 0.0,
+        }
+
+    @classmethod
+    def load(cls, session_store, sql_cnx, interval=5):
+        """Index of every stored playlist vector, with the stream watermark taken before the MySQL read."""
+        last_id, last_seq = session_store.get_playlist_vector_watermark()
+        index = PlaylistVectorIndex(*sql_cnx.get_playlist_vectors())
+        return cls(index, session_store, sql_cnx, last_id, last_seq, interval)
+
+    def refresh(self, force=False):
+        """
+        Apply pending updates, unless the last poll was less than interval seconds ago.
+        Only one thread polls at a time, the others keep serving from the index as it is.
+
+        Returns:
+            int: Number of updates applied.
+        """
+        if not force and time.monotonic() - self._last_poll < self.interval:
+            return 0
+        if not self._lock.acquire(blocking=False):
+            return 0
+
+        start_time = time.perf_counter()
+        try:
+            self._last_poll = time.monotonic()
+            applied = self._apply_updates()
+        except Exception as e:
+            # Serving stale vectors beats failing the request, the next poll retries
+            print(f"Error refreshing playlist vectors: {e}")
+            self.metrics['refresh_errors'] += 1
+            return 0
+        finally:
+            self._lock.release()
+
+        elapsed = (time.perf_counter() - start_time) * 1000
+        self.metrics['refreshes'] += 1
+        self.metrics['updates_applied'] += applied
+        self.metrics['last_refresh_ms'] = elapsed
+        self.metrics['total_refresh_ms'] += elapsed
+        self.metrics['max_refresh_ms'] = max(self.metrics['max_refresh_ms'], elapsed)
+        if applied:
+            print(f"Applied {applied} playlist vector updates in {elapsed:.2f} ms, index size {len(self.index)}")
+        return applied
+
+    def _apply_updates(self):
+        applied = 0
+        while True:
+            updates = self.session_store.get_playlist_vector_updates(self.last_id)
+            if not updates:
+                return applied
+            for entry_id, seq, playlist_id, vector in updates:
+                if seq != self.last_seq + 1:
+                    self._reload()
+                    return applied
+                if vector is not None: # Written under another feature schema, picked up by the next full reload
+                    self.metrics['playlists_appended'] += self.index.upsert(playlist_id, vector)
+                    applied += 1
+                self.last_id, self.last_seq = entry_id, seq
+
+    def _reload(self):
+        last_id, last_seq = self.session_store.get_playlist_vector_watermark()
+        self.index.reset(*self.sql_cnx.get_playlist_vectors())
+        self.last_id, self.last_seq = last_id, last_seq
+        self.metrics['full_reloads'] += 1
+        print(f"Playlist vectors reloaded from MySQL, index size {len(self.index)}")
+
+    def stats(self):
+        refreshes = self.metrics['refreshes']
+        return {
+            **self.metrics,
+            'avg_refresh_ms': self.metrics['total_refresh_ms'] / refreshes if refreshes else 0.0,
+            'index_rows': self.index.size,
+            'index_live_rows': len(self.index),
+            'index_bytes': self.index.nbytes,
+            'last_seq': self.last_seq,
+            'seconds_since_poll': time.monotonic() - self._last_poll,
+        }
@@ -0,0 +1,226 @@
+"""
+Offline precomputation of recommendations for every stored playlist vector.
+
+Run from flask_app/src against the local MySQL dataset, after the playlist vectors are seeded:
+
+    python precompute.py [--output ../data/precomputed/playlist_recs.npz] [--per-genre 60] [--neighbours 30]
+
+The recommend route serves cold requests (no previous recommendations) for these playlists from the table and
+only scores live for playlists that are not in it, whose vector changed since the run, or once the feature
+store no longer matches the dataset the table was built from.
+"""
+import argparse
+import os
+import time
+import numpy as np
+
+import utils as utils
+from feature_schema import SCHEMA_VERSION, SCORED, VECTOR_DTYPE, GENRE_SLICE
+from scoring import grouped_top_k, weighted_cosine_many, genre_weight_vector
+from playlist_index import PlaylistVectorIndex
+
+DEFAULT_PATH = '../data/precomputed/playlist_recs.npz'
+
+
+class PrecomputedRecs:
+    """
+    Compact lookup table of precomputed, non-personalized recommendations per stored playlist.
+
+    Tracks are kept as feature store rows, so the table is only valid for the store version it was built from.
+    Each playlist keeps per_genre candidates for each of its top genres (twice what a request uses), so the
+    playlist's own tracks can still be dropped at request time. Neighbours are positions into playlist_ids,
+    more than 9 so that the user's saved playlists can be dropped too. Both are padded with -1.
+    """
+
+    def __init__(self, playlist_ids, vectors, tracks, scores, neighbours, store_version, schema_version=SCHEMA_VERSION):
+        """
+        Args:
+            playlist_ids (numpy.ndarray): Playlist id per table row.
+            vectors (numpy.ndarray): Scored part of the vector each row was computed from, shape (P, NUM_SCORED).
+            tracks (numpy.ndarray): int32 store rows, shape (P, N), grouped by top genre, each group best first.
+            scores (numpy.ndarray): float32 similarity of every entry in tracks.
+            neighbours (numpy.ndarray): int32 positions into playlist_ids, shape (P, M), most similar first.
+            store_version (str): FeatureStore.version the rows refer to.
+            schema_version (int): feature_schema.SCHEMA_VERSION the vectors were written with.
+        """
+        self.playlist_ids = np.asarray(playlist_ids, dtype=object)
+        self.vectors = np.asarray(vectors, dtype=VECTOR_DTYPE)
+        self.tracks = np.asarray(tracks, dtype=np.int32)
+        self.scores = np.asarray(scores, dtype=VECTOR_DTYPE)
+        self.neighbours = np.asarray(neighbours, dtype=np.int32)
+        self.store_version = str(store_version)
+        self.schema_version = int(schema_version)
+        self.row_lookup = {playlist_id: row for row, playlist_id in enumerate(self.playlist_ids)}
+        self.metrics = {'hits': 0, 'misses': 0, 'stale_vectors': 0}
+
+    def __len__(self):
+        return len(self.playlist_ids)
+
+    def __contains__(self, playlist_id):
+        return playlist_id in self.row_lookup
+
+    @property
+    def nbytes(self):
+        return self.vectors.nbytes + self.tracks.nbytes + self.scores.nbytes + self.neighbours.nbytes
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        np.savez(
+            path,
+            playlist_ids=self.playlist_ids.astype(str),
+            vectors=self.vectors,
+            tracks=self.tracks,
+            scores=self.scores,
+            neighbours=self.neighbours,
+            store_version=np.array(self.store_version),
+            schema_version=np.array(self.schema_version),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(
+                data['playlist_ids'].astype(object),
+                data['vectors'],
+                data['tracks'],
+                data['scores'],
+                data['neighbours'],
+                data['store_version'].item(),
+                data['schema_version'].item(),
+            )
+
+    @classmethod
+    def load_for(cls, store, path=DEFAULT_PATH):
+        """
+        Table at path if it exists and was built from store's dataset and the current feature schema, else None.
+        """
+        if not os.path.exists(path):
+            print(f"No precomputed recommendations at {path}, every request is scored live")
+            return None
+        table = cls.load(path)
+        if table.store_version != store.version or table.schema_version != SCHEMA_VERSION:
+            print(f"Precomputed recommendations at {path} are stale (store {table.store_version}, "
+                  f"schema {table.schema_version}), every request is scored live")
+            return None
+        print(f"Loaded precomputed recommendations for {len(table)} playlists, {table.nbytes / 1024**2:.2f} MB")
+        return table
+
+    def lookup(self, playlist_id, vector):
+        """
+        Precomputed entry of a playlist, if its stored vector still matches vector.
+
+        Returns:
+            tuple: (store rows, similarities, neighbour playlist ids) with the padding dropped, or None.
+        """
+        row = self.row_lookup.get(playlist_id)
+        if row is None or self.tracks[row, 0] < 0:
+            self.metrics['misses'] += 1
+            return None
+        scored_vector = np.nan_to_num(np.asarray(vector, dtype=VECTOR_DTYPE)[SCORED])
+        if not np.allclose(self.vectors[row], scored_vector, atol=1e-5):
+            # Tracks were added or removed since the table was built
+            self.metrics['stale_vectors'] += 1
+            return None
+
+        self.metrics['hits'] += 1
+        tracks, neighbours = self.tracks[row], self.neighbours[row]
+        filled = tracks >= 0
+        return tracks[filled], self.scores[row][filled], self.playlist_ids[neighbours[neighbours >= 0]].tolist()
+
+    def stats(self):
+        return {
+            **self.metrics,
+            'playlists': len(self),
+            'bytes': self.nbytes,
+            'store_version': self.store_version,
+        }
+
+
+def precompute(re, playlist_ids, vectors, per_genre=60, num_neighbours=30, batch_size=64):
+    """
+    Top tracks and neighbours for every playlist, scored against the playlist vector alone.
+
+    Candidates are selected exactly as recommend_by_playlist does without a user: every track of the playlist's
+    top genres (no ANN pruning), weighted by the top genre ratios.
+
+    Args:
+        re (RecEngine): Engine over the feature store to precompute against.
+        playlist_ids (numpy.ndarray), vectors (numpy.ndarray): Stored playlist vectors, as from get_playlist_vectors.
+        per_genre (int): Tracks kept per top genre.
+        num_neighbours (int): Neighbours kept per playlist.
+        batch_size (int): Playlists scored per matrix-matrix product, bounds the (candidates x batch) score matrix.
+    Returns:
+        PrecomputedRecs
+    """
+    store = re.feature_store
+    vectors = np.nan_to_num(np.asarray(vectors, dtype=VECTOR_DTYPE))
+    index = PlaylistVectorIndex(playlist_ids, vectors)
+    num_tracks = 3 * per_genre
+
+    tracks = np.full((len(playlist_ids), num_tracks), -1, dtype=np.int32)
+    scores = np.zeros((len(playlist_ids), num_tracks), dtype=VECTOR_DTYPE)
+    neighbours = np.full((len(playlist_ids), num_neighbours), -1, dtype=np.int32)
+
+    for start in range(0, len(playlist_ids), batch_size):
+        batch = np.arange(start, min(start + batch_size, len(playlist_ids)))
+        # A vector without genres has no top genres to recommend from, it stays live
+        batch = batch[vectors[batch, GENRE_SLICE].sum(axis=1) > 0]
+        if not len(batch):
+            continue
+
+        seeds = []
+        for row in batch:
+            top_genres, top_ratios = re.get_top_genres(vectors[row])
+            seeds.append((row, top_genres, re.create_weights(top_genres, top_ratios)))
+
+        candidate_rows = store.genre_rows(sorted({genre for _, top_genres, _ in seeds for genre in top_genres}))
+        similarity = weighted_cosine_many(
+            store.encoded[candidate_rows],
+            store.feature_sqnorms[candidate_rows],
+            store.schema_genre_codes[candidate_rows],
+            np.stack([genre_weight_vector(weights) for _, _, weights in seeds]),
+            vectors[batch][:, SCORED]
+        )
+
+        candidate_genres = store.genre_codes[candidate_rows]
+        for i, (row, top_genres, _) in enumerate(seeds):
+            top_genre_codes = [store.genre_lookup[genre] for genre in top_genres if genre in store.genre_lookup]
+            top_positions = grouped_top_k(similarity[:, i], candidate_genres, top_genre_codes, per_genre)
+            tracks[row, :len(top_positions)] = candidate_rows[top_positions]
+            scores[row, :len(top_positions)] = similarity[top_positions, i]
+
+        for row, top_ids in zip(batch, index.similar_many(vectors[batch], [[playlist_ids[row]] for row in batch], k=num_neighbours)):
+            neighbours[row, :len(top_ids)] = [index.row_lookup[playlist_id] for playlist_id in top_ids]
+
+        print(f"Precomputed {batch[-1] + 1}/{len(playlist_ids)} playlists")
+
+    return PrecomputedRecs(playlist_ids, vectors[:, SCORED], tracks, scores, neighbours, store.version)
+
+
+def main():
+    from sql_work import SQLWork
+    from feature_store import FeatureStore
+    from rec_engine import RecEngine
+
+    parser = argparse.ArgumentParser(description="Precompute recommendations for every stored playlist vector")
+    parser.add_argument('--output', default=DEFAULT_PATH, help="Lookup table path (.npz)")
+    parser.add_argument('--per-genre', type=int, default=60, help="Tracks kept per top genre")
+    parser.add_argument('--neighbours', type=int, default=30, help="Playlist neighbours kept per playlist")
+    parser.add_argument('--batch-size', type=int, default=64, help="Playlists scored per matrix product")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    sql_work = SQLWork()
+    store = FeatureStore.load(sql_work)
+    playlist_ids, vectors = sql_work.get_playlist_vectors()
+
+    with utils.track_memory_usage("precompute"):
+        table = precompute(RecEngine(None, 'precompute', sql_work, store), playlist_ids, vectors,
+                           args.per_genre, args.neighbours, args.batch_size)
+    table.save(args.output)
+    print(f"Saved {len(table)} playlists ({table.nbytes / 1024**2:.2f} MB) to {args.output} in {time.time() - start_time:.2f} s")
+    sql_work.close_sql()
+
+
+if __name__ == '__main__':
+    main()
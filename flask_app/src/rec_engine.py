@@ -4,6 +4,8 @@ import time
 from sklearn.metrics.pairwise import cosine_similarity
 from datetime import datetime, timedelta
 from spotify_client import SpotifyClient
+from feature_schema import GENRES, GENRE_SLICE, SCORED, VECTOR_DTYPE, encode_frame, vector_genre
+from scoring import top_k, grouped_top_k, weighted_cosine, genre_weight_vector, RunningTopK
 # import gc
 # from memory_profiler import profile
 
@@ -16,85 +18,88 @@ import utils as utils
 
 import random
 import time
+from functools import reduce
 
 
 class RecEngine:
+    # 30 playlist recs with an artist rec every 5th song: 6 slots, doubled for duplicates dropped in finalize
+    ARTIST_RECS_PER_GROUP = 12
+
     # @staticmethod
     # def mute_print(*args, **kwargs):
     #     pass
 
-    def __init__(self, spotify_client, unique_id, sql_cnx):
+    def __init__(self, spotify_client, unique_id, sql_cnx, feature_store=None):
         self.sp = spotify_client
         self.unique_id = unique_id
         self.sql_cnx = sql_cnx
+        self.feature_store = feature_store # Resident rec_dataset, candidate tracks are selected from here
+        self._user_top_tracks = None
+        self._ohe_user_top_tracks = None
         # global print
         # print = self.mute_print
        
 
     def playlist_vector(self, playlist, weight=1.1):
+        """
+        Playlist vector in the feature_schema layout, tracks weighted by how recently they were added.
+
+        Args:
+            playlist (pandas.DataFrame): Predicted playlist tracks, most recently added first.
+            weight (float): Each month behind the most recent track divides a track's weight by this.
+        Returns:
+            numpy.ndarray: Vector of length NUM_FEATURES.
+        """
         # print('-> re:playlist_vector()')
         # start_time = time.time()
 
-        playlist = self.ohe_features(playlist)
-
-        # Drop unnecessary columns from the playlist dataframe
-        playlist = playlist.drop(columns=['artist', 'name', 'id'])
+        encoded = encode_frame(playlist)
 
-        # Calculate the most recent date in the playlist
-        most_recent_date = playlist.iloc[0, 0]
-        most_recent_date = pd.to_datetime(most_recent_date, unit='ms').tz_localize(None)
+        # Calculate the number of months behind the most recent track for each track in the playlist
+        dates_added = pd.to_datetime(playlist['date_added'], unit='ms').dt.tz_localize(None)
+        months_behind = ((dates_added.iloc[0] - dates_added).dt.days / 30).astype(int).to_numpy()
 
-        if most_recent_date != pd.Timestamp('1970-01-01 00:00:00') or most_recent_date != 0: 
-            # Calculate the number of months behind for each track in the playlist
-            playlist['date_added'] = pd.to_datetime(playlist['date_added'], unit='ms').dt.tz_localize(None)
-            playlist['months_behind'] = ((most_recent_date - playlist['date_added']).dt.days / 30).astype(int)
-
-            # Calculate the weight for each track based on the months behind
-            playlist['weight'] = weight ** (-playlist['months_behind'])
-            playlist_df_weighted = playlist.copy()
-
-            # Update the values in the playlist dataframe with the weighted values
-            cols_to_update = playlist_df_weighted.columns.difference(['date_added', 'weight', 'months_behind'])
-            playlist_df_weighted.update(playlist_df_weighted[cols_to_update].mul(playlist_df_weighted.weight, axis=0))
-
-            weight_sum = playlist_df_weighted['weight'].sum()
-            # Get the final playlist vector by excluding unnecessary columns
-            playlist_vector = playlist_df_weighted[playlist_df_weighted.columns.difference(['date_added', 'weight', 'months_behind'])].sum(axis=0) / weight_sum
-        else:
-            # If the most recent date is the default value, exclude only the 'date_added' column
-            playlist_vector = playlist.drop(columns=['date_added']).mean(axis=0)
-
-        # Transposes into a one row vector
-        playlist_vector = playlist_vector.to_frame().T
+        # Weighted mean of the tracks, tracks without a date_added (0) all weigh 1
+        track_weights = weight ** (-months_behind.astype(float))
+        playlist_vector = (track_weights @ encoded) / track_weights.sum()
 
         # print(f'Playlist vector created in {time.time() - start_time:.2f} s')
         print('<- re:playlist_vector()')
-        return playlist_vector
+        return playlist_vector.astype(VECTOR_DTYPE)
 
     def recommend_playist_to_playlist(self, playlist_id, p_vector, playlist_vectors, saved_playlist_ids, prev_p_rec_ids):
+        """
+        Args:
+            playlist_vectors (PlaylistVectorIndex): Shared index of stored playlist vectors, never modified here.
+        Returns:
+            list: Top 9 most similar playlist ids, excluding the playlist itself, saved playlists and previous recommendations.
+        """
         print('-> re:recommend_playist_to_playlist()')
 
-        # Filter out playlists in user saved playlists, so save the unique id in these vectors
-        
-        columns_to_drop = ['duration_ms', 'popularity']
-        p_vector.drop(columns=[col for col in columns_to_drop if col in p_vector.columns], axis=1, inplace=True)
-        playlist_vectors.drop(columns=[col for col in columns_to_drop if col in playlist_vectors.columns], axis=1, inplace=True)
-        
-        playlist_vectors = playlist_vectors[~playlist_vectors['playlist_id'].isin([playlist_id] + saved_playlist_ids + prev_p_rec_ids)]
-
-        playlist_vectors_no_id = playlist_vectors.drop(columns=['playlist_id'])
+        top_playlists = playlist_vectors.similar(p_vector, [playlist_id] + saved_playlist_ids + prev_p_rec_ids, k=9)
 
-        playlist_vectors['similarity'] = cosine_similarity(playlist_vectors_no_id.values, p_vector.values.reshape(1, -1))[:,0]
+        print('<- re:recommend_playist_to_playlist()')
+        return top_playlists
 
-        playlist_vectors = playlist_vectors.sort_values(by='similarity', ascending=False)
-        # Return the top 10 results playlist_id
 
-        print('<- re:recommend_playist_to_playlist()')
-        # playlist_vectors.to_csv('playlist_vectors.csv')
-        # Introduce a random element
-        return playlist_vectors['playlist_id'].head(9).tolist()   # .sample(5).tolist()
 
+    def recommend_playlists_many(self, seeds, playlist_vectors, saved_playlist_ids):
+        """
+        recommend_playist_to_playlist for every seed of a batch, scored as one matrix-matrix product.
 
+        Args:
+            seeds (list): Dicts with 'id', 'vector' and 'prev_p_rec_ids'.
+        Returns:
+            list: Top 9 playlist ids per seed.
+        """
+        print('-> re:recommend_playlists_many()')
+        top_playlists = playlist_vectors.similar_many(
+            np.stack([seed['vector'] for seed in seeds]),
+            [[seed['id']] + saved_playlist_ids + seed['prev_p_rec_ids'] for seed in seeds],
+            k=9
+        )
+        print('<- re:recommend_playlists_many()')
+        return top_playlists
 
     def recommend_by_playlist(
         self,
@@ -112,111 +117,142 @@ class RecEngine:
         Recommend songs based on a playlist.
         """
         print('-> re:recommend_by_playlist()')
+        seed = {
+            'type': 'playlist',
+            'vector': playlist_vector,
+            'track_ids': p_track_ids,
+            'recommended_ids': recommended_ids,
+            'top_genres': top_genres,
+            'top_ratios': top_ratios,
+        }
+        return self.recommend_many([seed], user_top_tracks, user_top_artists, class_items)[0]
+
+    def recommend_many(self, seeds, user_top_tracks, user_top_artists, class_items):
+        """
+        Recommend songs for several playlists / tracks of one user at once.
 
-        with utils.track_memory_usage("get_dataset"):
-            rec_dataset = self.sql_cnx.get_dataset(top_genres, user_top_artists)
-            print(f"Memory usage of rec_dataset: {utils.mem_usage(rec_dataset)}")
-            print(len(rec_dataset))
-
-        # rec_dataset = rec_dataset[
-        #     rec_dataset['track_genre'].isin(top_genres) |
-        #     rec_dataset['artists'].isin([artist['artist_name'] for artist in user_top_artists])
-        # ].reset_index(drop=True)
-
-        with utils.track_memory_usage("prepare_data"):
-            # Prepare data for recommendation
-            playlist_vector, rec_dataset, ohe_rec_dataset, top_artists_tracks, ohe_top_artist_tracks = self.prepare_data(
-                self.sp,
-                rec_dataset,
-                playlist_vector,
-                p_track_ids,
-                recommended_ids,
-                [artist['artist_name'] for artist in user_top_artists] # user_top_artists names
-            )
-
+        The seeds share one candidate slice of the feature store, the user's predicted top tracks and a single
+        matrix-matrix scoring pass; selection and finalization then run per seed exactly as for a single seed.
 
-        # Apply weights to the top genres
-        weights = self.create_weights(top_genres, top_ratios)
-        with utils.track_memory_usage("ohe_rec_dataset"):
-            ohe_rec_dataset = self.apply_weights(ohe_rec_dataset, weights)
-
-        with utils.track_memory_usage("find_similar_artists"):
-        # Find similar artists
-            top_3_artists = self.find_similar_artists(
-                top_artists_tracks,
-                ohe_top_artist_tracks,
-                playlist_vector,
-                top_genres,
-                top_ratios,
-                weights
-            )
+        Args:
+            seeds (list): One dict per seed with 'type' ('playlist' or 'track'), 'vector', 'track_ids' (tracks of
+                the seed itself), 'recommended_ids' (previous recommendations) and, for playlists,
+                'top_genres' and 'top_ratios'.
+        Returns:
+            list: Recommended track ids per seed, in seed order.
+        """
+        print(f'-> re:recommend_many() {len(seeds)} seeds')
+        seeds = [dict(seed) for seed in seeds] # Working copies, per-seed state is added below
+        top_artist_names = [artist['artist_name'] for artist in user_top_artists]
 
-        if top_3_artists:
-            print("Top 3 Artists:", top_3_artists)
-            with utils.track_memory_usage("get_artist_recs"):
-                artist_recs = self.get_artist_recs(
-                    rec_dataset,
-                    top_3_artists, 
-                    user_top_artists, 
-                    playlist_vector, 
-                    p_track_ids, 
-                    recommended_ids, 
-                    top_genres,
-                    weights
+        with utils.track_memory_usage("get_dataset"):
+            top_artist_rows = self.feature_store.artist_rows(top_artist_names)
+            for seed in seeds:
+                excluded = set(list(seed['track_ids']) + list(seed['recommended_ids']))
+                if seed['type'] == 'playlist':
+                    seed['weights'] = self.create_weights(seed['top_genres'], seed['top_ratios'])
+                    seed['k'] = 90 // len(seed['top_genres'])
+                    genre_rows = self.genre_candidate_rows(seed['top_genres'], seed['vector'], seed['k'], len(excluded))
+                    rows = np.union1d(genre_rows, top_artist_rows)
+                else:
+                    seed['genre'] = vector_genre(seed['vector'])
+                    seed['weights'] = {seed['genre']: 0.9, 'default': 0.8}
+                    rows = self.genre_candidate_rows([seed['genre']], seed['vector'], 45, len(excluded))
+
+                # Exclude tracks that are already in the seed or were recommended before
+                seed['rows'] = self.feature_store.exclude_tracks(rows, excluded)
+                # Only the scored features are compared, replace any NaN values in the vector with 0
+                seed['scored_vector'] = np.nan_to_num(np.asarray(seed['vector'])[SCORED])
+
+            # Candidates of every seed, scored together chunk by chunk below
+            candidate_rows = reduce(np.union1d, [seed['rows'] for seed in seeds], np.empty(0, dtype=np.int32))
+            print(len(candidate_rows))
+
+        for seed in seeds:
+            seed['artist_recs'] = []
+            if seed['type'] != 'playlist':
+                continue
+            with utils.track_memory_usage("find_similar_artists"):
+                top_3_artists = self.find_similar_artists(
+                    self.feature_store.frame(top_artist_rows),
+                    self.feature_store.encoded[top_artist_rows],
+                    seed['scored_vector'],
+                    seed['top_genres'],
+                    seed['top_ratios'],
+                    seed['weights']
                 )
-        with utils.track_memory_usage("get_personalized_vector"):
-            # Get personalized vector
-            personalized_vector = self.get_personalized_vector(
-                playlist_vector,
-                weights,
-                user_top_tracks,
-                class_items
-            )
+            if top_3_artists:
+                print("Top 3 Artists:", top_3_artists)
+                with utils.track_memory_usage("get_artist_recs"):
+                    seed['artist_recs'] = self.get_artist_recs(
+                        top_3_artists,
+                        user_top_artists,
+                        seed['scored_vector'],
+                        seed['track_ids'],
+                        seed['recommended_ids'],
+                        seed['top_genres'],
+                        seed['weights']
+                    )
 
         with utils.track_memory_usage("combined_vector"):
-            # Combine vectors
-            combined_vector = 0.7 * playlist_vector + 0.3 * personalized_vector
+            # Combine each seed vector with the user's personalized vector
+            combined_vectors = []
+            for seed in seeds:
+                personalized_vector = self.get_personalized_vector(seed['scored_vector'], seed['weights'], user_top_tracks, class_items)
+                seed_weight = 0.7 if seed['type'] == 'playlist' else 0.9
+                combined_vectors.append(seed_weight * seed['scored_vector'] + (1 - seed_weight) * personalized_vector)
+
+        for seed in seeds:
+            # Seed rows are a sorted subset of candidate_rows, their positions tell which rows of a chunk are the seed's
+            seed['positions'] = np.searchsorted(candidate_rows, seed['rows'])
+            if seed['type'] == 'playlist':
+                # Top songs of each top genre
+                top_genre_codes = [self.feature_store.genre_lookup[genre] for genre in seed['top_genres'] if genre in self.feature_store.genre_lookup]
+                seed['top_songs'] = RunningTopK(top_genre_codes, seed['k'])
+            else:
+                # Candidates all come from the track genre, take the top 45 directly
+                seed['top_songs'] = RunningTopK([0], 45)
 
         with utils.track_memory_usage("calc_cosine_similarity"):
-            # Calculate similarity between combined and rec_dataset, return with ranked similarity
-            rec_dataset = self.calc_cosine_similarity(
-                rec_dataset,
-                ohe_rec_dataset,
-                combined_vector,
-                weights
+            # Only one chunk of scores exists at a time, each seed keeps its running top songs
+            chunks = self.feature_store.score_chunks(
+                candidate_rows,
+                np.stack([genre_weight_vector(seed['weights']) for seed in seeds]),
+                np.stack(combined_vectors)
             )
-
-        # Initialize an empty DataFrame to store top songs
-        top_songs = pd.DataFrame()
-
-        print("Selecting top songs...")
-        # Select top songs from each genre based on similarity and add them to the top_songs DataFrame
-        
-        with utils.track_memory_usage("top_songs"):
-            for genre in top_genres:
-                genre_songs = rec_dataset[rec_dataset['track_genre'] == genre]
-                top_songs = pd.concat(
-                    [top_songs, genre_songs.nlargest(90 // len(top_genres), 'similarity')]
-                )
-
-        # If no songs are found, return an empty list
-        if top_songs.empty:
-            return []
-
-        with utils.track_memory_usage("finalize_update_recommendations"):
-            # Finalize and update the recommended songs
-            recommendations = self.finalize_update_recommendations(
-                top_songs,
-                'playlist',
-                artist_recs,
-                top_ratios
-            )
-
+            for start, chunk_rows, similarity in chunks:
+                for i, seed in enumerate(seeds):
+                    first, last = np.searchsorted(seed['positions'], [start, start + len(chunk_rows)])
+                    chunk_positions = seed['positions'][first:last] - start
+                    rows = chunk_rows[chunk_positions]
+                    groups = self.feature_store.genre_codes[rows] if seed['type'] == 'playlist' else np.zeros(len(rows), dtype=np.intp)
+                    seed['top_songs'].push(rows, similarity[chunk_positions, i], groups)
+
+        recommendations = []
+        for seed in seeds:
+            with utils.track_memory_usage("top_songs"):
+                top_rows, top_similarity = seed['top_songs'].result()
+                top_songs = self.feature_store.frame(top_rows)
+                top_songs['similarity'] = top_similarity
+
+            # If no songs are found, return an empty list
+            if seed['type'] == 'playlist' and top_songs.empty:
+                recommendations.append([])
+                continue
+
+            with utils.track_memory_usage("finalize_update_recommendations"):
+                recommendations.append(self.finalize_update_recommendations(
+                    top_songs,
+                    seed['type'],
+                    seed['artist_recs'],
+                    seed.get('top_ratios', {})
+                ))
+
+        print('<- re:recommend_many()')
         return recommendations
 
     def get_artist_recs(
         self, 
-        rec_dataset,
         top_3_artists, 
         user_top_artists, 
         playlist_vector, 
@@ -247,21 +283,18 @@ class RecEngine:
 
         print("Related Artists:", related_artists)
 
-        # Get related artist tracks
-        related_artists_tracks = rec_dataset[rec_dataset['artists'].isin(related_artists)]
+        # Get related artist tracks, across all genres
         with utils.track_memory_usage("get_dataset artist_rec"):
-            add_rel_art_tracks = self.sql_cnx.get_dataset(top_genres, related_artists, artist_rec=True)
-        related_artists_tracks =  pd.concat([related_artists_tracks, add_rel_art_tracks], ignore_index=True)
+            related_artist_rows = self.feature_store.artist_rows(related_artists)
         _, related_artists_tracks, related_artists_tracks_ohe = self.prepare_data(
             self.sp,
-            related_artists_tracks,
+            related_artist_rows,
             playlist_vector,
             p_track_ids,
             recommended_ids
         )
 
         # Calculate cosine similarity between final playlist vector and related artist tracks to find 
-        related_artists_tracks_ohe = self.apply_weights(related_artists_tracks_ohe, weights)
         artist_recs_df = self.calc_cosine_similarity(
             related_artists_tracks,
             related_artists_tracks_ohe,
@@ -269,84 +302,83 @@ class RecEngine:
             weights
         )
 
-        artist_recs_df = artist_recs_df.sort_values(by='similarity', ascending=False)
+        artist_recs_df = self.rank_artist_recs(artist_recs_df, related_artists)
         # artist_recs_df.to_csv('artist_recs.csv', index=False)
 
         # print("Time taken to get artist recommendations:", time.time() - start_time)
         print("<- re:get_artist_recs()")
         return artist_recs_df
 
+    def rank_artist_recs(self, artist_recs_df, related_artists):
+        """
+        Keep the best ARTIST_RECS_PER_GROUP tracks of each (artist, genre) and order them by similarity.
+
+        finalize_update_recommendations only ever takes the best remaining track of an artist (in a genre),
+        at most once per insertion slot, so deeper tracks of a group are never used.
+        """
+        similarity = artist_recs_df['similarity'].to_numpy()
+        related_codes = np.sort([self.feature_store.artist_lookup[artist] for artist in related_artists if artist in self.feature_store.artist_lookup])
+
+        # Compact (artist, genre) group codes, every row is by one of the related artists
+        artist_slots = np.searchsorted(related_codes, self.feature_store.artist_codes[artist_recs_df.index])
+        groups = artist_slots * len(self.feature_store.genres) + self.feature_store.genre_codes[artist_recs_df.index]
+
+        selected = grouped_top_k(similarity, groups, np.unique(groups), self.ARTIST_RECS_PER_GROUP)
+        selected = selected[np.lexsort((selected, -similarity[selected]))]
+        return artist_recs_df.iloc[selected]
+
     def track_vector(self, track):
         print('-> re:track_vector()')
         # One-hot encode categorical features
-        track_vector = self.ohe_features(track)
-        track_vector = track_vector.drop(columns=['artist', 'name', 'id'])
+        track_vector = encode_frame(track)[0]
         print('<- re:track_vector()')
         return track_vector
 
+    def recommend_precomputed(self, rows, similarity, p_track_ids, top_genres, top_ratios):
+        """
+        Recommend songs for a cold playlist request from its precomputed.PrecomputedRecs entry, without scoring.
+
+        Args:
+            rows (numpy.ndarray), similarity (numpy.ndarray): Precomputed store rows and similarities, grouped by top genre.
+            p_track_ids (set): Track ids of the playlist, dropped from the precomputed tracks.
+        Returns:
+            list: Recommended track ids, as recommend_by_playlist without the user's personalization and artist recs.
+        """
+        print('-> re:recommend_precomputed()')
+        keep = np.isin(rows, self.feature_store.exclude_tracks(rows, p_track_ids))
+        top_songs = self.feature_store.frame(rows[keep])
+        top_songs['similarity'] = similarity[keep]
+        # Same number of songs per top genre as a live request
+        top_songs = top_songs.groupby('track_genre', sort=False).head(90 // len(top_genres))
+
+        if top_songs.empty:
+            return []
+        recommendations = self.finalize_update_recommendations(top_songs, 'playlist', [], top_ratios)
+        print('<- re:recommend_precomputed()')
+        return recommendations
+
     def recommend_by_track(self, track_vector, track_id, user_top_tracks, class_items, recommended_ids=[]):
         print('-> re:recommend_by_track()')
-        
-        # Get track genre and drop release date
-        track_genre_column = track_vector.columns[(track_vector.columns.str.startswith('track_genre_')) & (track_vector.iloc[0] == 1)].tolist()
-        if track_genre_column:
-            track_genre = track_genre_column[0].replace('track_genre_', '')
-            print(track_genre)
-        if 'release_date' in track_vector.columns:
-            track_vector = track_vector.drop(columns=['release_date'])
-
-        # Get dataset for track
-        with utils.track_memory_usage("get_dataset track_rec"):
-            rec_dataset = self.sql_cnx.get_dataset(track_genre, track=True)
-            print(len(rec_dataset))
-
-        # Prepare data for recommendation
-        track_vector, rec_dataset, ohe_rec_dataset  = self.prepare_data(self.sp, rec_dataset, track_vector, track_id, recommended_ids)
-
-        # Apply weight to track genre
-        weights = {track_genre: 0.9, 'default': 0.8}
-        ohe_rec_dataset = self.apply_weights(ohe_rec_dataset, weights)
-
-        # Get personalized track vector based on top tracks
-        personalized_vector = self.get_personalized_vector(track_vector, weights, user_top_tracks, class_items)
-        combined_vector = 0.9 * track_vector + 0.1 * personalized_vector
-        
-        # Calculate cosine similarity between final track vector and recommendations
-        rec_dataset = self.calc_cosine_similarity(rec_dataset, ohe_rec_dataset, combined_vector, weights)
-        top_songs = pd.DataFrame()
-        
-        genre_songs = rec_dataset[rec_dataset['track_genre'] == track_genre]
-        top_songs = pd.concat([genre_songs.nlargest(45, 'similarity')])
-        
-        # Finalize and update the recommended songs
-        recommendations = self.finalize_update_recommendations(top_songs, 'track')
-        
-        return recommendations
+        seed = {
+            'type': 'track',
+            'vector': track_vector,
+            'track_ids': track_id,
+            'recommended_ids': recommended_ids,
+        }
+        return self.recommend_many([seed], user_top_tracks, [], class_items)[0]
 
     # Helper Functions
-    def ohe_features(self, df):
-        print('-> re:ohe_features()')
-        # start_time = time.time() 
-        # print(f"input df shape: {df.shape}, columns: {df.columns}") 
-        all_genres = pd.read_csv('../data/datasets/genre_counts.csv')
-        df = pd.get_dummies(df, columns=['track_genre', 'mode', 'key'])  # One-hot encode the genre column
-    
-        ohe_columns = [col for col in df.columns if 'track_genre' in col or 'mode' in col or 'key' in col]
-        df[ohe_columns] = df[ohe_columns].astype(int) 
-
-        expected_genres = {'track_genre_' + genre for genre in all_genres['track_genre']}
-        missing_genres = expected_genres - set(df.columns)
-        for genre in missing_genres:
-            df[genre] = 0
-
-        expected_keys_modes = {f'key_{i}' for i in range(12)} | {f'mode_{i}' for i in range(2)}
-        missing_keys_modes = expected_keys_modes - set(df.columns)
-        for key_mode in missing_keys_modes:
-            df[key_mode] = 0
-        
-        # print("Time taken to OHE Features:", time.time() - start_time, "s")
-        print("<- re:ohe_features()")
-        return df
+    def genre_candidate_rows(self, genres, vector, k, num_excluded):
+        """
+        Feature store rows of the given genres to score against vector.
+
+        Every row of the genres, or only the rows the ANN index finds close to vector when the store has an up to date
+        index. The index keeps probing until each genre has k candidates left after num_excluded tracks are dropped.
+        """
+        index = self.feature_store.track_index
+        if index is None or index.version != self.feature_store.version:
+            return self.feature_store.genre_rows(genres)
+        return index.candidate_rows(genres, vector, min_rows=k + num_excluded)
 
     def normalize_vector(self, vector):
         num_tracks = len(vector)
@@ -357,15 +389,15 @@ class RecEngine:
         
     def get_top_genres(self, final_playlist_vector):
         print('-> re:get_top_genres()')
-        # Get the genre columns from the final playlist vector
-        genre_columns = final_playlist_vector.columns[final_playlist_vector.columns.str.startswith('track_genre_')]
-        
+        # Get the genre features from the final playlist vector
+        genre_values = final_playlist_vector[GENRE_SLICE]
+
         # Get the top 3 genres from the final playlist vector
-        top_genres = final_playlist_vector[genre_columns].iloc[0].nlargest(3)
-        top_genres_names = list(top_genres.index.str.replace('track_genre_', ''))
-        total_genres_sum = final_playlist_vector[genre_columns].iloc[0].sum()
+        top_genres = top_k(genre_values, 3)
+        top_genres_names = [GENRES[i] for i in top_genres]
+        total_genres_sum = genre_values.sum()
 
-        top_genres_ratios = {genre_name: float(top_genres[f'track_genre_{genre_name}'] / total_genres_sum) for genre_name in top_genres_names}
+        top_genres_ratios = {GENRES[i]: float(genre_values[i] / total_genres_sum) for i in top_genres}
 
         print(top_genres_ratios)
         print(top_genres_names)
@@ -376,61 +408,41 @@ class RecEngine:
         print("<- re:get_top_genres()")
         return top_genres_names, top_genres_ratios
 
-    def prepare_data(self, sp, rec_dataset, vector, ids, recommended_ids, top_artist_names=None):
+    def prepare_data(self, sp, rows, vector, ids, recommended_ids, top_artist_names=None):
+        """
+        Slice the candidate rows out of the feature store, dropping tracks already in the input or previously recommended.
+
+        Args:
+            rows (numpy.ndarray): Candidate row indices into the feature store.
+            vector (numpy.ndarray): Playlist or track vector in the feature_schema layout.
+            ids (list): Track ids of the playlist / track being recommended for.
+            recommended_ids (list): Previously recommended track ids.
+            top_artist_names (list, optional): User top artist names, their candidate tracks are returned separately.
+        Returns:
+            The scored part of the vector, the candidate tracks and their encoded matrix
+            (plus the top artist tracks and their encoded matrix when top_artist_names is given).
+        """
         print('-> re:prepare_data()')
         start_time = time.time()
-        if rec_dataset is None:
-            print("rec_dataset is None") 
-        else:
-            print(f"memory usage of rec_dataset: {utils.mem_usage(rec_dataset)}")
-            
-        # print(f"input rec_dataset shape: {rec_dataset.shape}, columns: {rec_dataset.columns}")
-        with utils.track_memory_usage("ohe_features in prepare_data"):
-            ohe_rec_dataset = self.ohe_features(rec_dataset)  # Save instance in SQL
-            print(f"memory usage of ohe_rec_dataset: {utils.mem_usage(ohe_rec_dataset)}")
 
         if top_artist_names is not None:
-            top_artist_tracks = rec_dataset[rec_dataset['artists'].isin(top_artist_names)]
-            ohe_top_artist_tracks = ohe_rec_dataset[ohe_rec_dataset['track_id'].isin(top_artist_tracks['track_id'])]
+            top_artist_rows = rows[self.feature_store.artist_mask(top_artist_names)[rows]]
+            top_artist_tracks = self.feature_store.frame(top_artist_rows)
+            ohe_top_artist_tracks = self.feature_store.encoded[top_artist_rows]
 
-
-        # Exclude tracks from the ohe_rec_dataset that are already in the playlist track ids
-        # ohe_rec_dataset = ohe_rec_dataset[~ohe_rec_dataset['track_id'].apply(lambda x: x in ids or x in recommended_ids)]
-        
+        # Exclude tracks that are already in the playlist track ids or were recommended before
         with utils.track_memory_usage("filter ids"):
-            ids_set = set(list(ids) + recommended_ids)
-            ohe_rec_dataset = ohe_rec_dataset[~ohe_rec_dataset['track_id'].isin(ids_set)]
-            print(f"memory usage of ohe_rec_dataset after filter: {utils.mem_usage(ohe_rec_dataset)}")
-       
-        # Match ohe_rec_dataset and rec_dataset track ids
-        # rec_dataset = rec_dataset.merge(ohe_rec_dataset[['track_id']], on='track_id')
-        rec_dataset = rec_dataset[rec_dataset['track_id'].isin(ohe_rec_dataset['track_id'])]
+            rows = self.feature_store.exclude_tracks(rows, set(list(ids) + recommended_ids))
 
+        # Encoded rows are precomputed in the feature store, just slice them out
+        with utils.track_memory_usage("slice encoded rows"):
+            rec_dataset = self.feature_store.frame(rows)
+            ohe_rec_dataset = self.feature_store.encoded[rows]
+            print(f"memory usage of ohe_rec_dataset: {ohe_rec_dataset.nbytes / 1024**2:.2f} MB")
 
-        # Sort the columns of the final vector and final recommendation dataframe to have the same order
-        with utils.track_memory_usage("sort columns"):
-            vector, ohe_rec_dataset = self.sort_columns(vector, ohe_rec_dataset)
-            print(f"memory usage of vector: {utils.mem_usage(vector)}")
-            print(f"memory usage of ohe_rec_dataset: {utils.mem_usage(ohe_rec_dataset)}")
+        # Only the scored features are compared, replace any NaN values in the vector with 0
+        vector = np.nan_to_num(vector[SCORED])
 
-        if top_artist_names is not None:
-            ohe_top_artist_tracks = ohe_top_artist_tracks.reindex(columns=ohe_rec_dataset.columns)
-        
-        # Drop unnecessary columns from the vector and ohe_rec_dataset
-        columns_to_drop = ['duration_ms', 'popularity'] # Reconsider if you should drop popularity
-        vector.drop(columns=[col for col in columns_to_drop if col in vector.columns], axis=1, inplace=True)
-        ohe_rec_dataset.drop(columns=[col for col in columns_to_drop if col in ohe_rec_dataset.columns], axis=1, inplace=True)
-        
-        if top_artist_names is not None:
-            ohe_top_artist_tracks.drop(columns=[col for col in columns_to_drop if col in ohe_top_artist_tracks.columns], axis=1, inplace=True)
-       
-        # Replace any NaN values in the final vector or dataframe with 0
-        vector.fillna(0, inplace=True,)
-        ohe_rec_dataset.fillna(0, inplace=True)
-        
-        if top_artist_names is not None:
-            ohe_top_artist_tracks.fillna(0, inplace=True)
-        
         print("Time taken to prepare data:", time.time() - start_time, "s")
         print("<- re:prepare_data()")
         if top_artist_names is not None:
@@ -438,42 +450,28 @@ class RecEngine:
 
         return vector, rec_dataset, ohe_rec_dataset
 
-    def apply_weights(self, ohe_dataset, weights):
-        # print('-> re:apply_weights()')
-        # start_time = time.time()    
-
-        for genre in ohe_dataset.columns:
-            if genre.startswith('track_genre_'):
-                stripped_genre = genre.replace('track_genre_', '')
-                if stripped_genre in weights:
-                    ohe_dataset[genre] *= weights[stripped_genre]
-                else:
-                    ohe_dataset[genre] *= weights['default']
-
-        # print("Time taken to apply weights:", time.time() - start_time, "s")
-        # print("<- re:apply_weights()")
-        return ohe_dataset
-
     def calc_cosine_similarity(self, dataset, ohe_dataset, vector, weights):
         """
         Args:
-            dataset (pandas.DataFrame): dataset to apply similarity to. // Can be rec_dataset, related_artist_tracks, or top_artist_tracks
-            ohe_dataset (pandas.DataFrame): The one-hot encoded dataset.
+            dataset (pandas.DataFrame): dataset to apply similarity to, indexed by feature store row. // Can be rec_dataset, related_artist_tracks, or top_artist_tracks
+            ohe_dataset (numpy.ndarray): The one-hot encoded dataset, unweighted.
             vector (numpy.ndarray): The vector being compared to the data.
             weights (dict): The weights for each track genre.
         Returns:
-            pandas.DataFrame: The dataset with an additional column 'similarity' representing the cosine similarity.
+            pandas.DataFrame: The dataset with an additional column 'similarity' representing the genre weighted cosine similarity.
         """
         print('-> re:calc_cosine_similarity()')
         # start_time = time.time()
 
-        # Calculate the cosine similarity between the final vector and the final recommendation dataframe
-        dataset['similarity'] = cosine_similarity(ohe_dataset.values, vector.values.reshape(1, -1))[:,0]
-        
-        nan_weight = weights.get('default', 0)
-
-        weights = dataset['track_genre'].map(weights).fillna(nan_weight)
-        dataset['similarity'] *= weights
+        # Genre columns and the final similarity are both scaled by the genre weights, in one pass over ohe_dataset
+        rows = dataset.index.to_numpy()
+        dataset['similarity'] = weighted_cosine(
+            ohe_dataset,
+            self.feature_store.feature_sqnorms[rows],
+            self.feature_store.schema_genre_codes[rows],
+            genre_weight_vector(weights),
+            vector
+        )
 
         # print("cosine_similarity time:", time.time() - start_time, "seconds")
         print("<- re:calc_cosine_similarity()")
@@ -519,12 +517,14 @@ class RecEngine:
                 remaining_songs_df = top_songs[~top_songs['track_id'].isin(recommended_songs['track_id'])].head(remaining_songs)
                 recommended_songs = pd.concat([recommended_songs, remaining_songs_df], ignore_index=True)
             
-            unique_artists = artist_recs['artists'].unique() # All unique artists in artist_recs
+            unique_artists = artist_recs['artists'].unique() if len(artist_recs) else [] # All unique artists in artist_recs
             used_artists = set() # Set to keep track of artists that have already been recommended
             artist_index = 0 # Start with first artist in artist_recs
+            # Without artist recs (no top artist matched, or a precomputed cold request) the genre picks are final
+            insert_until = len(recommended_songs) if len(unique_artists) else 0
 
             # Iterate through the recommended songs to insert artist recs at defined interval (5)
-            for i in range(artist_rec_interval - 1, len(recommended_songs), artist_rec_interval):   
+            for i in range(artist_rec_interval - 1, insert_until, artist_rec_interval):   
                 # Initial check to see if all unique artists have already been recommended
                 if artist_index >= len(unique_artists):
                     artist_index = 0
@@ -566,18 +566,6 @@ class RecEngine:
         print('<- re:finalize_update_recommendations()')
         return recommended_ids
 
-    def sort_columns(self, vector, ohe_dataset):
-        # Print none columns:
-        print(vector.columns[vector.isnull().any()])
-        common_cols = vector.columns.intersection(ohe_dataset.columns)
-        # vector.drop(columns=vector.columns.difference(common_cols), inplace=True)
-        # ohe_dataset.drop(columns=ohe_dataset.columns.difference(common_cols), inplace=True)
-        vector = vector[common_cols]
-        ohe_dataset = ohe_dataset[common_cols]
-
-
-        return vector, ohe_dataset
-
     def clean_recommendations(self, df):
         df['similarity'] = (df['similarity'] * 100).round().astype(int).astype(str) + '% similar'
         df = df[['track_name', 'artists', 'track_genre', 'similarity', 'Link', 'track_id']]
@@ -628,22 +616,22 @@ class RecEngine:
         print("-> re:get_personalized_vector()")
         start_time = time.time()
 
-        user_top_tracks = self.sp.predict(user_top_tracks, 'playlist', class_items) # list items
-        ohe_user_top_tracks = self.ohe_features(user_top_tracks)
-
-        ohe_user_top_tracks, vector = self.sort_columns(ohe_user_top_tracks, vector)
+        # Predicted and encoded once per RecEngine, every seed of a batch shares them
+        if self._user_top_tracks is None:
+            self._user_top_tracks = self.sp.predict(user_top_tracks, 'playlist', class_items) # list items
+            self._ohe_user_top_tracks = encode_frame(self._user_top_tracks, scored_only=True)
+        user_top_tracks, ohe_user_top_tracks = self._user_top_tracks, self._ohe_user_top_tracks
 
         # Calculate the weighted similarity of user top tracks against the vector
-        user_top_tracks['similarity'] = cosine_similarity(ohe_user_top_tracks.values, vector.values.reshape(1, -1))[:,0]
+        similarity = cosine_similarity(ohe_user_top_tracks, vector.reshape(1, -1))[:,0]
         # Map genre weights to user top tracks
         nan_weight = weights.get('default') 
-        genre_weights = user_top_tracks['track_genre'].map(weights).fillna(nan_weight) 
+        genre_weights = user_top_tracks['track_genre'].map(weights).fillna(nan_weight).to_numpy()
         # Apply genre weights for weighted similarity
-        user_top_tracks['weighted_similarity'] = user_top_tracks['similarity'] * genre_weights
+        weighted_similarity = similarity * genre_weights
 
         # Normalize the final playlist vector
-        personalized_vector = ohe_user_top_tracks.multiply(user_top_tracks['weighted_similarity'], axis=0).sum() / user_top_tracks['weighted_similarity'].sum()
-        personalized_vector = personalized_vector.to_frame().T
+        personalized_vector = (weighted_similarity @ ohe_user_top_tracks) / weighted_similarity.sum()
 
         print("Getting personalized vector... :", time.time() - start_time, "s")
         print("<- re:get_personalized_vector()")   
@@ -694,14 +682,10 @@ class RecEngine:
     def find_similar_artists(self, top_artist_tracks, ohe_top_artist_tracks, playlist_vector, top_genres, top_ratios, weights):
         print("-> re:find_similar_artists()")
         # start_time = time.time()
-        
-        ohe_top_artist_tracks = self.apply_weights(ohe_top_artist_tracks, weights)
 
         # Calculate cosine similarity between final playlist vector and recommendations
         similar_artists_df = self.calc_cosine_similarity(top_artist_tracks, ohe_top_artist_tracks, playlist_vector, weights)
 
-        similar_artists_df = similar_artists_df.sort_values(by='similarity', ascending=False)
-        
         # Group by artists and track genre to find how many entries in each genre each artist has
         artist_genre_counts = similar_artists_df.groupby(['artists', 'track_genre']).size().unstack(fill_value=0)
         
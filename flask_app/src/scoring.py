@@ -0,0 +1,207 @@
+"""
+Scoring and selection over raw similarity arrays.
+
+weighted_cosine is RecEngine's genre-weighted cosine similarity in one pass over the candidate matrix.
+Selection results match pandas' nlargest(keep='first'): highest score first, ties broken by position, NaN never
+selected ahead of a number. Selection is O(n) with np.argpartition, only the k selected rows are sorted.
+"""
+import numpy as np
+
+from feature_schema import GENRES, GENRE_SLICE, VECTOR_DTYPE
+
+
+def genre_weight_vector(weights):
+    """
+    Genre weights dict (genre -> weight plus 'default') as an array indexed by GENRES position.
+
+    The trailing element holds the default weight, so a genre code of -1 (unknown genre) picks it up.
+    """
+    default = weights.get('default', 0)
+    return np.array([weights.get(genre, default) for genre in GENRES] + [default], dtype=VECTOR_DTYPE)
+
+
+def weighted_cosine(matrix, feature_sqnorms, genre_codes, genre_weights, query):
+    """
+    Genre-weighted cosine similarity of every candidate row against a query vector.
+
+    Equivalent to scaling each genre column of the candidates by its genre weight, taking the cosine similarity
+    with the query, then multiplying each row by the weight of its own genre. Since a candidate has exactly one
+    genre column set, its weighted norm is sqrt(feature_sqnorms + weight**2) and the weighting folds into the
+    query side, so the candidate matrix is only read once (one float32 GEMV) and never copied or modified.
+
+    Args:
+        matrix (numpy.ndarray): float32 candidate matrix of shape (n, NUM_SCORED), e.g. FeatureStore.encoded[rows].
+        feature_sqnorms (numpy.ndarray): Squared norm of each row's non-genre scored features, shape (n,).
+        genre_codes (numpy.ndarray): GENRES position of each row, -1 for genres outside of the schema.
+        genre_weights (numpy.ndarray): Output of genre_weight_vector.
+        query (numpy.ndarray): Scored query vector, shape (NUM_SCORED,).
+    Returns:
+        numpy.ndarray: float32 scores, 0 for all-zero rows or query.
+    """
+    query = np.asarray(query, dtype=VECTOR_DTYPE)
+    weighted_query = query.copy()
+    weighted_query[GENRE_SLICE] *= genre_weights[:-1]
+
+    row_weights = genre_weights[genre_codes]
+    row_norms = feature_sqnorms + np.where(genre_codes >= 0, row_weights * row_weights, 0).astype(VECTOR_DTYPE)
+    np.sqrt(row_norms, out=row_norms)
+    row_norms *= np.linalg.norm(query)
+
+    scores = matrix @ weighted_query
+    scores *= row_weights
+    np.divide(scores, row_norms, out=scores, where=row_norms > 0)
+    scores[row_norms == 0] = 0
+    return scores
+
+
+
+def weighted_cosine_many(matrix, feature_sqnorms, genre_codes, genre_weights, queries):
+    """
+    weighted_cosine for several queries at once, each with its own genre weights, as one float32 GEMM.
+
+    Args:
+        matrix, feature_sqnorms, genre_codes: As in weighted_cosine, shared by every query.
+        genre_weights (numpy.ndarray): One genre_weight_vector per query, shape (q, len(GENRES) + 1).
+        queries (numpy.ndarray): Scored query vectors, shape (q, NUM_SCORED).
+    Returns:
+        numpy.ndarray: float32 scores of shape (n, q), column j holds the scores of query j.
+    """
+    queries = np.asarray(queries, dtype=VECTOR_DTYPE)
+    genre_weights = np.asarray(genre_weights, dtype=VECTOR_DTYPE)
+    weighted_queries = queries.copy()
+    weighted_queries[:, GENRE_SLICE] *= genre_weights[:, :-1]
+
+    row_weights = genre_weights[:, genre_codes].T # (n, q)
+    row_norms = np.where((genre_codes >= 0)[:, None], row_weights * row_weights, 0).astype(VECTOR_DTYPE)
+    row_norms += feature_sqnorms[:, None]
+    np.sqrt(row_norms, out=row_norms)
+    row_norms *= np.linalg.norm(queries, axis=1)
+
+    scores = matrix @ weighted_queries.T
+    scores *= row_weights
+    np.divide(scores, row_norms, out=scores, where=row_norms > 0)
+    scores[row_norms == 0] = 0
+    return scores
+
+
+def top_k(scores, k):
+    """
+    Positions of the k highest scores, in descending score order.
+
+    Args:
+        scores (numpy.ndarray): 1-d similarity array.
+        k (int): Number of positions to return (fewer if scores is shorter).
+    Returns:
+        numpy.ndarray: intp positions into scores.
+    """
+    scores = np.asarray(scores)
+    num_scores = len(scores)
+    k = min(int(k), num_scores)
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+
+    # NaN sorts last under argpartition, negate so the largest scores come first
+    negated = -scores
+    if k < num_scores:
+        selected = np.argpartition(negated, k - 1)[:k]
+        threshold = negated[selected].max()
+        if not np.isnan(threshold):
+            # argpartition picks arbitrary rows among ties at the boundary, keep the earliest ones instead
+            selected = selected[negated[selected] < threshold]
+            ties = np.flatnonzero(negated == threshold)[:k - len(selected)]
+            selected = np.concatenate([selected, ties])
+    else:
+        selected = np.arange(num_scores)
+
+    return selected[np.lexsort((selected, negated[selected]))]
+
+
+def _group_members(groups, wanted):
+    """Positions of the wanted groups' members, group by group in wanted order (in position order within a group), and the group bounds."""
+    # Map each group code to its slot in wanted, -1 for groups that aren't wanted.
+    # The table has one spare trailing -1, so a code of -1 (missing) also lands on "not wanted"
+    slots = np.full(max(groups.max(), wanted.max()) + 2, -1, dtype=np.int16 if len(wanted) < 2**15 else np.intp)
+    slots[wanted[::-1]] = np.arange(len(wanted))[::-1] # First occurrence wins for repeated codes
+    member_slots = slots[groups]
+
+    members = np.flatnonzero(member_slots >= 0)
+    member_slots = member_slots[members]
+    # Stable sort keeps score order within each group, on int16 codes numpy uses a linear radix sort
+    members = members[np.argsort(member_slots, kind='stable')]
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(member_slots, minlength=len(wanted)))])
+    return members, bounds
+
+
+def grouped_top_k(scores, groups, wanted, k):
+    """
+    Top k positions of every wanted group, in one pass over the scores.
+
+    Args:
+        scores (numpy.ndarray): 1-d similarity array.
+        groups (numpy.ndarray): Non-negative integer group code per score, e.g. FeatureStore.genre_codes[rows].
+        wanted (list): Group codes to select from, in output order.
+        k (int): Positions per group.
+    Returns:
+        numpy.ndarray: intp positions into scores, group by group in wanted order, each group by descending score.
+    """
+    groups = np.asarray(groups)
+    wanted = np.asarray(wanted, dtype=np.intp)
+    if len(wanted) == 0 or len(groups) == 0:
+        return np.empty(0, dtype=np.intp)
+
+    members, bounds = _group_members(groups, wanted)
+    selected = []
+    for slot in range(len(wanted)):
+        rows = members[bounds[slot]:bounds[slot + 1]]
+        selected.append(rows[top_k(scores[rows], k)])
+    return np.concatenate(selected)
+
+
+class RunningTopK:
+    """
+    grouped_top_k over scores that arrive chunk by chunk, in position order.
+
+    Only the current top k of every wanted group is kept, so memory stays at k entries per group however many
+    scores are pushed. Each push merges a chunk into the running top k with top_k; earlier chunks come first in
+    the merge, so ties still go to the earliest position and the result matches grouped_top_k over the
+    concatenated scores.
+    """
+
+    def __init__(self, wanted, k):
+        """
+        Args:
+            wanted (list): Group codes to select from, in output order.
+            k (int): Entries kept per group.
+        """
+        self.wanted = np.asarray(wanted, dtype=np.intp)
+        self.k = k
+        self._ids = [np.empty(0, dtype=np.intp) for _ in self.wanted]
+        self._scores = [np.empty(0, dtype=VECTOR_DTYPE) for _ in self.wanted]
+
+    def push(self, ids, scores, groups):
+        """
+        Args:
+            ids (numpy.ndarray): What to return for each score, e.g. feature store rows.
+            scores (numpy.ndarray): 1-d similarity array of the chunk.
+            groups (numpy.ndarray): Non-negative integer group code per score.
+        """
+        if len(self.wanted) == 0 or len(scores) == 0:
+            return
+        members, bounds = _group_members(np.asarray(groups), self.wanted)
+        for slot in range(len(self.wanted)):
+            positions = members[bounds[slot]:bounds[slot + 1]]
+            if len(positions) == 0:
+                continue
+            merged_ids = np.concatenate([self._ids[slot], ids[positions]])
+            merged_scores = np.concatenate([self._scores[slot], scores[positions]])
+            kept = top_k(merged_scores, self.k)
+            self._ids[slot], self._scores[slot] = merged_ids[kept], merged_scores[kept]
+
+    def result(self):
+        """
+        Returns:
+            tuple: (ids, scores), group by group in wanted order, each group by descending score.
+        """
+        if len(self.wanted) == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=VECTOR_DTYPE)
+        return np.concatenate(self._ids), np.concatenate(self._scores)
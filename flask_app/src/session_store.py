@@ -2,16 +2,21 @@ import os
 import json
 import redis
 import time
-import pickle
 import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta
 import random
 from sql_work import SQLWork
+from feature_schema import SCHEMA_VERSION, VECTOR_DTYPE, to_vector
+from near_cache import NearCache, RedisInvalidation, MISSING
+from codec import encode_vector, decode_vector, encode_json, decode
 # Load Redis environment variables
 REDIS_HOST = os.environ.get('REDIS_HOST')
 REDIS_PORT = os.environ.get('REDIS_PORT')
 REDIS_PASSWORD = os.environ.get('REDIS_PASSWORD')
 REDIS_DB = os.environ.get('REDIS_DB', 0)
+NEAR_CACHE_TRACKING = os.environ.get('NEAR_CACHE_TRACKING') == 'True' # Drop near cache entries other workers overwrote
+USER_KEYS_TTL = 86400 # Seconds, the longest TTL of a per-user key, so a user's registry outlives the keys in it
 
 # Create a Redis connection pool
 default_redis_pool = redis.ConnectionPool(
@@ -21,77 +26,194 @@ default_redis_pool = redis.ConnectionPool(
     db=REDIS_DB
 )
 
-class SessionStore:
-    def __init__(self, redis_pool=None):
-        self.redis = redis.Redis(connection_pool=default_redis_pool or redis_pool)
-        self.cache = {}
+def user_keys_key(unique_id):
+    """Redis SET of the keys written for a user ('<unique_id>:...'), deleted with them on logout."""
+    return f'user_keys:{unique_id}'
+
+
+def ttl_seconds(ttl_ms):
+    """PTTL reply in seconds, None for a key without expiry."""
+    return ttl_ms / 1000 if ttl_ms >= 0 else None
+
+
+class SessionWrites:
+    """
+    Writes of one request, sent as a single MULTI / EXEC transaction by execute() (on leaving the with block).
+
+    The near cache is only updated once the transaction has gone through. Scripts run with EVALSHA inside the
+    transaction; one the server lost (restart, SCRIPT FLUSH) fails there without effect and is run again on its own.
+    """
+
+    # Bottom-k reservoir: every pushed id gets a uniform random score and the pool keeps the k lowest, in O(k)
+    # memory. Distinct ids are equally likely to be kept; an id pushed again keeps its lowest score, so ids that
+    # are recommended more often weigh more, as they did in the old list. Pushes stop once the day's sample is taken.
+    _push_random_recs_script = """
+    if redis.call('EXISTS', KEYS[3]) == 1 then
+        return 0
+    end
+    for i = 2, #ARGV, 2000 do
+        redis.call('ZADD', KEYS[1], 'LT', unpack(ARGV, i, math.min(i + 1999, #ARGV)))
+    end
+    redis.call('ZREMRANGEBYRANK', KEYS[1], ARGV[1], -1)
+    redis.call('INCRBY', KEYS[2], (#ARGV - 1) / 2)
+    redis.call('EXPIRE', KEYS[1], 86400, 'NX')
+    redis.call('EXPIRE', KEYS[2], 86400, 'NX')
+    return 1
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.pipe = store.redis.pipeline(transaction=True)
+        self._callbacks = [] # (first result, end, callback(results of its commands))
+        self._scripts = [] # (result position, registered script, keys, args)
+
+    def _then(self, start, callback):
+        self._callbacks.append((start, len(self.pipe), callback))
+
+    def _evalsha(self, script, keys, args):
+        self._scripts.append((len(self.pipe), script, keys, args))
+        self.pipe.evalsha(script.sha, len(keys), *keys, *args)
+
+    def _register(self, key):
+        """Add a per-user key (the user's unique_id is its first segment) to the user's registry."""
+        registry = user_keys_key(key.partition(':')[0])
+        self.pipe.sadd(registry, key)
+        self.pipe.expire(registry, USER_KEYS_TTL)
 
-    def _get_date_key(self):
-        return datetime.now().strftime("%Y-%m-%d")
+    def set_prev_rec(self, key, prev_rec):
+        serialized_rec = encode_json(prev_rec)
+        self._register(key)
+        start = len(self.pipe)
+        self.pipe.set(key, serialized_rec, ex=86400, nx=True) # 1 day
+        self.pipe.set(key, serialized_rec, xx=True, keepttl=True) # Updates keep the first write's expiry
+        self.pipe.pttl(key)
+        self._then(start, lambda results: self.store.cache.set(key, prev_rec, len(serialized_rec), ttl=ttl_seconds(results[-1])))
 
-    def _get_random_recs_key(self):
-        return f'random_recs:{self._get_date_key()}'
+    def set_random_recs(self, recommended_songs):
+        if not recommended_songs:
+            return
 
-    def _get_sample_taken_key(self):
-        return f'sample_taken:{self._get_date_key()}'
+        def pushed(results):
+            if not results[0]:
+                print('Sample already taken, no random recs saved')
+        scored = [arg for song in recommended_songs for arg in (repr(random.random()), song)]
+        start = len(self.pipe)
+        self._evalsha(self.store._push_random_recs, self.store._get_random_recs_keys(), [self.store.RANDOM_RECS_SAMPLE, *scored])
+        self._then(start, pushed)
 
-    def set_prev_rec(self, key, prev_rec):
-        start_time = time.time()
-        # data = {'track_ids': track_ids, 'recommended_ids': recommended_songs}
-        self.redis.set(key, json.dumps(prev_rec), ex=86400, nx=True) # 1 day
-        self.redis.set(key, json.dumps(prev_rec), xx=True)
-        self.cache[key] = prev_rec
-        print("Time to set rec ids in redis:", time.time() - start_time)
+    def set_vector(self, key, vector, ttl=3600):
+        if isinstance(vector, (pd.DataFrame, np.ndarray)):
+            serialized_vector = encode_vector(vector)
+            vector = decode_vector(serialized_vector) # Cached as get_data returns it, a float32 view
+        else:
+            serialized_vector = encode_json(vector)
+        self._register(key)
+        start = len(self.pipe)
+        self.pipe.set(key, serialized_vector, ex=ttl)
+        self._then(start, lambda results: self.store.cache.set(key, vector, len(serialized_vector), ttl=ttl))
 
+    def set_user_top_data(self, key, data):
+        serialized_data = encode_json(data)
+        self._register(key)
+        start = len(self.pipe)
+        self.pipe.set(key, serialized_data, ex=86400)
+        self._then(start, lambda results: self.store.cache.set(key, data, len(serialized_data), ttl=86400))
 
-    def set_random_recs(self, recommended_songs):
-        if self.redis.exists(self._get_sample_taken_key()):
-            print('Sample already taken, no random recs saved')
+    def update_total_recs(self, num_recs: int):
+        hourly_key = f'hourly_recs:{datetime.now().strftime("%Y-%m-%d:%H")}'
+        self.pipe.incrby('total_recs', num_recs)
+        self.pipe.incrby(hourly_key, num_recs)
+        self.pipe.expire(hourly_key, 3600, nx=True)
+
+    def execute(self):
+        if not len(self.pipe):
             return
+        start_time = time.time()
+        results = self.pipe.execute(raise_on_error=False)
+        for position, script, keys, args in self._scripts:
+            if isinstance(results[position], redis.exceptions.NoScriptError):
+                results[position] = script(keys=keys, args=args) # Loads the script again
+        self._scripts = []
+        for result in results:
+            if isinstance(result, Exception):
+                self._callbacks = []
+                raise result
+        for start, end, callback in self._callbacks:
+            callback(results[start:end])
+        self._callbacks = []
+        print(f"Time to write {len(results)} commands to redis:", time.time() - start_time)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.execute()
+        else:
+            self.pipe.reset() # Nothing is written when the request failed half way
+            self._callbacks = []
+            self._scripts = []
 
-        pipe = self.redis.pipeline()
-        pipe.rpush(self._get_random_recs_key(), *recommended_songs)
-        pipe.expire(self._get_random_recs_key(), 86400, nx=True) # 1 day
-        pipe.expire(self._get_sample_taken_key(), 86400, nx=True) # 1 day
-        pipe.execute()
 
-    def get_random_recs(self):
-        random_rec_key = self._get_random_recs_key()
-        sample_taken_key = self._get_sample_taken_key()
+class SessionStore:
+    def __init__(self, redis_pool=None, near_cache=None, tracking=NEAR_CACHE_TRACKING):
+        self.redis = redis.Redis(connection_pool=redis_pool or default_redis_pool)
+        self.cache = near_cache if near_cache is not None else NearCache()
+        self.invalidation = RedisInvalidation(self.redis, self.cache) if tracking else None
+        # Registered once, calls send EVALSHA and redis-py loads a script again whenever the server lost it
+        self._push_random_recs = self.redis.register_script(SessionWrites._push_random_recs_script)
+        self._take_random_recs = self.redis.register_script(self._take_random_recs_script)
+        self._publish_playlist_vector = self.redis.register_script(self._publish_playlist_vector_script)
+        self._remove_user_keys = self.redis.register_script(self._remove_user_keys_script)
 
-        list_length = self.redis.llen(random_rec_key)
-        print("List length", list_length)
+    def _get_date_key(self):
+        return datetime.now().strftime("%Y-%m-%d")
 
-        if list_length == 10 and self.redis.exists(sample_taken_key):  
-            print("Returning existing daily sample")
-            return [item.decode('utf-8') for item in self.redis.lrange(random_rec_key, 0, -1)]
+    def _get_random_recs_keys(self):
+        """The day's reservoir (sorted set), count of pushed ids and sample taken from the reservoir (list)."""
+        date_key = self._get_date_key()
+        return f'random_rec_pool:{date_key}', f'random_rec_seen:{date_key}', f'random_rec_sample:{date_key}'
 
+    def writes(self):
+        """A SessionWrites batch: `with session_store.writes() as writes: ...` writes everything in one round trip."""
+        return SessionWrites(self)
 
-        if list_length < 200 and not self.redis.exists(sample_taken_key):
-            print("Not enough items for a sample")
-            return None
+    def set_prev_rec(self, key, prev_rec):
+        with self.writes() as writes:
+            writes.set_prev_rec(key, prev_rec)
 
-        random_indicies = random.sample(range(list_length), 10)
-        pipe = self.redis.pipeline()
-        for index in random_indicies:
-            pipe.lindex(random_rec_key, index)
-        
-        sample = [item.decode('utf-8') for item in pipe.execute() if item is not None]
+    def set_random_recs(self, recommended_songs):
+        with self.writes() as writes:
+            writes.set_random_recs(recommended_songs)
+
+    RANDOM_RECS_SAMPLE = 10 # Ids in the daily showcase
+    RANDOM_RECS_MIN_SEEN = 200 # Ids pushed before the day's sample is taken
+
+    # The first read once enough ids were seen freezes the reservoir as the day's sample, later reads return it
+    _take_random_recs_script = """
+    local sample = redis.call('LRANGE', KEYS[3], 0, -1)
+    if #sample > 0 then
+        return sample
+    end
+    if tonumber(redis.call('GET', KEYS[2]) or '0') < tonumber(ARGV[1]) then
+        return false
+    end
+    sample = redis.call('ZRANGE', KEYS[1], 0, -1)
+    if #sample == 0 then
+        return false
+    end
+    redis.call('RPUSH', KEYS[3], unpack(sample))
+    redis.call('EXPIRE', KEYS[3], 86400)
+    redis.call('DEL', KEYS[1])
+    return sample
+    """
 
+    def get_random_recs(self):
+        sample = self._take_random_recs(keys=self._get_random_recs_keys(), args=[self.RANDOM_RECS_MIN_SEEN])
         if not sample:
-            print("Sample empty")
+            print("Not enough items for a sample")
             return None
-         
-        pipe = self.redis.pipeline()
-        pipe.delete(random_rec_key)
-        pipe.rpush(random_rec_key, *sample)
-        pipe.set(sample_taken_key, 1)
-        pipe.expire(sample_taken_key, 86400) # 1 day
-        pipe.expire(random_rec_key, 86400) # 1 day
-        pipe.execute()
-    
-        print("Sample taken and replaced original data")
-        return sample
+        return [item.decode('utf-8') for item in sample]
 
 
 
@@ -116,29 +238,57 @@ class SessionStore:
         return list(top_3.keys()) 
             
     def set_vector(self, key, vector, ttl=3600):
-        if isinstance(vector, pd.DataFrame):
-            serialized_vector = pickle.dumps(vector)
-        else:
-            serialized_vector = json.dumps(vector)
-        self.redis.set(key, serialized_vector)
-        self.redis.expire(key, ttl)
-        self.cache[key] = vector
+        with self.writes() as writes:
+            writes.set_vector(key, vector, ttl)
+
+    # Playlist vector updates, a Redis stream every worker replays into its PlaylistVectorIndex
+    PLAYLIST_VECTOR_STREAM = 'playlist_vectors:updates'
+    PLAYLIST_VECTOR_SEQ = 'playlist_vectors:seq'
+    PLAYLIST_VECTOR_STREAM_LENGTH = 10000
+
+    # Sequence number and stream entry are written atomically, so readers can tell when entries were trimmed
+    _publish_playlist_vector_script = """
+    local seq = redis.call('INCR', KEYS[2])
+    redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[4], '*', 'seq', seq, 'playlist_id', ARGV[1], 'schema', ARGV[2], 'vector', ARGV[3])
+    return seq
+    """
+
+    def publish_playlist_vector(self, playlist_id, vector):
+        return self._publish_playlist_vector(
+            keys=[self.PLAYLIST_VECTOR_STREAM, self.PLAYLIST_VECTOR_SEQ],
+            args=[playlist_id, SCHEMA_VERSION, to_vector(vector).tobytes(), self.PLAYLIST_VECTOR_STREAM_LENGTH]
+        )
+
+    def get_playlist_vector_watermark(self):
+        """(last stream entry id, last sequence number), read together before loading playlist_vectors from MySQL."""
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.xrevrange(self.PLAYLIST_VECTOR_STREAM, count=1)
+        pipe.get(self.PLAYLIST_VECTOR_SEQ)
+        last_entry, seq = pipe.execute()
+        last_id = last_entry[0][0].decode('utf-8') if last_entry else '0-0'
+        return last_id, int(seq) if seq else 0
+
+    def get_playlist_vector_updates(self, last_id, count=500):
+        """
+        Returns:
+            list: (entry id, sequence number, playlist id, vector or None for another schema) after last_id, oldest first.
+        """
+        updates = []
+        for entry_id, fields in self.redis.xrange(self.PLAYLIST_VECTOR_STREAM, min=f'({last_id}', count=count):
+            vector = None
+            if int(fields[b'schema']) == SCHEMA_VERSION:
+                vector = np.frombuffer(fields[b'vector'], dtype=VECTOR_DTYPE)
+            updates.append((entry_id.decode('utf-8'), int(fields[b'seq']), fields[b'playlist_id'].decode('utf-8'), vector))
+        return updates
 
     def set_user_top_data(self, key, data):
-        self.redis.set(key, json.dumps(data), ex=86400)
-        self.cache[key] = data
+        with self.writes() as writes:
+            writes.set_user_top_data(key, data)
         print("Cache size", len(self.cache))
 
     def update_total_recs(self, num_recs: int):
-        key = 'total_recs'
-        hourly_key = f'hourly_recs:{datetime.now().strftime("%Y-%m-%d:%H")}'
-        print("Hourly key", hourly_key)
-
-        pipeline = self.redis.pipeline()
-        pipeline.incrby(key, num_recs)
-        pipeline.incrby(hourly_key, num_recs)
-        pipeline.expire(hourly_key, 3600, nx=True)
-        pipeline.execute()
+        with self.writes() as writes:
+            writes.update_total_recs(num_recs)
 
     
     def get_total_recs(self):
@@ -154,26 +304,75 @@ class SessionStore:
       
 
     def get_data(self, key): 
-        start_time = time.time()
-        if key in self.cache:
-            print(f'Cache hit time for {key}: {time.time() - start_time}')
-            return self.cache[key]
+        return self.get_many([key])[key]
 
-        print(f'Cache miss for key: {key}')
-        data_str = self.redis.get(key)
+    def get_many(self, keys):
+        """
+        Values of keys, from the near cache or else all read from Redis in one round trip.
 
-        if data_str:
+        Returns:
+            dict: key -> value, None for keys that aren't set.
+        """
+        start_time = time.time()
+        if self.invalidation is not None:
+            self.invalidation.ensure_running()
+        values, missing = {}, []
+        for key in keys:
+            data = self.cache.get(key)
+            if data is MISSING:
+                missing.append(key)
+            else:
+                values[key] = data
+        if values:
+            print(f'Cache hit time for {list(values)}: {time.time() - start_time}')
+        if missing:
+            print(f'Cache miss for keys: {missing}')
+            values.update(self.cache.fill_many(missing, lambda keys: self._load_many(keys, start_time)))
+        return values
+
+    def _load_many(self, keys, start_time):
+        """{key: (data, serialized size, remaining TTL in seconds or None)} of the keys Redis has."""
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.get(key)
+            pipe.pttl(key)
+        results = pipe.execute()
+
+        loaded = {}
+        for key, data_str, ttl_ms in zip(keys, results[::2], results[1::2]):
+            if not data_str:
+                continue
             try:
-                data = pickle.loads(data_str)
-                print(f'Pickle load time for {key}: {time.time() - start_time}')
-            except (pickle.UnpicklingError, EOFError):
-                data = json.loads(data_str)
-                print(f'Json load time for {key}: {time.time() - start_time}')
-
-            self.cache[key] = data
-            return data
-        
-        return None
+                loaded[key] = decode(data_str), len(data_str), ttl_seconds(ttl_ms)
+            except ValueError as e:
+                # Pickled by an older release or another schema, callers rebuild it like an expired key
+                print(f'Undecodable value for {key}, ignored: {e}')
+        print(f'Redis read and decode time for {len(keys)} keys: {time.time() - start_time}')
+        return loaded
+
+    # The registered keys and the registry in one round trip, however many keys the database holds
+    _remove_user_keys_script = """
+    local keys = redis.call('SMEMBERS', KEYS[1])
+    local deleted = 0
+    for i = 1, #keys, 1000 do
+        deleted = deleted + redis.call('DEL', unpack(keys, i, math.min(i + 999, #keys)))
+    end
+    redis.call('DEL', KEYS[1])
+    return deleted
+    """
+
+    # A login's background sync (user_sync.UserSyncWorker), visible to every worker process. The TTL bounds how
+    # long readers wait on a sync whose worker died before clearing it.
+    SYNC_PENDING_TTL = 60
+
+    def set_sync_pending(self, unique_id):
+        self.redis.set(f'{unique_id}:sync_pending', 1, ex=self.SYNC_PENDING_TTL)
+
+    def clear_sync_pending(self, unique_id):
+        self.redis.delete(f'{unique_id}:sync_pending')
+
+    def is_sync_pending(self, unique_id):
+        return bool(self.redis.exists(f'{unique_id}:sync_pending'))
 
     def remove_user_data(self, unique_id):
         if unique_id is None:
@@ -181,31 +380,11 @@ class SessionStore:
             return
         
         print(f'Removing data associated with user: {unique_id}')
-        user_key_pattern = f"{unique_id}:*"
-        cursor = "0"
-        total_deleted = 0
-
-        while cursor != 0:
-            print(f'Starting scan with cursor: {cursor}')
-            cursor, keys = self.redis.scan(cursor=cursor, match=user_key_pattern)
-
-            deleted_count = 0
-            if keys:
-                # Delete from Redis
-                deleted_count = self.redis.delete(*keys)
-                total_deleted += deleted_count
-
-                # Remove from in-memory cache
-                for key in keys:
-                    key_str = key.decode('utf-8')
-                    if key_str in self.cache:
-                        del self.cache[key_str]
-                        print(f'Removed key from cache: {key_str}')
-
-            print(f'Count of keys deleted: {deleted_count}')
+        total_deleted = self._remove_user_keys(keys=[user_keys_key(unique_id)])
+        removed_from_cache = self.cache.delete_prefix(f'{unique_id}:')
 
         print(f'Total count of keys deleted: {total_deleted}')
-        print(f'Cache size after clearing: {len(self.cache)}')
+        print(f'Removed {removed_from_cache} keys from cache, cache size after clearing: {len(self.cache)}')
 
     def clear_all(self):
         self.cache.clear()
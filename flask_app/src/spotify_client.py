@@ -6,18 +6,23 @@ import requests
 from spotipy.oauth2 import SpotifyClientCredentials
 from spotipy.oauth2 import SpotifyOAuth
 from spotipy.client import SpotifyException
+import functools
 import warnings
 import random
 import time
+from feature_schema import TRACK_COLUMNS
+from spotify_fetch import SpotifyFetcher
 
 warnings.filterwarnings("ignore")
 
 
 
 class SpotifyClient:
-    def __init__(self, sp):
+    def __init__(self, sp, track_cache=None):
 
         self.sp = sp
+        self.fetcher = SpotifyFetcher(sp)
+        self.track_cache = track_cache
 
     # def __init__(self, client_id, client_secret, redirect_uri, user_id, scope):
     #     self.client_id = client_id
@@ -34,41 +39,41 @@ class SpotifyClient:
     #     self.sp = spotipy.Spotify(auth_manager=auth_manager)
 
     def get_user_saved_info(self):
-        user_profile = self.sp.current_user()
-
-
-        all_playlists = []
-
-        user_playlists = self.sp.current_user_playlists() 
+        """
+        Profile, every saved playlist, top artists and top tracks of the current user.
 
-        while user_playlists:
-            all_playlists.extend(user_playlists['items'])
-            if user_playlists['next']:
-                user_playlists = self.sp.next(user_playlists)
-            else:
-                user_playlists = None
-
-        unique_id = user_profile['id']
-        if unique_id == "31bv2bralifp3lgy4p5zvikjghki":
-            return user_profile, all_playlists, None, None
-
-        # recently_played = self.sp.current_user_recently_played()
-        top_artists_short = self.sp.current_user_top_artists(20,0, 'short_term')
-        # top_artists_med = self.sp.current_user_top_artists(20,0, 'medium_term')
-        # top_artists_long = self.sp.current_user_top_artists(20,0, 'long_term')
-        top_artists = {
-            'short_term': top_artists_short,
-            # 'medium_term': top_artists_med,
-            # 'long_term': top_artists_long
-        }
-        top_tracks_short = self.sp.current_user_top_tracks(20,0, 'short_term')
-        # top_tracks_med = self.sp.current_user_top_tracks(20,0, 'medium_term')
-        # top_tracks_long = self.sp.current_user_top_tracks(20,0, 'long_term')
-        top_tracks = {
-            'short_term': top_tracks_short,
-            # 'medium_term': top_tracks_med,
-            # 'long_term': top_tracks_long
-        }
+        The calls don't depend on each other and go out together; playlist pages after the first are requested
+        together as soon as the first page gives the total.
+        """
+        fetch = self.fetcher
+        with fetch.executor() as executor:
+            user_profile = executor.submit(fetch.call, self.sp.current_user)
+            first_playlists = executor.submit(fetch.call, self.sp.current_user_playlists, 50, 0)
+            # recently_played = self.sp.current_user_recently_played()
+            top_artists_short = executor.submit(fetch.call, self.sp.current_user_top_artists, 20, 0, 'short_term')
+            # top_artists_med = self.sp.current_user_top_artists(20,0, 'medium_term')
+            # top_artists_long = self.sp.current_user_top_artists(20,0, 'long_term')
+            top_tracks_short = executor.submit(fetch.call, self.sp.current_user_top_tracks, 20, 0, 'short_term')
+            # top_tracks_med = self.sp.current_user_top_tracks(20,0, 'medium_term')
+            # top_tracks_long = self.sp.current_user_top_tracks(20,0, 'long_term')
+
+            all_playlists = fetch.paged(executor, first_playlists, self.sp.current_user_playlists)
+            user_profile = user_profile.result()
+
+            unique_id = user_profile['id']
+            if unique_id == "31bv2bralifp3lgy4p5zvikjghki":
+                return user_profile, all_playlists, None, None
+
+            top_artists = {
+                'short_term': top_artists_short.result(),
+                # 'medium_term': top_artists_med,
+                # 'long_term': top_artists_long
+            }
+            top_tracks = {
+                'short_term': top_tracks_short.result(),
+                # 'medium_term': top_tracks_med,
+                # 'long_term': top_tracks_long
+            }
         return user_profile, all_playlists, top_artists, top_tracks
     
     
@@ -97,84 +102,95 @@ class SpotifyClient:
         - playlist_with_features (pd.DataFrame): A DataFrame containing the playlist tracks and their audio features.
         """
         print("-> sp:analyze_playlist()")
-        if isinstance(input_data, dict):
-            start_time = time.time()
-            # Input is a playlist ID
-            playlist_id = input_data
-            
-            # Retrieve the tracks from the playlist
-            playlist = input_data
-            playlist_data = []
-            playlist_tracks = playlist['tracks']
-
-            while playlist_tracks:
-                playlist_data.extend([
-                    {
-                        'artist': track_item['track']['artists'][0]['name'],
-                        'name': track_item['track']['name'],
-                        'id': track_item['track']['id'],
-                        'date_added': track_item['added_at'],
-                        'popularity': track_item['track']['popularity'],
-                        'explicit': track_item['track']['explicit']
-                    }
-                    for track_item in playlist_tracks['items']
-                    if track_item['track'] and track_item['track']['id'] and track_item['track']['type'] == 'track'
-                ])
-                if playlist_tracks['next']:
-                    playlist_tracks = self.sp.next(playlist_tracks)
-                else:
-                    playlist_tracks = None
-
-            # Create a DataFrame from the playlist data
-            playlist = pd.DataFrame(playlist_data)
-            playlist['date_added'] = pd.to_datetime(playlist['date_added'])
-            playlist = playlist.sort_values('date_added', ascending=False)
-            playlist = playlist.drop_duplicates(subset='id')
-
-            # Retrieve the track IDs from the playlist
-            track_ids = playlist['id'].tolist()
-            print("Playlist tracks received and organized in {:.2f} seconds.".format(time.time() - start_time))
-            
-        elif isinstance(input_data, list):
-            # Input is a list of track IDs
-            track_ids = input_data
-            
-            # Retrieve track information for the given track IDs
-            tracks_info = self.sp.tracks(track_ids)['tracks']
-            
-            # Create a DataFrame from the track information
-            playlist = pd.DataFrame([{
-                'artist': track['artists'][0]['name'],
-                'name': track['name'],
-                'id': track['id'],
-                'popularity': track['popularity'],
-                'explicit': track['explicit']
-            } for track in tracks_info])
-        
-        else:
-            raise ValueError("Invalid input type. Expected a playlist ID or a list of track IDs.")
-        
-        if type_analyze == 'rec':
-            return track_ids
-        
-        # Handle Pagination
-        def chunks(lst, n):
-            for i in range(0, len(lst), n):
-                yield lst[i:i + n]
-        
-        audio_features_list = []
-        for chunk in chunks(track_ids, 100):
-            audio_features_list.extend(self.sp.audio_features(chunk))
+        fetch = self.fetcher
+        feature_requests = []
+        cached_features = []
+        selected_columns = ['id', 'danceability', 'energy', 'key', 'loudness', 'mode', 'speechiness', 'acousticness', 'instrumentalness', 'liveness', 'valence', 'tempo', 'duration_ms', 'time_signature']
+
+        with fetch.executor() as executor:
+            def request_audio_features(track_ids):
+                # Cached tracks first, the misses in requests of up to 100 ids. Called for each page as it comes
+                # in; paged keeps a thread free and submits the next page after this, so these requests run
+                # alongside the page requests still in flight instead of waiting for the last page
+                if type_analyze == 'rec':
+                    return
+                if self.track_cache is not None:
+                    cached = self.track_cache.get_features(track_ids)
+                    cached_features.extend(cached.values())
+                    track_ids = [track_id for track_id in track_ids if track_id not in cached]
+                for start in range(0, len(track_ids), 100):
+                    feature_requests.append(executor.submit(self.fetch_audio_features, track_ids[start:start + 100]))
+
+            if isinstance(input_data, dict):
+                start_time = time.time()
+                # Input is a playlist
+                playlist = input_data
+
+                # Tracks are collected column by column, pages fetched concurrently from tracks.total
+                columns = {'artist': [], 'name': [], 'id': [], 'date_added': [], 'popularity': [], 'explicit': []}
+                requested_ids = set()
+
+                def add_page(items):
+                    new_ids = []
+                    for track_item in items:
+                        track = track_item['track']
+                        if not (track and track['id'] and track['type'] == 'track'):
+                            continue
+                        columns['artist'].append(track['artists'][0]['name'])
+                        columns['name'].append(track['name'])
+                        columns['id'].append(track['id'])
+                        columns['date_added'].append(track_item['added_at'])
+                        columns['popularity'].append(track['popularity'])
+                        columns['explicit'].append(track['explicit'])
+                        if track['id'] not in requested_ids:
+                            requested_ids.add(track['id'])
+                            new_ids.append(track['id'])
+                    request_audio_features(new_ids)
+
+                fetch.paged(executor, playlist['tracks'],
+                            functools.partial(self.sp.playlist_items, playlist['id'], additional_types=('track',)),
+                            on_page=add_page)
+
+                # Create a DataFrame from the playlist data
+                playlist = pd.DataFrame(columns)
+                playlist['date_added'] = pd.to_datetime(playlist['date_added'])
+                playlist = playlist.sort_values('date_added', ascending=False)
+                playlist = playlist.drop_duplicates(subset='id')
+
+                # Retrieve the track IDs from the playlist
+                track_ids = playlist['id'].tolist()
+                print("Playlist tracks received and organized in {:.2f} seconds.".format(time.time() - start_time))
+
+            elif isinstance(input_data, list):
+                # Input is a list of track IDs
+                track_ids = input_data
+                request_audio_features(track_ids)
+
+                # Retrieve track information for the given track IDs
+                tracks_info = fetch.call(self.sp.tracks, track_ids)['tracks']
+
+                # Create a DataFrame from the track information
+                playlist = pd.DataFrame({
+                    'artist': [track['artists'][0]['name'] for track in tracks_info],
+                    'name': [track['name'] for track in tracks_info],
+                    'id': [track['id'] for track in tracks_info],
+                    'popularity': [track['popularity'] for track in tracks_info],
+                    'explicit': [track['explicit'] for track in tracks_info],
+                })
 
-        # Filter out None entries 
-        audio_features_list = [features for features in audio_features_list if features is not None]
+            else:
+                raise ValueError("Invalid input type. Expected a playlist ID or a list of track IDs.")
 
+            if type_analyze == 'rec':
+                return track_ids
 
-        audio_features_df = pd.DataFrame(audio_features_list) # Consider filling none with 0
+            # Filter out None entries
+            audio_features_list = cached_features + [features for request in feature_requests for features in request.result() if features is not None]
 
         # Select specific columns for the audio features DataFrame
-        selected_columns = ['id', 'danceability', 'energy', 'key', 'loudness', 'mode', 'speechiness', 'acousticness', 'instrumentalness', 'liveness', 'valence', 'tempo', 'duration_ms', 'time_signature']
-        audio_features_df = audio_features_df[selected_columns]
+        audio_features_df = pd.DataFrame({
+            column: [features.get(column) for features in audio_features_list] for column in selected_columns
+        }) # Consider filling none with 0
 
         # Merge the playlist DataFrame with the audio features DataFrame
         playlist_with_features = pd.merge(playlist, audio_features_df, on='id', how='inner')
@@ -187,6 +203,20 @@ class SpotifyClient:
 
         return playlist_with_features
     
+    def fetch_audio_features(self, track_ids):
+        """
+        Audio features of up to 100 tracks from the Spotify API, saved to the track cache.
+
+        Returns:
+            list: One features dict per id, None for tracks Spotify has no features for.
+        """
+        start_time = time.perf_counter()
+        audio_features_list = self.fetcher.call(self.sp.audio_features, track_ids)
+        if self.track_cache is not None:
+            self.track_cache.record_api(len(track_ids), (time.perf_counter() - start_time) * 1000)
+            self.track_cache.put_features([features for features in audio_features_list if features is not None])
+        return audio_features_list
+
     def track_base_features(self, track, track_id):
         """
         Retrieves the audio features of a list of track IDs from Spotify API.
@@ -203,7 +233,8 @@ class SpotifyClient:
         #     return
      
         # Retrieve audio features for the track IDs
-        audio_features_list = self.sp.audio_features(track_id)
+        cached = self.track_cache.get_features([track_id]) if self.track_cache is not None else {}
+        audio_features_list = list(cached.values()) or self.fetch_audio_features([track_id])
 
         # Convert the list of audio features into a DataFrame
         audio_features_df = pd.DataFrame(audio_features_list)
@@ -265,18 +296,8 @@ class SpotifyClient:
         Returns:
             pandas.DataFrame: The rearranged DataFrame.
         """
-        # Define the desired order of columns
-        columns_order = ['artist', 'name', 'id', 'date_added', 'popularity', 'duration_ms', 'danceability', 'energy', 'key', 
-                         'loudness', 'mode', 'speechiness', 'acousticness', 'instrumentalness', 
-                         'liveness', 'valence', 'tempo', 'time_signature']
-
-        # Add missing columns with default value 0
-        for column in columns_order:
-            if column not in df.columns:
-                df[column] = 0
-
-        # Reorder the columns
-        df = df[columns_order]
+        # Missing columns default to 0, order is fixed by the feature schema
+        df = df.reindex(columns=TRACK_COLUMNS, fill_value=0)
 
         return df
 
@@ -331,14 +352,22 @@ class SpotifyClient:
         
         data_df[columns_to_scale] = scaler.transform(data_df[columns_to_scale])
             
-        # Predict the genre labels using the model
-        predictions_encoded = model.predict(data_df)
-        
-        # Decode the predicted labels using the label encoder
-        predictions_decoded = label_encoder.inverse_transform(predictions_encoded)
-        
-        # Add the predicted genre labels to the data DataFrame
-        data['track_genre'] = predictions_decoded
+        # Genres predicted before (by this model) come from the track cache, the model only predicts the rest
+        cached_genres = self.track_cache.get_genres(data['id'].tolist()) if self.track_cache is not None else {}
+        to_predict = ~data['id'].isin(cached_genres.keys()).to_numpy()
+        data['track_genre'] = data['id'].map(cached_genres).astype(object)
+
+        if to_predict.any():
+            # Predict the genre labels using the model
+            predictions_encoded = model.predict(data_df[to_predict])
+
+            # Decode the predicted labels using the label encoder
+            predictions_decoded = label_encoder.inverse_transform(predictions_encoded)
+
+            # Add the predicted genre labels to the data DataFrame
+            data.loc[to_predict, 'track_genre'] = predictions_decoded
+            if self.track_cache is not None:
+                self.track_cache.put_genres(zip(data['id'][to_predict], predictions_decoded))
 
         if (choice == 'track'):
             # data['release_date'] = release_date
@@ -0,0 +1,167 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from spotipy.client import SpotifyException
+
+MAX_WORKERS = int(os.getenv('SPOTIFY_CONCURRENCY', 8)) # Concurrent Spotify requests per fetch
+MAX_ATTEMPTS = int(os.getenv('SPOTIFY_MAX_ATTEMPTS', 4)) # Per call, rate limited and transient failures included
+MAX_RETRY_AFTER = 30 # Seconds, a longer Retry-After fails the call instead of stalling the request
+
+# Dropped / refused connections and timeouts, spotipy lets them through as they are (5xx are retried by spotipy)
+TRANSIENT_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+
+class RateLimitGate:
+    """
+    Rate limit state shared by every Spotify call of the process.
+
+    Spotify rate limits the app, not a request: once any call gets a 429, every other call made before its
+    Retry-After has passed would be limited too. The first 429 closes the gate for Retry-After seconds and
+    calls from every thread wait at the gate, rather than each thread finding out and sleeping on its own.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._open_at = 0.0
+        self.metrics = {
+            'calls': 0,
+            'rate_limited': 0,
+            'gate_waits': 0,
+            'total_wait_ms': 0.0,
+        }
+
+    def wait(self):
+        while True:
+            with self._lock:
+                delay = self._open_at - time.monotonic()
+            if delay <= 0:
+                self.metrics['calls'] += 1
+                return
+            self.metrics['gate_waits'] += 1
+            self.metrics['total_wait_ms'] += delay * 1000
+            time.sleep(delay)
+
+    def close_for(self, seconds):
+        with self._lock:
+            self._open_at = max(self._open_at, time.monotonic() + seconds)
+            self.metrics['rate_limited'] += 1
+
+    def stats(self):
+        return {**self.metrics, 'closed_for_s': max(self._open_at - time.monotonic(), 0.0)}
+
+
+RATE_LIMIT = RateLimitGate()
+
+
+def retry_after(error, default=1):
+    """Seconds a 429 asks to wait (Retry-After header), default when it doesn't say."""
+    headers = getattr(error, 'headers', None) or {}
+    try:
+        return max(float(headers.get('Retry-After', default)), 0)
+    except (TypeError, ValueError):
+        return default
+
+
+class SpotifyFetcher:
+    """
+    Concurrent Spotify calls for one SpotifyClient: a bounded thread pool per fetch and the shared rate limit gate.
+
+    spotipy retries 429s itself, sleeping in whichever thread got one. The fetcher takes 429s out of spotipy's
+    retried statuses (5xx stay with spotipy) so that they come back here and close the gate for every thread.
+    """
+
+    def __init__(self, sp, max_workers=MAX_WORKERS, gate=RATE_LIMIT, max_attempts=MAX_ATTEMPTS, base_delay=0.2, max_delay=2.0):
+        """
+        Args:
+            max_workers (int): Concurrency cap, requests in flight per fetch.
+            gate (RateLimitGate): Rate limit state, the process-wide one unless testing.
+            max_attempts (int): Attempts per call before its error is raised.
+            base_delay (float), max_delay (float): Backoff before retry n of a transient error is uniform in
+                [0, min(max_delay, base_delay * 2**n)].
+        """
+        self.sp = sp
+        self.max_workers = max_workers
+        self.gate = gate
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        session = getattr(sp, '_session', None)
+        if isinstance(session, requests.Session):
+            for adapter in session.adapters.values():
+                retry = adapter.max_retries
+                # urllib3 retries any response with a Retry-After header unless told not to
+                adapter.max_retries = retry.new(
+                    status_forcelist={status for status in retry.status_forcelist or () if status != 429},
+                    respect_retry_after_header=False,
+                )
+
+    def call(self, func, *args, **kwargs):
+        """
+        func(*args, **kwargs) through the gate, retried after Retry-After on a 429 and with jittered backoff on
+        a transient error.
+
+        Raises:
+            SpotifyException: Any other error, a 429 on the last attempt or one asking to wait over MAX_RETRY_AFTER.
+            requests.exceptions.RequestException: A transient error on the last attempt.
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            self.gate.wait()
+            try:
+                return func(*args, **kwargs)
+            except TRANSIENT_ERRORS as e:
+                if attempt == self.max_attempts:
+                    raise
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                print(f"Transient Spotify error, retrying in {delay:.2f} s: {e}")
+                time.sleep(delay)
+            except SpotifyException as e:
+                if e.http_status != 429 or attempt == self.max_attempts:
+                    raise
+                seconds = retry_after(e)
+                if seconds > MAX_RETRY_AFTER:
+                    raise
+                print(f"Spotify rate limit, retrying in {seconds:.1f} s")
+                self.gate.close_for(seconds)
+
+    def executor(self):
+        return ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='spotify')
+
+    def paged(self, executor, first, fetch_page, on_page=None):
+        """
+        Items of every page of a paging object, in order. The remaining pages are requested concurrently once
+        the first page told the total. With on_page, at most max_workers - 1 page requests are in flight and the
+        next one is submitted after each on_page, so the requests on_page submits to the same executor start
+        ahead of the pages still to come, rather than queueing behind all of them.
+
+        Args:
+            executor (ThreadPoolExecutor): Runs the page requests.
+            first (Future or dict): First page (offset 0).
+            fetch_page (callable): fetch_page(limit=..., offset=...) -> page, e.g. sp.current_user_playlists.
+            on_page (callable, optional): Called with each page's items, in order, as soon as they are in (to
+                start dependent requests while later pages are still loading).
+        """
+        first = first.result() if hasattr(first, 'result') else first
+        limit = first['limit']
+        offsets = deque(range(first['offset'] + limit, first['total'], limit) if first['next'] and limit else [])
+        window = max(self.max_workers - 1, 1) if on_page is not None else len(offsets)
+        pages = deque()
+
+        def submit_pages():
+            while offsets and len(pages) < window:
+                pages.append(executor.submit(self.call, fetch_page, limit=limit, offset=offsets.popleft()))
+
+        items = list(first['items'])
+        if on_page is not None:
+            on_page(first['items'])
+        submit_pages()
+        while pages:
+            page_items = pages.popleft().result()['items']
+            items.extend(page_items)
+            if on_page is not None:
+                on_page(page_items)
+            submit_pages()
+        return items
@@ -2,13 +2,88 @@ import os
 from dotenv import load_dotenv
 import mysql.connector.pooling
 import pandas as pd
+import numpy as np
 import json
 import time
 import mysql.connector
 from contextlib import contextmanager   
+from feature_schema import SQL_COLUMNS, NUM_FEATURES, VECTOR_DTYPE, to_vector
+from feature_store import DATASET_COLUMNS, DATASET_DTYPES
+from db_pool import ConnectionManager
 
 load_dotenv()
 
+FETCH_CHUNK_SIZE = 10000 # Rows per fetchmany in columnar fetches
+APPEND_BATCH_SIZE = 1000 # Rows per multi-row INSERT into append_data, well below max_allowed_packet
+QUOTED_COLUMNS = [f'`{column}`' for column in DATASET_COLUMNS] # key and mode are reserved words
+
+
+def append_rows(data, columns=DATASET_COLUMNS):
+    """
+    Rows of data as tuples of plain Python values, built from whole columns instead of data.iterrows().
+    NaN becomes None (NULL) and repeated track ids are dropped, keeping their first row.
+    """
+    data = data.drop_duplicates('track_id')
+    values = []
+    for column in columns:
+        array = data[column].to_numpy(dtype=object) # numpy scalars -> Python, which mysql-connector can convert
+        array[pd.isna(array)] = None
+        values.append(array)
+    return list(zip(*values))
+
+
+def read_columnar(cursor, dtypes=DATASET_DTYPES, chunk_size=FETCH_CHUNK_SIZE):
+    """
+    Stream an executed query's rows from a tuple cursor into typed column arrays, fetchmany chunk by chunk.
+
+    Numeric columns fill preallocated arrays of their dtype (grown by doubling), 'category' columns are
+    factorized per chunk into int32 codes, so no per-row dict or object column of numbers is ever built.
+    NULL is NaN in float columns and 0 in integer columns.
+
+    Args:
+        cursor: Non-dictionary cursor with an executed SELECT.
+        dtypes (dict): Column name -> numpy dtype, object or 'category', for every selected column.
+        chunk_size (int): Rows per fetchmany.
+    Returns:
+        pandas.DataFrame: One typed column per selected column, in select order.
+    """
+    names = [column[0] for column in cursor.description]
+    arrays = {name: np.empty(chunk_size, dtype=np.int32 if dtypes[name] == 'category' else dtypes[name]) for name in names}
+    categories = {name: {} for name in names if dtypes[name] == 'category'}
+    num_rows = 0
+
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        end = num_rows + len(rows)
+        if end > len(arrays[names[0]]):
+            capacity = max(end, 2 * len(arrays[names[0]]))
+            for name, array in arrays.items():
+                arrays[name] = np.empty(capacity, dtype=array.dtype)
+                arrays[name][:num_rows] = array[:num_rows]
+
+        for name, values in zip(names, zip(*rows)):
+            if name in categories:
+                codes, uniques = pd.factorize(np.array(values, dtype=object), sort=False)
+                lookup = categories[name]
+                chunk_codes = np.array([lookup.setdefault(value, len(lookup)) for value in uniques], dtype=np.int32)
+                arrays[name][num_rows:end] = np.where(codes >= 0, chunk_codes[codes], -1) if len(uniques) else -1
+            elif np.issubdtype(arrays[name].dtype, np.integer) and None in values:
+                arrays[name][num_rows:end] = [0 if value is None else value for value in values]
+            else:
+                arrays[name][num_rows:end] = values
+        num_rows = end
+
+    data = {}
+    for name in names:
+        if name in categories:
+            data[name] = pd.Categorical.from_codes(arrays[name][:num_rows], categories=list(categories[name]))
+        else:
+            data[name] = arrays[name][:num_rows]
+    return pd.DataFrame(data, columns=names)
+
+
 class SQLWork:
     def __init__(self):
         self.MYSQL_HOST = os.environ.get('MYSQL_HOST')
@@ -19,23 +94,24 @@ class SQLWork:
         self.MYSQL_PASSWORD = os.environ.get("MYSQL_PASSWORD")
         self.MYSQL_DATABASE = os.environ.get("MYSQL_DATABASE")
         print(self.MYSQL_DATABASE)
-        try:
-            self.pool =  mysql.connector.pooling.MySQLConnectionPool(
-                host=self.MYSQL_HOST,
-                port=self.MYSQL_PORT,
-                user=self.MYSQL_USER,
-                passwd=self.MYSQL_PASSWORD,
-                database=self.MYSQL_DATABASE,
-                pool_name="pool",
-                pool_size=5,
-            )
-        except mysql.connector.Error as e:
-            print(f"Error connecting to MySQL: {e}")
-        
+
+        # Sized from gunicorn.conf.py and connected lazily in each worker, see db_pool
+        self.pool = ConnectionManager(
+            pool_size=int(os.environ['MYSQL_POOL_SIZE']) if os.environ.get('MYSQL_POOL_SIZE') else None,
+            checkout_timeout=float(os.environ['MYSQL_CHECKOUT_TIMEOUT']) if os.environ.get('MYSQL_CHECKOUT_TIMEOUT') else None,
+            host=self.MYSQL_HOST,
+            port=self.MYSQL_PORT,
+            user=self.MYSQL_USER,
+            passwd=self.MYSQL_PASSWORD,
+            database=self.MYSQL_DATABASE,
+            connection_timeout=int(os.environ.get('MYSQL_CONNECT_TIMEOUT', 5)),
+        )
+        print(f"MySQL pool size {self.pool.pool_size}, retry deadline {self.pool.deadline:.1f} s")
+
     @contextmanager
-    def get_cursor(self):
+    def get_cursor(self, dictionary=True):
         connection = self.pool.get_connection()
-        cursor = connection.cursor(dictionary=True)
+        cursor = connection.cursor(dictionary=dictionary)
         try:
             yield cursor
             connection.commit()
@@ -48,60 +124,74 @@ class SQLWork:
 
 
 
-    def get_dataset(self, top_genres, user_top_artists=None, track=False, artist_rec=False):
+    def get_dataset(self, top_genres, user_top_artists=None, track=False, artist_rec=False, columnar=False):
+        """
+        Args:
+            columnar (bool): Select only the rec_dataset columns on a tuple cursor and stream them into typed
+                arrays (see read_columnar) instead of building a DataFrame from one dict per row.
+        """
         print("-> get_dataset()")
-        retries = 5 
-        while retries > 0:
-            try: 
-                with self.get_cursor() as cursor:
-                    if track == False:
-                        if artist_rec == False:
-                            print(top_genres)
-                            print([artist['artist_name'] for artist in user_top_artists])
-                            query = """
-                            SELECT * FROM rec_dataset WHERE artists IN ({}) OR track_genre IN ({})
-                            """.format(
-                                ','.join(['%s'] * len([artist['artist_name'] for artist in user_top_artists])),
-                                ','.join(['%s'] * len(top_genres))
-                            )
-                            # Flatten list of genre and artiist names to use as parameters
-                            params = [artist['artist_name'] for artist in user_top_artists] + top_genres
-                        else:
-                            query = """SELECT * FROM rec_dataset 
-                            WHERE artists IN ({}) AND track_genre NOT IN ({})
-                            """.format(
-                                ','.join(['%s'] * len(user_top_artists)),
-                                ','.join(['%s'] * len(top_genres))
-                            )
-                            params = user_top_artists + top_genres
-                    else:
-                        print("track = True")
-                        query = """SELECT * FROM rec_dataset WHERE track_genre = %s"""
-                        params = [top_genres]
-
-                    cursor.execute(query, params)
-                    rec_dataset = pd.DataFrame(cursor.fetchall())
-                    if 'id' in rec_dataset.columns:
-                        rec_dataset = rec_dataset.drop('id', axis=1)
-                    return rec_dataset
-            except mysql.connector.Error as e:
-                print(f"Error getting dataset from database: {e}")
-                retries -= 1
-                print(f"Retries left: {retries}")
-                time.sleep(5)
-            except Exception as e:
-                print(f"Unexpected error: {e}")
-                retries -= 1
-                print(f"Retries left: {retries}")
-                time.sleep(5)
+        # Columnar mode skips the id column and names the columns it needs
+        select = ', '.join(f'`{column}`' for column in DATASET_COLUMNS) if columnar else '*'
+        if track == False:
+            if artist_rec == False:
+                print(top_genres)
+                print([artist['artist_name'] for artist in user_top_artists])
+                query = """
+                SELECT {} FROM rec_dataset WHERE artists IN ({}) OR track_genre IN ({})
+                """.format(
+                    select,
+                    ','.join(['%s'] * len([artist['artist_name'] for artist in user_top_artists])),
+                    ','.join(['%s'] * len(top_genres))
+                )
+                # Flatten list of genre and artiist names to use as parameters
+                params = [artist['artist_name'] for artist in user_top_artists] + top_genres
+            else:
+                query = """SELECT {} FROM rec_dataset 
+                WHERE artists IN ({}) AND track_genre NOT IN ({})
+                """.format(
+                    select,
+                    ','.join(['%s'] * len(user_top_artists)),
+                    ','.join(['%s'] * len(top_genres))
+                )
+                params = user_top_artists + top_genres
+        else:
+            print("track = True")
+            query = """SELECT {} FROM rec_dataset WHERE track_genre = %s""".format(select)
+            params = [top_genres]
+
+        def fetch():
+            connection = self.pool.get_connection()
+            cursor = connection.cursor(dictionary=not columnar)
+            try:
+                cursor.execute(query, params)
+                if columnar:
+                    return read_columnar(cursor)
+                rec_dataset = pd.DataFrame(cursor.fetchall())
+                if 'id' in rec_dataset.columns:
+                    rec_dataset = rec_dataset.drop('id', axis=1)
+                return rec_dataset
             finally:
-                if 'connection' in locals() and connection.is_connected():
-                    connection.close()
-                    print("Connection closed.")
-        print("Failed to get dataset after multiple retries.")
-        return None
+                cursor.close()
+                connection.close()
+
+        try:
+            # Transient errors are retried with jittered backoff, never past the pool's deadline
+            return self.pool.run(fetch)
+        except mysql.connector.Error as e:
+            print(f"Error getting dataset from database: {e}")
+            return None
+
+    def get_rec_dataset(self):
+        """Full rec_dataset for the resident feature store, pulled once at startup as typed columns."""
+        print("-> get_rec_dataset()")
+        with self.get_cursor(dictionary=False) as cursor:
+            cursor.execute("SELECT {} FROM rec_dataset".format(', '.join(f'`{column}`' for column in DATASET_COLUMNS)))
+            rec_dataset = read_columnar(cursor)
+            print(f"rec_dataset rows: {len(rec_dataset)}")
+            return rec_dataset
+
 
-           
     # def get_dataset(self):
     #     print("-> get_dataset()")
     #     retries = 5 
@@ -129,8 +219,14 @@ class SQLWork:
     #     print("Failed to get dataset after multiple retries.")
     #     return None
         
-    def get_user_data(self, sp):
-        
+    def get_user_data(self, sp, sync_worker=None):
+        """
+        Fetch the user's profile, playlists and top items from Spotify and save them (sync_user_data).
+
+        Args:
+            sync_worker (UserSyncWorker, optional): Save in the background instead, returning as soon as
+                Spotify answered.
+        """
         start_time = time.time()
 
         user_profile, user_playlists, top_artists, top_tracks = sp.get_user_saved_info()
@@ -146,144 +242,115 @@ class SQLWork:
         if unique_id == "31bv2bralifp3lgy4p5zvikjghki" :
             return unique_id, display_name
 
-        start_time = time.time()
-        self.user_profile_db(unique_id, display_name, email)
-
-        print("Saving user profile to database... :", time.time() - start_time, "s")
-        
-
-        # self.user_recently_played_db(unique_id, recently_played)
-
- 
-
-        start_time = time.time()
-
-        self.user_playlists_db(unique_id, user_playlists)
-        print("Saving user playlists to database...", time.time() - start_time, "s")
-        start_time = time.time()
-        
-        self.user_top_artists_db(unique_id, top_artists)
-
-        print("Saving user top artists to database... :", time.time() - start_time, "s")
+        if sync_worker is not None:
+            sync_worker.submit(unique_id, display_name, email, user_playlists, top_artists, top_tracks)
+            print("User data queued for saving")
+            return unique_id, display_name
 
         start_time = time.time()
-
-        self.user_top_tracks_db(unique_id, top_tracks)
-
-        print("Saving user top tracks to database... :", time.time() - start_time, "s")
-
-        print("User data saved to database")
+        self.sync_user_data(unique_id, display_name, email, user_playlists, top_artists, top_tracks)
+        print("Saving user data to database... :", time.time() - start_time, "s")
 
         return unique_id, display_name
 
+    def sync_user_data(self, unique_id, display_name, email, user_playlists, top_artists, top_tracks):
+        """
+        Save a user's profile, playlists, top artists and top tracks in one transaction on one connection.
 
-
-    # Helpers        
-    def user_profile_db(self, unique_id, display_name, email):
-
-        print("-> user_profile_db()")
-
-        connection = self.pool.get_connection()
-        try:
+        Every table is written set-based, without reading it first: one insert-if-missing for the profile, one
+        multi-row upsert per list and one delete of whatever the list no longer contains. A failed attempt rolls
+        back as a whole and transient errors retry the whole transaction (see ConnectionManager.run), which is
+        safe since every statement is idempotent.
+        """
+        playlists = [
+            (playlist['id'], playlist['name'], playlist['images'][0]['url'] if playlist['images'] else None,
+             playlist['owner']['id'], unique_id)
+            for playlist in user_playlists
+        ]
+        artists = [
+            (unique_id, artist['id'], artist['name'], rank if time_range == 'short_term' else None)
+            for time_range, items in top_artists.items()
+            for rank, artist in enumerate(items['items'], start=1)
+        ]
+        tracks = [
+            (unique_id, track['id'], track['name'], track['artists'][0]['name'], rank if time_range == 'short_term' else None)
+            for time_range, items in top_tracks.items()
+            for rank, track in enumerate(items['items'], start=1)
+        ]
+
+        def delete_missing(cursor, table, key, keep):
+            query = f"DELETE FROM {table} WHERE unique_id = %s"
+            if keep:
+                query += f" AND {key} NOT IN ({', '.join(['%s'] * len(keep))})"
+            cursor.execute(query, [unique_id] + list(keep))
+            return cursor.rowcount
+
+        def sync():
+            connection = self.pool.get_connection()
             cursor = connection.cursor()
-            query = "SELECT * FROM users WHERE unique_id = %s"
-            cursor.execute(query, (unique_id,))
-            result = cursor.fetchone()
-            print("User exists")
-            if not result:
-                print('User does not exist')
-                insert_query = "INSERT INTO users (unique_id, display_name, email) VALUES (%s, %s, %s)"
-                cursor.execute(insert_query, (unique_id, display_name, email))
-                cursor.close()
-                print('User database authenticated')
-            
-            connection.commit()
-        except mysql.connector.Error as e:
-            print(f"Error adding/checking user in database: {e}")
-        finally:
-            print('<- user_profile_db()')
-            cursor.close()
-            connection.close()
+            try:
+                cursor.execute("""
+                    INSERT INTO users (unique_id, display_name, email)
+                    SELECT %s, %s, %s FROM DUAL
+                    WHERE NOT EXISTS (SELECT 1 FROM users WHERE unique_id = %s)
+                """, (unique_id, display_name, email, unique_id))
+
+                if playlists:
+                    cursor.executemany("""
+                        INSERT INTO playlists (playlist_id, name, image_url, owner_id, unique_id)
+                        VALUES (%s, %s, %s, %s, %s)
+                        ON DUPLICATE KEY UPDATE
+                            name = VALUES(name),
+                            image_url = VALUES(image_url),
+                            owner_id = VALUES(owner_id)
+                    """, playlists)
+                removed_playlists = delete_missing(cursor, 'playlists', 'playlist_id', {row[0] for row in playlists})
+
+                if artists:
+                    cursor.executemany("""
+                        INSERT INTO user_top_artists
+                            (unique_id, artist_id, artist_name, short_term_rank)
+                        VALUES (%s, %s, %s, %s)
+                        ON DUPLICATE KEY UPDATE
+                            artist_name = VALUES(artist_name),
+                            short_term_rank = VALUES(short_term_rank)
+                    """, artists)
+                removed_artists = delete_missing(cursor, 'user_top_artists', 'artist_id', {row[1] for row in artists})
+
+                if tracks:
+                    cursor.executemany("""
+                        INSERT INTO user_top_tracks
+                            (unique_id, track_id, track_name, artist_name, short_term_rank)
+                        VALUES (%s, %s, %s, %s, %s)
+                        ON DUPLICATE KEY UPDATE
+                            track_name = VALUES(track_name),
+                            artist_name = VALUES(artist_name),
+                            short_term_rank = VALUES(short_term_rank)
+                    """, tracks)
+                removed_tracks = delete_missing(cursor, 'user_top_tracks', 'track_id', {row[1] for row in tracks})
 
+                connection.commit()
+            except BaseException:
+                try:
+                    connection.rollback()
+                except mysql.connector.Error:
+                    pass # A lost connection was rolled back by the server
+                raise
+            finally:
+                cursor.close()
+                connection.close()
+            print(f"User {unique_id} synced: {len(playlists)} playlists ({removed_playlists} removed), "
+                  f"{len(artists)} top artists ({removed_artists} removed), {len(tracks)} top tracks ({removed_tracks} removed)")
 
-    def user_playlists_db(self, unique_id, user_playlists): # Maybe add owner_id to filter by current user in playlist dropdwon?
         try:
-            with self.get_cursor() as cursor:
-                # Get existing playlist IDs from the database for the current user
-                cursor.execute("SELECT playlist_id, name, image_url, owner_id FROM playlists WHERE unique_id = %s", (unique_id,))
-                existing_playlists = {row['playlist_id']: row for row in cursor.fetchall()}
-                
-                # Prepare data for batch operations
-                user_playlist_ids = set()
-                update_data = []
-                insert_data = []
-
-                for playlist in user_playlists:
-                    playlist_id = playlist['id']
-                    user_playlist_ids.add(playlist_id)
-                    name = playlist['name'] 
-                    image_url = playlist['images'][0]['url'] if playlist['images'] else None
-                    owner_id = playlist['owner']['id']
-
-                    if playlist_id in existing_playlists:
-                        existing = existing_playlists[playlist_id]
-                        if (name != existing['name'] or 
-                            image_url != existing['image_url'] or 
-                            owner_id != existing['owner_id']):
-                            update_data.append((name, image_url, owner_id, unique_id, playlist_id))
-                            print(f"Updating playlist: {playlist_id}, Name: {name}")
-                    else:
-                        insert_data.append((playlist_id, name, image_url, owner_id, unique_id))
-
-                playlists_to_delete = set(existing_playlists.keys()) - user_playlist_ids
-                if playlists_to_delete:
-                    delete_query = "DELETE FROM playlists WHERE unique_id = %s AND playlist_id IN ({})".format(
-                        ','.join(['%s'] * len(playlists_to_delete))
-                    )
-                    cursor.execute(delete_query, (unique_id, *playlists_to_delete))
-                    print(f"Deleted {cursor.rowcount} playlists from the database")
-
-                print("Update Data:", update_data)
-                # Batch update existing playlists
-                if update_data:
-                    update_query = """
-                    UPDATE playlists
-                    SET name = %s, image_url = %s, owner_id = %s
-                    WHERE unique_id = %s AND playlist_id = %s
-                    """
-                    cursor.executemany(update_query, update_data)
-                    print(f"Updated {cursor.rowcount} playlists in the database")
-
-                # Batch insert new playlists
-                      # Insert new playlists
-                if insert_data:
-                    insert_query = """
-                    INSERT INTO playlists (playlist_id, name, image_url, owner_id, unique_id)
-                    VALUES (%s, %s, %s, %s, %s)
-                    """
-                    try:
-                        cursor.executemany(insert_query, insert_data)
-                        print(f"Inserted {cursor.rowcount} new playlists into the database")
-                    except mysql.connector.IntegrityError as e:
-                        if e.errno == 1062:  # Duplicate entry error
-                            print("Duplicate playlist entry encountered. Inserting playlists one by one.")
-                            for playlist_data in insert_data:
-                                try:
-                                    cursor.execute(insert_query, playlist_data)
-                                except mysql.connector.IntegrityError as inner_e:
-                                    if inner_e.errno == 1062:
-                                        print(f"Skipping duplicate playlist: {playlist_data[0]}")
-                                    else:
-                                        raise
-                        else:
-                            raise
-
-            print('Playlists synchronized with database')
+            self.pool.run(sync)
         except mysql.connector.Error as e:
-            print(f"Error adding playlists to database: {e}")
+            print(f"Error syncing user data to database: {e}")
             raise
 
 
+
+    # Helpers        
     def user_recently_played_db(self, unique_id, recently_played):
         connection = self.pool.get_connection()
         try:
@@ -315,177 +382,26 @@ class SQLWork:
             cursor.close()
             connection.close() 
             
-    def user_top_artists_db(self, unique_id, top_artists):
-        try:
-            with self.get_cursor() as cursor:
-                # Fetch existing artists for logging purposes
-                cursor.execute("""
-                    SELECT artist_id, artist_name, short_term_rank 
-                    FROM user_top_artists 
-                    WHERE unique_id = %s
-                """, (unique_id,))
-                existing_artists = {row['artist_id']: row for row in cursor.fetchall()}
-
-                # Prepare data for upsert operation
-                upsert_data = []
-                all_artist_ids = set()
-
-                for time_range, artists in top_artists.items():
-                    for rank, artist in enumerate(artists['items'], start=1):
-                        artist_id = artist['id']
-                        artist_name = artist['name']
-                        all_artist_ids.add(artist_id)
-
-                        # Prepare data for upsert
-                        upsert_data.append((
-                            unique_id, artist_id, artist_name,
-                            rank if time_range == 'short_term' else None,
-                            # rank if time_range == 'medium_term' else None,
-                            # rank if time_range == 'long_term' else None
-                        ))
-
-                        # Log changes
-                        if artist_id in existing_artists:
-                            old_rank = existing_artists[artist_id][f'{time_range}_rank']
-                            if old_rank != rank:
-                                print(f"Artist {artist_name} {time_range}_rank: {old_rank} -> {rank}")
-                        else:
-                            print(f"New artist {artist_name} {time_range}_rank: None -> {rank}")
-
-                # Perform upsert operation
-                upsert_query = """
-                    INSERT INTO user_top_artists 
-                        (unique_id, artist_id, artist_name, short_term_rank)
-                    VALUES (%s, %s, %s, %s)
-                    ON DUPLICATE KEY UPDATE
-                        artist_name = VALUES(artist_name),
-                        short_term_rank = VALUES(short_term_rank)
-                """
-                cursor.executemany(upsert_query, upsert_data)
-                
-                print(f'Artists upserted: {len(upsert_data)}')
-
-                # Update ranks to NULL for artists no longer in any top list
-                print(existing_artists.keys())
-                artists_to_update = set(existing_artists.keys()) - all_artist_ids
-                if artists_to_update:
-                    placeholders = ','.join(['%s'] * len(artists_to_update))
-                    null_update_query = f"""
-                        DELETE FROM user_top_artists
-                        WHERE unique_id = %s AND artist_id IN ({placeholders})
-                    """
-                    params = [unique_id] + list(artists_to_update)
-                    cursor.execute(null_update_query, params)
-                    
-                    for artist_id in artists_to_update:
-                        artist = existing_artists[artist_id]
-                        print(f"Removing artist {artist['artist_name']} from table")
-
-                print(f'Top artists updated: {len(upsert_data)} upserted, {len(artists_to_update)} removed from table')
-
-        except mysql.connector.Error as e:
-            print(f"Error updating top artists in database: {e}")
-            raise
-
+    def append_tracks(self, data, append_count):
+        """
+        Stage a playlist's tracks in append_data and merge the staged tracks into rec_dataset once enough piled up.
 
-    def user_top_tracks_db(self, unique_id, top_tracks):
-        try:
-            with self.get_cursor() as cursor:
+        Rows go in as multi-row INSERTs of APPEND_BATCH_SIZE rows (mysql-connector's executemany rewrites the
+        batch into one VALUES list), so a 10k-track playlist takes a handful of round trips instead of 10k.
 
-                cursor.execute("""
-                    SELECT track_id, track_name, artist_name, short_term_rank
-                    FROM user_top_tracks
-                    WHERE unique_id = %s
-                """, (unique_id,))
-                existing_tracks = {row['track_id']: row for row in cursor.fetchall()}
-
-                # Prepare data for upsert operation
-                upsert_data = []
-                all_track_ids = set()
-
-                for time_range, tracks in top_tracks.items():
-                    for rank, track in enumerate(tracks['items'], start=1):
-                        track_id = track['id']
-                        track_name = track['name']
-                        artist = track['artists'][0]
-                        artist_name = artist['name']
-                        all_track_ids.add(track_id)
-
-                        # Prepare data for upsert
-                        upsert_data.append((
-                            unique_id, track_id, track_name, artist_name,
-                            rank if time_range == 'short_term' else None,
-                            # rank if time_range == 'medium_term' else None,
-                            # rank if time_range == 'long_term' else None
-                        ))
-
-                        # Log changes
-                        if track_id in existing_tracks:
-                            old_rank = existing_tracks[track_id][f'{time_range}_rank']
-                            if old_rank != rank:
-                                print(f"Track {track_name} {time_range}_rank: {old_rank} -> {rank}")
-                        else:
-                            print(f"New track {track_name} {time_range}_rank: None -> {rank}")
-
-                # Perform upsert operation
-                upsert_query = """
-                    INSERT INTO user_top_tracks
-                        (unique_id, track_id, track_name, artist_name, short_term_rank)
-                    VALUES (%s, %s, %s, %s, %s)
-                    ON DUPLICATE KEY UPDATE
-                        track_name = VALUES(track_name),
-                        artist_name = VALUES(artist_name),
-                        short_term_rank = VALUES(short_term_rank)
-                    """
-                cursor.executemany(upsert_query, upsert_data)
-
-                print(f'Top tracks upserted: {len(upsert_data)}')
-
-                # Update ranks to NULL for tracks no longer in any top list
-                tracks_to_update = set(existing_tracks.keys()) - all_track_ids
-                if tracks_to_update:
-                    placeholders = ','.join(['%s'] * len(tracks_to_update))
-                    null_update_query = f"""
-                        DELETE FROM user_top_tracks
-                        WHERE unique_id = %s AND track_id IN ({placeholders})
-                    """
-                    
-                    params = [unique_id] + list(tracks_to_update)
-                    cursor.execute(null_update_query, params)
-                    
-                    for track_id in tracks_to_update:
-                        track = existing_tracks[track_id] 
-                        print(f"Removing track {track['track_name']} from top lists")
-
-                print(f'Top tracks updated: {len(upsert_data)} upserted, {len(tracks_to_update)} removed from table')
-        
-        except mysql.connector.Error as e:
-            print(f"Error updating top tracks in database: {e}")
-            raise
-        
-    
-    def append_tracks(self, data, append_count):
+        Returns:
+            bool: Whether append_data was merged into rec_dataset (and emptied).
+        """
+        rows = append_rows(data)
         connection = self.pool.get_connection()
         try:
             cursor = connection.cursor()
-            for _, row in data.iterrows():
-                query = """
-                    INSERT INTO append_data (
-                        artists, track_name, track_id, popularity, duration_ms,
-                        danceability, energy, `key`, loudness, `mode`, speechiness,
-                        acousticness, instrumentalness, liveness, valence, tempo,
-                        time_signature, track_genre
-                    )
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """
-                values = (
-                    row['artists'], row['track_name'], row['track_id'], row['popularity'],
-                    row['duration_ms'], row['danceability'], row['energy'], row['key'],
-                    row['loudness'], row['mode'], row['speechiness'], row['acousticness'],
-                    row['instrumentalness'], row['liveness'], row['valence'], row['tempo'],
-                    row['time_signature'], row['track_genre']
-                )
-                cursor.execute(query, values)
+            query = f"""
+                INSERT INTO append_data ({', '.join(QUOTED_COLUMNS)})
+                VALUES ({', '.join(['%s'] * len(DATASET_COLUMNS))})
+            """
+            for start in range(0, len(rows), APPEND_BATCH_SIZE):
+                cursor.executemany(query, rows[start:start + APPEND_BATCH_SIZE])
             connection.commit()
             query = "SELECT COUNT(*) FROM append_data"
             cursor.execute(query)
@@ -493,20 +409,13 @@ class SQLWork:
 
             if append_count >= 20 or row_count > 500:  # Check if conditions for appending to rec_dataset are met
                 print('appending')
-                query = """
-                    INSERT INTO rec_dataset (
-                        artists, track_name, track_id, popularity, duration_ms,
-                        danceability, energy, `key`, loudness, `mode`, speechiness,
-                        acousticness, instrumentalness, liveness, valence, tempo,
-                        time_signature, track_genre
-                    )
-                    SELECT DISTINCT
-                        artists, track_name, track_id, popularity, duration_ms,
-                        danceability, energy, `key`, loudness, `mode`, speechiness,
-                        acousticness, instrumentalness, liveness, valence, tempo,
-                        time_signature, track_genre
-                    FROM append_data
-                    WHERE track_id NOT IN (SELECT track_id FROM rec_dataset)
+                # Anti-join instead of NOT IN (SELECT ...): one lookup per staged row against rec_dataset's track_id
+                query = f"""
+                    INSERT INTO rec_dataset ({', '.join(QUOTED_COLUMNS)})
+                    SELECT DISTINCT {', '.join('a.' + column for column in QUOTED_COLUMNS)}
+                    FROM append_data a
+                    LEFT JOIN rec_dataset r ON r.track_id = a.track_id
+                    WHERE r.track_id IS NULL
                 """
                 cursor.execute(query)
                 query = "TRUNCATE TABLE append_data"
@@ -558,90 +467,20 @@ class SQLWork:
             connection.close()
 
     def add_vector_to_db(self, vector, playlist_id):
-        vector = vector.rename(columns={
-            'track_genre_R&B': 'track_genre_R_B',
-            'track_genre_Hip-Hop': 'track_genre_Hip_Hop'
-        })
-
-        if isinstance(vector, pd.DataFrame):
-            vector = vector.iloc[0].to_dict()
-
-        vector['playlist_id'] = playlist_id
-        upsert_query ="""
-        INSERT INTO playlist_vectors (
-            playlist_id, acousticness, danceability, duration_ms, energy,
-            instrumentalness, key_0, key_1, key_10, key_11, key_2, key_3,
-            key_4, key_5, key_6, key_7, key_8, key_9, liveness, loudness,
-            mode_0, mode_1, popularity, speechiness, tempo, time_signature,
-            track_genre_Alternative, track_genre_Anime, track_genre_Blues,
-            track_genre_Classical, track_genre_Country, track_genre_Dance,
-            track_genre_Electronic, track_genre_Folk, track_genre_Hip_Hop,
-            track_genre_Indie, track_genre_Jazz, track_genre_Opera,
-            track_genre_Pop, track_genre_R_B, track_genre_Reggae,
-            track_genre_Reggaeton, track_genre_Rock, track_genre_Soul,
-            track_genre_Soundtrack, track_genre_World, valence
-        ) VALUES (
-            %(playlist_id)s, %(acousticness)s, %(danceability)s, %(duration_ms)s, %(energy)s,
-            %(instrumentalness)s, %(key_0)s, %(key_1)s, %(key_10)s, %(key_11)s, %(key_2)s, %(key_3)s,
-            %(key_4)s, %(key_5)s, %(key_6)s, %(key_7)s, %(key_8)s, %(key_9)s, %(liveness)s, %(loudness)s,
-            %(mode_0)s, %(mode_1)s, %(popularity)s, %(speechiness)s, %(tempo)s, %(time_signature)s,
-            %(track_genre_Alternative)s, %(track_genre_Anime)s, %(track_genre_Blues)s,
-            %(track_genre_Classical)s, %(track_genre_Country)s, %(track_genre_Dance)s,
-            %(track_genre_Electronic)s, %(track_genre_Folk)s, %(track_genre_Hip_Hop)s,
-            %(track_genre_Indie)s, %(track_genre_Jazz)s, %(track_genre_Opera)s,
-            %(track_genre_Pop)s, %(track_genre_R_B)s, %(track_genre_Reggae)s,
-            %(track_genre_Reggaeton)s, %(track_genre_Rock)s, %(track_genre_Soul)s,
-            %(track_genre_Soundtrack)s, %(track_genre_World)s, %(valence)s
-        ) ON DUPLICATE KEY UPDATE
-            acousticness = VALUES(acousticness),
-            danceability = VALUES(danceability),
-            duration_ms = VALUES(duration_ms),
-            energy = VALUES(energy),
-            instrumentalness = VALUES(instrumentalness),
-            key_0 = VALUES(key_0),
-            key_1 = VALUES(key_1),
-            key_10 = VALUES(key_10),
-            key_11 = VALUES(key_11),
-            key_2 = VALUES(key_2),
-            key_3 = VALUES(key_3),
-            key_4 = VALUES(key_4),
-            key_5 = VALUES(key_5),
-            key_6 = VALUES(key_6),
-            key_7 = VALUES(key_7),
-            key_8 = VALUES(key_8),
-            key_9 = VALUES(key_9),
-            liveness = VALUES(liveness),
-            loudness = VALUES(loudness),
-            mode_0 = VALUES(mode_0),
-            mode_1 = VALUES(mode_1),
-            popularity = VALUES(popularity),
-            speechiness = VALUES(speechiness),
-            tempo = VALUES(tempo),
-            time_signature = VALUES(time_signature),
-            track_genre_Alternative = VALUES(track_genre_Alternative),
-            track_genre_Anime = VALUES(track_genre_Anime),
-            track_genre_Blues = VALUES(track_genre_Blues),
-            track_genre_Classical = VALUES(track_genre_Classical),
-            track_genre_Country = VALUES(track_genre_Country),
-            track_genre_Dance = VALUES(track_genre_Dance),
-            track_genre_Electronic = VALUES(track_genre_Electronic),
-            track_genre_Folk = VALUES(track_genre_Folk),
-            track_genre_Hip_Hop = VALUES(track_genre_Hip_Hop),
-            track_genre_Indie = VALUES(track_genre_Indie),
-            track_genre_Jazz = VALUES(track_genre_Jazz),
-            track_genre_Opera = VALUES(track_genre_Opera),
-            track_genre_Pop = VALUES(track_genre_Pop),
-            track_genre_R_B = VALUES(track_genre_R_B),
-            track_genre_Reggae = VALUES(track_genre_Reggae),
-            track_genre_Reggaeton = VALUES(track_genre_Reggaeton),
-            track_genre_Rock = VALUES(track_genre_Rock),
-            track_genre_Soul = VALUES(track_genre_Soul),
-            track_genre_Soundtrack = VALUES(track_genre_Soundtrack),
-            track_genre_World = VALUES(track_genre_World),
-            valence = VALUES(valence)
-        """
+        """Upsert a playlist vector (feature_schema layout) into playlist_vectors."""
+        vector = to_vector(vector)
+
+        upsert_query = """
+        INSERT INTO playlist_vectors (playlist_id, {columns})
+        VALUES (%s, {placeholders})
+        ON DUPLICATE KEY UPDATE {updates}
+        """.format(
+            columns=', '.join(SQL_COLUMNS),
+            placeholders=', '.join(['%s'] * len(SQL_COLUMNS)),
+            updates=', '.join(f'{column} = VALUES({column})' for column in SQL_COLUMNS)
+        )
         with self.get_cursor() as cursor:
-            cursor.execute(upsert_query, vector)
+            cursor.execute(upsert_query, [playlist_id] + vector.astype(float).tolist())
             print(f"Playlist vector upserted for playlist ID: {playlist_id}")
 
     def get_user_top_tracks(self, unique_id):
@@ -748,16 +587,18 @@ class SQLWork:
             connection.close()
 
     def get_playlist_vectors(self): 
+        """
+        Returns:
+            tuple: (playlist ids as an object ndarray, float32 matrix of vectors in the feature_schema layout)
+        """
         try:
             with self.get_cursor() as cursor:
-                cursor.execute("SELECT * FROM playlist_vectors")
-                playlist_vectors = pd.DataFrame(cursor.fetchall())
-
-                playlist_vectors = playlist_vectors.rename(columns={
-                    'track_genre_R_B': 'track_genre_R&B',
-                    'track_genre_Hip_Hop': 'track_genre_Hip-Hop'
-                })
-            return playlist_vectors
+                cursor.execute("SELECT playlist_id, {} FROM playlist_vectors".format(', '.join(SQL_COLUMNS)))
+                rows = cursor.fetchall()
+
+            playlist_ids = np.array([row['playlist_id'] for row in rows], dtype=object)
+            vectors = np.array([[row[column] for column in SQL_COLUMNS] for row in rows], dtype=VECTOR_DTYPE).reshape(len(rows), NUM_FEATURES)
+            return playlist_ids, np.nan_to_num(vectors)
         except mysql.connector.Error as e:
             print(f"Error getting playlist vectors from database: {e}")
             raise
@@ -0,0 +1,222 @@
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from feature_schema import SCHEMA_VERSION
+
+LOCAL_SIZE = 20000 # Tracks kept in process, a few MB
+TTL = 30 * 86400 # Seconds a track stays in Redis after its last write
+
+
+def namespace(model_version):
+    """Key / table namespace of the cache for the genre model of load_gc.model_version."""
+    return f'v{SCHEMA_VERSION}_{model_version:08x}'
+
+
+class RedisTrackStore:
+    """One hash per track (features as JSON, genre), read with one pipelined round trip per batch."""
+
+    def __init__(self, redis_client, namespace, ttl=TTL):
+        self.redis = redis_client
+        self.namespace = namespace
+        self.ttl = ttl
+
+    def _key(self, track_id):
+        return f'track:{self.namespace}:{track_id}'
+
+    def get_many(self, track_ids):
+        pipe = self.redis.pipeline(transaction=False)
+        for track_id in track_ids:
+            pipe.hmget(self._key(track_id), 'features', 'genre')
+        entries = {}
+        for track_id, (features, genre) in zip(track_ids, pipe.execute()):
+            if features is not None or genre is not None:
+                entries[track_id] = {
+                    'features': json.loads(features) if features is not None else None,
+                    'genre': genre.decode('utf-8') if isinstance(genre, bytes) else genre,
+                }
+        return entries
+
+    def set_many(self, field, values):
+        pipe = self.redis.pipeline(transaction=False)
+        for track_id, value in values.items():
+            pipe.hset(self._key(track_id), field, json.dumps(value) if field == 'features' else value)
+            pipe.expire(self._key(track_id), self.ttl)
+        pipe.execute()
+
+
+class SQLiteTrackStore:
+    """A SQLite file shared by the workers of one host, WAL mode so readers don't block the writer."""
+
+    def __init__(self, path, namespace):
+        self.path = path
+        self.table = f'tracks_{namespace}'
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+
+    def _connect(self):
+        """The process' connection (lock held), opened after the fork, a SQLite connection can't cross one."""
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.table} (track_id TEXT PRIMARY KEY, features TEXT, genre TEXT)')
+            self._pid = os.getpid()
+        return self._connection
+
+    def get_many(self, track_ids, chunk_size=500):
+        entries = {}
+        with self._lock:
+            for start in range(0, len(track_ids), chunk_size):
+                chunk = track_ids[start:start + chunk_size]
+                rows = self._connect().execute(
+                    f"SELECT track_id, features, genre FROM {self.table} WHERE track_id IN ({', '.join('?' * len(chunk))})", chunk)
+                for track_id, features, genre in rows:
+                    entries[track_id] = {'features': json.loads(features) if features is not None else None, 'genre': genre}
+        return entries
+
+    def set_many(self, field, values):
+        rows = [(track_id, json.dumps(value) if field == 'features' else value) for track_id, value in values.items()]
+        with self._lock:
+            self._connect().executemany(
+                f"INSERT INTO {self.table} (track_id, {field}) VALUES (?, ?) "
+                f"ON CONFLICT(track_id) DO UPDATE SET {field} = excluded.{field}", rows)
+
+
+class TrackFeatureCache:
+    """
+    Read-through cache of Spotify audio features and predicted genres, keyed by track id.
+
+    Popular tracks show up in many users' playlists. Lookups go to a small in-process LRU first, then to a shared
+    store (Redis hashes, or a SQLite file when the workers share a host but no Redis), and only the remaining
+    misses are requested from Spotify. Features of a track never change; a predicted genre is only valid for the
+    model that predicted it, so stores are namespaced by the model files' checksum and a retrained model starts
+    from an empty cache. A failing store is treated as a miss: the features are requested from Spotify as they would be without a cache.
+    """
+
+    def __init__(self, store=None, local_size=LOCAL_SIZE):
+        self.store = store
+        self.local_size = local_size
+        self._local = OrderedDict() # track_id -> {'features': dict or None, 'genre': str or None}
+        self._lock = threading.Lock()
+        self.metrics = {
+            'feature_lookups': 0,
+            'feature_local_hits': 0,
+            'feature_store_hits': 0,
+            'genre_lookups': 0,
+            'genre_hits': 0,
+            'api_requests': 0,
+            'api_tracks': 0,
+            'api_ms': 0.0,
+            'store_errors': 0,
+        }
+
+    @classmethod
+    def from_env(cls, model_version, redis_client=None):
+        """
+        TRACK_CACHE: 'redis' (default), 'sqlite' (file at TRACK_CACHE_PATH), 'local' (in-process only) or 'off'.
+
+        Args:
+            model_version (int): load_gc.model_version of the genre model whose predictions are cached.
+        """
+        backend = os.getenv('TRACK_CACHE', 'redis')
+        if backend == 'off':
+            return None
+        if backend == 'sqlite':
+            return cls(SQLiteTrackStore(os.getenv('TRACK_CACHE_PATH', '../data/track_cache.sqlite3'), namespace(model_version)))
+        if backend == 'redis' and redis_client is not None:
+            return cls(RedisTrackStore(redis_client, namespace(model_version)))
+        return cls()
+
+    def _lookup(self, track_ids, wanted):
+        """Entries of track_ids that have a `wanted` value, local LRU first, then one store read."""
+        found, missing = {}, []
+        with self._lock:
+            for track_id in track_ids:
+                entry = self._local.get(track_id)
+                if entry is not None and entry[wanted] is not None:
+                    self._local.move_to_end(track_id)
+                    found[track_id] = entry
+                else:
+                    missing.append(track_id)
+        local_hits = len(found)
+
+        if missing and self.store is not None:
+            try:
+                stored = self.store.get_many(missing)
+            except Exception as e:
+                print(f"Track cache store unavailable: {e}")
+                self.metrics['store_errors'] += 1
+                stored = {}
+            with self._lock:
+                for track_id, entry in stored.items():
+                    entry = self._remember(track_id, entry)
+                    if entry[wanted] is not None:
+                        found[track_id] = entry
+        return found, local_hits
+
+    def _remember(self, track_id, entry):
+        """Merge entry into the local LRU (lock held), returning the merged entry."""
+        current = self._local.pop(track_id, None) or {'features': None, 'genre': None}
+        merged = {key: entry.get(key) if entry.get(key) is not None else current[key] for key in current}
+        self._local[track_id] = merged
+        while len(self._local) > self.local_size:
+            self._local.popitem(last=False)
+        return merged
+
+    def get_features(self, track_ids):
+        """{track_id: audio features dict} of the cached tracks among track_ids."""
+        found, local_hits = self._lookup(list(track_ids), 'features')
+        self.metrics['feature_lookups'] += len(track_ids)
+        self.metrics['feature_local_hits'] += local_hits
+        self.metrics['feature_store_hits'] += len(found) - local_hits
+        return {track_id: entry['features'] for track_id, entry in found.items()}
+
+    def get_genres(self, track_ids):
+        """{track_id: predicted genre} of the cached tracks among track_ids."""
+        found, _ = self._lookup(list(track_ids), 'genre')
+        self.metrics['genre_lookups'] += len(track_ids)
+        self.metrics['genre_hits'] += len(found)
+        return {track_id: entry['genre'] for track_id, entry in found.items()}
+
+    def put_features(self, features_list):
+        self._put('features', {features['id']: features for features in features_list})
+
+    def put_genres(self, genres):
+        self._put('genre', dict(genres))
+
+    def _put(self, field, values):
+        if not values:
+            return
+        with self._lock:
+            for track_id, value in values.items():
+                self._remember(track_id, {field: value})
+        if self.store is not None:
+            try:
+                self.store.set_many(field, values)
+            except Exception as e:
+                print(f"Track cache store unavailable: {e}")
+                self.metrics['store_errors'] += 1
+
+    def record_api(self, num_tracks, elapsed_ms):
+        """One audio features request that the cache couldn't answer."""
+        self.metrics['api_requests'] += 1
+        self.metrics['api_tracks'] += num_tracks
+        self.metrics['api_ms'] += elapsed_ms
+
+    def stats(self):
+        hits = self.metrics['feature_local_hits'] + self.metrics['feature_store_hits']
+        lookups = self.metrics['feature_lookups']
+        api_ms_per_track = self.metrics['api_ms'] / self.metrics['api_tracks'] if self.metrics['api_tracks'] else 0.0
+        with self._lock:
+            local_tracks = len(self._local)
+        return {
+            **self.metrics,
+            'local_tracks': local_tracks,
+            'feature_hit_rate': hits / lookups if lookups else 0.0,
+            'genre_hit_rate': self.metrics['genre_hits'] / self.metrics['genre_lookups'] if self.metrics['genre_lookups'] else 0.0,
+            # Requests carry up to 100 tracks, so a hit saves about a 100th of a request when misses fill them
+            'estimated_saved_ms': hits * api_ms_per_track,
+        }
@@ -0,0 +1,160 @@
+import os
+import threading
+import time
+
+POLL_INTERVAL = 0.1 # Seconds between checks of a sync queued by another worker process
+
+
+class UserSyncWorker:
+    """
+    Runs the login sync of a user's Spotify data (SQLWork.sync_user_data) off the request path.
+
+    One daemon thread per process, started by the first submit so that it lives in the gunicorn worker and not in
+    the preloaded master. Syncs are queued per user: a newer login of a user whose sync hasn't started yet replaces
+    the queued one, it carries the same data, only fresher. Readers that need the synced rows (the top tracks /
+    artists cache fill after login) wait() for the user's pending sync first. The login and the first request
+    after it may be served by different worker processes, so a pending sync is also flagged in the shared store
+    (SessionStore's sync_pending key) and wait() polls that flag when the sync isn't queued in this process.
+    """
+
+    def __init__(self, sync, shared=None):
+        """
+        Args:
+            sync (callable): sync(unique_id, *args), writes one user's data.
+            shared (SessionStore, optional): Holds the pending flags every worker process sees.
+        """
+        self.sync = sync
+        self.shared = shared
+        self._condition = threading.Condition()
+        self._pending = {} # unique_id -> args, oldest first
+        self._done = {} # unique_id -> Event, set once nothing is queued or running for the user
+        self._thread = None
+        self._pid = None
+        self.metrics = {
+            'submitted': 0,
+            'coalesced': 0,
+            'synced': 0,
+            'failed': 0,
+            'waits': 0,
+            'wait_timeouts': 0,
+            'shared_errors': 0,
+            'last_sync_ms': 0.0,
+            'total_sync_ms': 0.0,
+            'max_sync_ms': 0.0,
+        }
+
+    def submit(self, unique_id, *args):
+        self._set_shared(unique_id, pending=True)
+        with self._condition:
+            if unique_id in self._pending:
+                self.metrics['coalesced'] += 1
+            self._pending[unique_id] = args
+            if unique_id not in self._done:
+                self._done[unique_id] = threading.Event()
+            self.metrics['submitted'] += 1
+            if self._thread is None or self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name='user-sync', daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+            self._condition.notify()
+
+    def wait(self, unique_id, timeout=None):
+        """
+        Block until the user's queued or running sync is done, in this process or another one (immediately when
+        there is none).
+
+        Returns:
+            bool: False if the timeout passed first.
+        """
+        with self._condition:
+            done = self._done.get(unique_id)
+        if done is None:
+            if not self._shared_pending(unique_id):
+                return True
+            with self._condition:
+                self.metrics['waits'] += 1
+            give_up_at = None if timeout is None else time.monotonic() + timeout
+            while self._shared_pending(unique_id):
+                if give_up_at is not None and time.monotonic() >= give_up_at:
+                    return self._timed_out()
+                time.sleep(POLL_INTERVAL)
+            return True
+        with self._condition:
+            self.metrics['waits'] += 1
+        if not done.wait(timeout):
+            return self._timed_out()
+        return True
+
+    def _timed_out(self):
+        with self._condition:
+            self.metrics['wait_timeouts'] += 1
+        return False
+
+    def _shared_pending(self, unique_id):
+        if self.shared is None:
+            return False
+        try:
+            return self.shared.is_sync_pending(unique_id)
+        except Exception as e:
+            print(f"Could not read the sync state of user {unique_id}: {e}")
+            with self._condition:
+                self.metrics['shared_errors'] += 1
+            return False
+
+    def _set_shared(self, unique_id, pending):
+        if self.shared is None:
+            return
+        try:
+            if pending:
+                self.shared.set_sync_pending(unique_id)
+            else:
+                self.shared.clear_sync_pending(unique_id)
+        except Exception as e:
+            # Other workers don't wait for this sync, or wait until the flag expires
+            print(f"Could not update the sync state of user {unique_id}: {e}")
+            with self._condition:
+                self.metrics['shared_errors'] += 1
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                unique_id = next(iter(self._pending))
+                args = self._pending.pop(unique_id)
+
+            start_time = time.perf_counter()
+            try:
+                self.sync(unique_id, *args)
+                succeeded = True
+            except Exception as e:
+                # The next login syncs again, until then readers see the previous login's rows
+                print(f"Error syncing user {unique_id}: {e}")
+                succeeded = False
+            elapsed = (time.perf_counter() - start_time) * 1000
+
+            with self._condition:
+                self.metrics['synced' if succeeded else 'failed'] += 1
+                self.metrics['last_sync_ms'] = elapsed
+                self.metrics['total_sync_ms'] += elapsed
+                self.metrics['max_sync_ms'] = max(self.metrics['max_sync_ms'], elapsed)
+                finished = unique_id not in self._pending
+            if finished:
+                self._set_shared(unique_id, pending=False)
+                with self._condition:
+                    resubmitted = unique_id in self._pending
+                    if not resubmitted:
+                        self._done.pop(unique_id).set()
+                if resubmitted: # A login came in while the flag was cleared, its sync is still to run
+                    self._set_shared(unique_id, pending=True)
+
+    def stats(self):
+        with self._condition:
+            metrics = dict(self.metrics)
+            queued = len(self._pending)
+        finished = metrics['synced'] + metrics['failed']
+        return {
+            **metrics,
+            'queued': queued,
+            'avg_sync_ms': metrics['total_sync_ms'] / finished if finished else 0.0,
+        }
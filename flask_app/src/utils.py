@@ -2,6 +2,7 @@ import psutil
 import logging
 import functools
 import contextlib
+import tracemalloc
 import time
 import pandas as pd
 
@@ -35,13 +36,19 @@ def log_current_memory_usage():
 def track_memory_usage(operation):
     process = psutil.Process()
     before_memory = process.memory_info().rss / 1024 / 1024  # Convert to MB
+    # RSS only shows what's still held at the end, under tracemalloc (PYTHONTRACEMALLOC=1) also log the peak
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        before_traced = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak() # Nested blocks reset it too, an outer block's peak then only covers its tail
     start_time = time.time()
     yield
     after_memory = process.memory_info().rss / 1024 / 1024  # Convert to MB
     end_time = time.time()
     memory_diff = after_memory - before_memory
     time_diff = end_time - start_time
-    logging.info(f"{operation} memory usage: {memory_diff:.2f} MB in {time_diff:.2f} seconds")
+    peak = f", peak {(tracemalloc.get_traced_memory()[1] - before_traced) / 1024**2:.2f} MB" if tracing else ""
+    logging.info(f"{operation} memory usage: {memory_diff:.2f} MB{peak} in {time_diff:.2f} seconds")
 
 
 def mem_usage(df):
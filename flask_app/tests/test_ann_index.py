@@ -0,0 +1,66 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+import pytest
+import numpy as np
+import pandas as pd
+from feature_store import FeatureStore
+from feature_schema import GENRES
+from ann_index import TrackIndex
+
+
+def make_dataset(num_tracks=3000, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'artists': [f'artist_{i}' for i in rng.integers(0, 100, num_tracks)],
+        'track_name': [f'track_{i}' for i in range(num_tracks)],
+        'track_id': [f'id_{i}' for i in range(num_tracks)],
+        'popularity': rng.integers(0, 100, num_tracks),
+        'duration_ms': rng.integers(60000, 400000, num_tracks),
+        'danceability': rng.random(num_tracks),
+        'energy': rng.random(num_tracks),
+        'key': rng.integers(0, 12, num_tracks),
+        'loudness': rng.uniform(-30, 0, num_tracks),
+        'mode': rng.integers(0, 2, num_tracks),
+        'speechiness': rng.random(num_tracks),
+        'acousticness': rng.random(num_tracks),
+        'instrumentalness': rng.random(num_tracks),
+        'liveness': rng.random(num_tracks),
+        'valence': rng.random(num_tracks),
+        'tempo': rng.uniform(60, 200, num_tracks),
+        'time_signature': rng.integers(3, 6, num_tracks).astype(float),
+        'track_genre': rng.choice(GENRES[:3] + ['Not a schema genre'], num_tracks),
+    })
+
+
+@pytest.fixture(scope='module')
+def store():
+    return FeatureStore(make_dataset())
+
+
+@pytest.fixture(scope='module')
+def index(store):
+    return TrackIndex(store, list_size=50, nprobe=2)
+
+
+def test_probed_rows_stay_in_genre(store, index):
+    query = store.encoded[0]
+    rows = index.genre_rows(GENRES[1], query)
+    assert len(rows) < len(store.genre_rows(GENRES[1]))
+    assert np.all(np.diff(rows) > 0)
+    assert set(store.genres[store.genre_codes[rows]]) == {GENRES[1]}
+
+
+def test_probing_every_list_is_exact(store, index):
+    query = store.encoded[1]
+    for genre in GENRES[:3]:
+        assert np.array_equal(index.genre_rows(genre, query, nprobe=10**6), store.genre_rows(genre))
+
+
+def test_min_rows_and_unindexed_genres(store, index):
+    query = store.encoded[2]
+    assert len(index.genre_rows(GENRES[0], query, nprobe=1, min_rows=300)) >= 300
+    assert np.array_equal(index.genre_rows('Not a schema genre', query), store.genre_rows('Not a schema genre'))
+    rows = index.candidate_rows(GENRES[:2], query)
+    assert np.array_equal(rows, np.union1d(index.genre_rows(GENRES[0], query), index.genre_rows(GENRES[1], query)))
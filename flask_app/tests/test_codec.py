@@ -0,0 +1,44 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+import pickle
+import numpy as np
+import pandas as pd
+import pytest
+from codec import encode_vector, decode_vector, encode_json, decode, VECTOR_HEADER
+from feature_schema import FEATURES, NUM_FEATURES, SCHEMA_VERSION
+
+
+@pytest.fixture
+def vector():
+    return np.random.default_rng(0).random(NUM_FEATURES).astype(np.float32)
+
+
+def test_vector_round_trip_without_copy(vector):
+    payload = encode_vector(vector)
+    assert len(payload) == VECTOR_HEADER.size + 4 * NUM_FEATURES
+
+    decoded = decode(payload)
+    assert np.array_equal(decoded, vector) and decoded.dtype == np.float32
+    assert not decoded.flags.writeable and not decoded.flags.owndata # A view of the payload
+    assert decoded.ctypes.data % 4 == 0
+
+    # Older one-row DataFrame vectors encode to the same bytes
+    assert encode_vector(pd.DataFrame([vector], columns=FEATURES)) == payload
+
+
+def test_rejects_other_schemas_and_pickles(vector):
+    payload = bytearray(encode_vector(vector))
+    payload[4:8] = ((SCHEMA_VERSION + 1) % 2**32).to_bytes(4, 'little')
+    with pytest.raises(ValueError, match='schema'):
+        decode_vector(bytes(payload))
+    with pytest.raises(ValueError):
+        decode(encode_vector(vector)[:-4])
+    with pytest.raises(ValueError):
+        decode(pickle.dumps(vector)) # Never unpickled
+
+
+def test_json_round_trip():
+    prev_rec = {'track_ids': ['a', 'b'], 'recommended_ids': ['c'], 'counts': {1: np.int64(3)}}
+    assert decode(encode_json(prev_rec)) == {'track_ids': ['a', 'b'], 'recommended_ids': ['c'], 'counts': {'1': 3}}
@@ -0,0 +1,141 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+import threading
+import time
+import pytest
+from mysql.connector import errors
+import db_pool
+from db_pool import ConnectionManager, PoolTimeout, pool_size_for, deadline_for, gunicorn_config
+
+
+class FakeConnection:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def cursor(self, dictionary=False):
+        return 'cursor'
+
+    def close(self):
+        self.pool.returned += 1
+
+
+class FakePool:
+    """Stands in for MySQLConnectionPool, failing the first `failures` checkouts"""
+
+    def __init__(self, pool_size, failures=0, error=errors.InterfaceError, **cnx_config):
+        self.pool_size = pool_size
+        self.failures = failures
+        self.error = error
+        self.checkouts = 0
+        self.returned = 0
+
+    def get_connection(self):
+        self.checkouts += 1
+        if self.checkouts <= self.failures:
+            raise self.error("Lost connection to MySQL server")
+        return FakeConnection(self)
+
+
+def make_manager(pool_size=2, deadline=1.0, checkout_timeout=0.2, **pool_kwargs):
+    pools = []
+
+    def factory(size, **cnx_config):
+        pools.append(FakePool(size, **pool_kwargs))
+        return pools[-1]
+    manager = ConnectionManager(pool_size=pool_size, deadline=deadline, checkout_timeout=checkout_timeout,
+                                base_delay=0.01, max_delay=0.05, pool_factory=factory)
+    return manager, pools
+
+
+def test_sizing_follows_gunicorn_config():
+    config = gunicorn_config()
+    assert config['threads'] == 3 and config['timeout'] == 30
+    assert pool_size_for(config) == 4
+    assert pool_size_for({'threads': 100}) == db_pool.POOL_MAX_SIZE
+    assert deadline_for(config) < config['timeout']
+
+
+def test_checkout_waits_then_times_out():
+    manager, pools = make_manager(pool_size=1, checkout_timeout=0.1)
+    held = manager.get_connection()
+    assert held.cursor() == 'cursor' # Delegated to the pooled connection
+
+    start_time = time.perf_counter()
+    with pytest.raises(PoolTimeout):
+        manager.get_connection()
+    assert 0.1 <= time.perf_counter() - start_time < 1
+
+    # A returned connection unblocks a waiting checkout
+    threading.Timer(0.05, held.close).start()
+    manager.get_connection(timeout=1).close()
+    held.close() # Closing twice releases once
+
+    stats = manager.stats()
+    assert stats['checkout_timeouts'] == 1 and stats['checkout_waits'] == 2
+    assert stats['checkouts'] == 2 and stats['in_use'] == 0 and stats['max_in_use'] == 1
+    assert stats['max_wait_ms'] >= 50
+    assert pools[0].returned == 2
+
+
+def test_run_retries_transient_errors():
+    manager, pools = make_manager(failures=2)
+
+    def operation():
+        connection = manager.get_connection()
+        connection.close()
+        return 'rows'
+    assert manager.run(operation) == 'rows'
+    assert manager.metrics['retries'] == 2 and manager.metrics['in_use'] == 0
+
+
+def test_run_gives_up_at_the_deadline():
+    manager, _ = make_manager(failures=10**6, deadline=0.3)
+    start_time = time.perf_counter()
+    with pytest.raises(errors.InterfaceError):
+        manager.run(lambda: manager.get_connection())
+    assert time.perf_counter() - start_time < 0.5
+    assert manager.metrics['failures'] == 1 and manager.metrics['in_use'] == 0
+
+
+def test_checkouts_in_run_wait_at_most_the_time_left():
+    manager, _ = make_manager(pool_size=1, deadline=0.3, checkout_timeout=10)
+    held = manager.get_connection()
+    start_time = time.perf_counter()
+    with pytest.raises(PoolTimeout):
+        manager.run(lambda: manager.get_connection())
+    assert time.perf_counter() - start_time < 0.6 # Not another full checkout timeout
+    assert manager.metrics['failures'] == 1
+    held.close()
+
+
+def test_metrics_are_exact_under_concurrent_checkouts():
+    manager, _ = make_manager(pool_size=4, checkout_timeout=5)
+
+    def checkouts():
+        for _ in range(500):
+            manager.get_connection().close()
+    threads = [threading.Thread(target=checkouts) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = manager.stats()
+    assert stats['checkouts'] == 4000 and stats['in_use'] == 0 and stats['max_in_use'] <= 4
+
+
+def test_run_raises_other_errors_right_away():
+    manager, pools = make_manager(failures=1, error=errors.ProgrammingError)
+    with pytest.raises(errors.ProgrammingError):
+        manager.run(lambda: manager.get_connection())
+    assert pools[0].checkouts == 1 and manager.metrics['retries'] == 0
+
+
+def test_pool_is_rebuilt_in_a_forked_process(monkeypatch):
+    manager, pools = make_manager(pool_size=1)
+    manager.get_connection() # Held by the "parent", never returned
+    monkeypatch.setattr(db_pool.os, 'getpid', lambda: -1)
+    manager.get_connection(timeout=0).close()
+    assert len(pools) == 2 and pools[1].returned == 1
+    assert manager.metrics['pool_builds'] == 2
@@ -0,0 +1,44 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+import pytest
+import numpy as np
+import pandas as pd
+from feature_schema import (FEATURES, NUM_FEATURES, NUM_SCORED, SQL_COLUMNS, GENRE_COLUMNS, AUDIO_OFFSET,
+                            UNSCORED_COLUMNS, TRACK_COLUMNS, encode_frame, to_vector, vector_genre, GENRES)
+
+
+def test_layout_is_fixed():
+    assert len(FEATURES) == NUM_FEATURES == len(set(FEATURES))
+    assert FEATURES[:len(GENRE_COLUMNS)] == GENRE_COLUMNS
+    assert FEATURES[NUM_SCORED:] == UNSCORED_COLUMNS
+    assert all(column.replace('_', '').isalnum() for column in SQL_COLUMNS)
+
+
+def test_to_vector_accepts_legacy_frames():
+    vector = np.arange(NUM_FEATURES, dtype=np.float32)
+    legacy = pd.DataFrame([vector[::-1]], columns=FEATURES[::-1]) # Column order used to depend on get_dummies
+    assert np.array_equal(to_vector(legacy), vector)
+
+    stored = dict(zip(SQL_COLUMNS, vector.tolist()))
+    stored['playlist_id'] = 'abc'
+    assert np.array_equal(to_vector(stored), vector)
+
+    with pytest.raises(ValueError):
+        to_vector(vector[:-1])
+
+
+def test_encode_frame_round_trips_genre():
+    track = pd.DataFrame([dict.fromkeys(TRACK_COLUMNS, 0)])
+    track['track_genre'] = GENRES[3]
+    track['key'] = 5
+    track['mode'] = 1
+    track['tempo'] = 120.0
+
+    vector = encode_frame(track)[0]
+    assert vector.dtype == np.float32 and len(vector) == NUM_FEATURES
+    assert vector_genre(vector) == GENRES[3]
+    assert vector[FEATURES.index('tempo')] == 120.0
+    assert vector[:AUDIO_OFFSET].sum() == 3
+    assert vector_genre(np.zeros(NUM_FEATURES)) is None
@@ -0,0 +1,119 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+import pytest
+import numpy as np
+import pandas as pd
+from feature_store import FeatureStore, DATASET_COLUMNS
+from feature_schema import SCORED_COLUMNS, GENRE_COLUMNS, KEY_OFFSET, AUDIO_OFFSET, encode_frame
+from scoring import weighted_cosine_many, genre_weight_vector
+
+
+def make_dataset(num_tracks=500, seed=0):
+    """Random rec_dataset shaped frame"""
+    rng = np.random.default_rng(seed)
+    genres = ['Electronic', 'Rock', 'Hip-Hop', 'R&B', 'Jazz']
+    artists = [f'artist_{i}' for i in range(40)]
+    return pd.DataFrame({
+        'artists': rng.choice(artists, num_tracks),
+        'track_name': [f'track_{i}' for i in range(num_tracks)],
+        'track_id': [f'id_{i}' for i in range(num_tracks)],
+        'popularity': rng.integers(0, 100, num_tracks),
+        'duration_ms': rng.integers(60000, 400000, num_tracks),
+        'danceability': rng.random(num_tracks),
+        'energy': rng.random(num_tracks),
+        'key': rng.integers(0, 12, num_tracks),
+        'loudness': rng.uniform(-30, 0, num_tracks),
+        'mode': rng.integers(0, 2, num_tracks),
+        'speechiness': rng.random(num_tracks),
+        'acousticness': rng.random(num_tracks),
+        'instrumentalness': rng.random(num_tracks),
+        'liveness': rng.random(num_tracks),
+        'valence': rng.random(num_tracks),
+        'tempo': rng.uniform(60, 200, num_tracks),
+        'time_signature': rng.integers(3, 6, num_tracks).astype(float),
+        'track_genre': rng.choice(genres, num_tracks),
+    })
+
+
+@pytest.fixture(scope='module')
+def dataset():
+    return make_dataset()
+
+
+@pytest.fixture(scope='module')
+def store(dataset):
+    return FeatureStore(dataset)
+
+
+def test_matrix_layout(store, dataset):
+    assert store.features.dtype == np.float32
+    assert store.features.flags['C_CONTIGUOUS']
+    assert store.features.shape == (len(dataset), 14)
+    assert len(store) == len(dataset)
+
+
+def test_masks_agree_with_row_lists(store):
+    assert np.array_equal(np.flatnonzero(store.artist_mask(['artist_5'])), store.artist_rows(['artist_5']))
+    assert len(store.genre_rows('Opera')) == 0
+
+
+def test_frame_round_trips(store, dataset):
+    rows = store.genre_rows('Hip-Hop')
+    frame = store.frame(rows)
+    expected = dataset[dataset['track_genre'] == 'Hip-Hop'].reset_index(drop=True)
+
+    assert list(frame.columns) == DATASET_COLUMNS
+    assert frame['key'].dtype == np.int64
+    assert list(frame['track_id']) == list(expected['track_id'])
+    assert np.allclose(frame['tempo'], expected['tempo'], rtol=1e-6)
+
+
+def test_encoded_matrix_matches_get_dummies(store, dataset):
+    expected = pd.get_dummies(dataset, columns=['track_genre', 'mode', 'key']).reindex(columns=SCORED_COLUMNS, fill_value=0)
+    assert store.encoded.shape == (len(dataset), len(SCORED_COLUMNS))
+    assert np.allclose(store.encoded, expected.to_numpy(dtype=np.float32))
+
+
+def test_encode_frame_ignores_unknown_categories():
+    frame = make_dataset(3)
+    frame.loc[0, 'track_genre'] = 'Polka'
+    frame.loc[1, 'key'] = -1
+    encoded = encode_frame(frame)
+    assert encoded[0, :len(GENRE_COLUMNS)].sum() == 0
+    assert encoded[1, KEY_OFFSET:KEY_OFFSET + 12].sum() == 0
+    assert encoded[2, :AUDIO_OFFSET].sum() == 3
+
+
+def test_exclude_tracks(store):
+    rows = store.genre_rows('Jazz')
+    excluded = list(store.track_ids[rows[:5]]) + ['not in store']
+    remaining = store.exclude_tracks(rows, excluded)
+    assert len(remaining) == len(rows) - 5
+    assert not set(store.track_ids[remaining]) & set(excluded)
+
+
+def test_score_chunks_match_one_pass(store):
+    rows = store.genre_rows(['Jazz', 'Rock'])
+    queries = store.encoded[:2]
+    genre_weights = np.stack([genre_weight_vector({'Jazz': 0.6, 'default': 0.2})] * 2)
+    expected = weighted_cosine_many(store.encoded[rows], store.feature_sqnorms[rows], store.schema_genre_codes[rows], genre_weights, queries)
+
+    chunks = list(store.score_chunks(rows, genre_weights, queries, chunk_size=32))
+    assert all(len(chunk_rows) <= 32 for _, chunk_rows, _ in chunks)
+    assert np.array_equal(np.concatenate([chunk_rows for _, chunk_rows, _ in chunks]), rows)
+    assert np.array_equal(np.concatenate([scores for _, _, scores in chunks]), expected)
+
+
+def test_track_in_several_genres_keeps_every_row():
+    dataset = make_dataset(20)
+    dataset.loc[:, 'track_genre'] = 'Rock'
+    dataset.loc[[3, 10], 'track_genre'] = 'Jazz'
+    both = dataset.loc[[3]].assign(track_genre='Rock') # rec_dataset lists id_3 under Jazz and Rock
+    store = FeatureStore(pd.concat([dataset, both], ignore_index=True))
+
+    assert len(store) == 21
+    assert 'id_3' in store.track_ids[store.genre_rows('Jazz')] and 'id_3' in store.track_ids[store.genre_rows('Rock')]
+    remaining = store.exclude_tracks(store.genre_rows(['Jazz', 'Rock']), ['id_3'])
+    assert len(remaining) == 19 and 'id_3' not in store.track_ids[remaining]
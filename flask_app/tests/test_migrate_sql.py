@@ -0,0 +1,95 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data', 'datasets', 'handling')))
+import threading
+import numpy as np
+import pandas as pd
+import pytest
+from migrate_sql import COLUMNS, MAX_LENGTH, Checkpoint, chunk_rows, load
+
+
+class RecordingConnection:
+    """Connection + cursor keeping committed rows in a table shared by every connection, keyed by id"""
+
+    def __init__(self, table, lock, fail_on_id=None):
+        self.table = table
+        self.lock = lock
+        self.fail_on_id = fail_on_id
+        self.pending = []
+        self.closed = False
+
+    def cursor(self):
+        return self
+
+    def executemany(self, query, rows):
+        if any(row[0] == self.fail_on_id for row in rows):
+            raise ConnectionError("Lost connection to MySQL server")
+        self.pending.extend(rows)
+
+    def commit(self):
+        with self.lock:
+            for row in self.pending:
+                self.table.setdefault(row[0], row) # ON DUPLICATE KEY UPDATE id = id
+        self.pending = []
+
+    def close(self):
+        self.closed = True
+
+
+def make_csv_frame(num_rows=230, seed=0):
+    rng = np.random.default_rng(seed)
+    frame = pd.DataFrame({column: rng.random(num_rows) for column in COLUMNS})
+    for column in ('artists', 'track_name', 'track_id', 'track_genre'):
+        frame[column] = [f'{column}_{i}' for i in range(num_rows)]
+    frame['popularity'] = rng.integers(0, 100, num_rows)
+    return frame
+
+
+def chunks_of(frame, size):
+    return (frame.iloc[start:start + size] for start in range(0, len(frame), size))
+
+
+def test_chunk_rows_ids_nulls_and_truncation():
+    frame = make_csv_frame(10)
+    frame.loc[3, 'energy'] = np.nan
+    frame.loc[4, 'artists'] = np.nan
+    frame.loc[5, 'track_name'] = 'x' * 300
+    frame.loc[6, 'track_name'] = 12345 # Numeric names come back from read_csv as they were written
+    rows = chunk_rows(frame.iloc[2:8])
+
+    assert [row[0] for row in rows] == [3, 4, 5, 6, 7, 8]
+    assert rows[1][1 + COLUMNS.index('energy')] is None
+    assert rows[2][1 + COLUMNS.index('artists')] is None
+    assert rows[3][1 + COLUMNS.index('track_name')] == 'x' * MAX_LENGTH
+    assert rows[4][1 + COLUMNS.index('track_name')] == '12345'
+    assert type(rows[0][1 + COLUMNS.index('popularity')]) is int
+
+
+def test_load_resumes_from_the_checkpoint(tmp_path):
+    frame = make_csv_frame()
+    table, lock = {}, threading.Lock()
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'), chunk_size=50)
+
+    connections = []
+
+    def failing_connect():
+        connections.append(RecordingConnection(table, lock, fail_on_id=120)) # In chunk 2
+        return connections[-1]
+    with pytest.raises(ConnectionError):
+        load(chunks_of(frame, 50), checkpoint, connect=failing_connect, workers=1, batch_size=20)
+    # Chunks after the failing one may have been queued already and committed out of order
+    assert {0, 1} <= checkpoint.done and 2 not in checkpoint.done
+    assert len(table) == sum(len(frame.iloc[50 * number:50 * number + 50]) for number in checkpoint.done)
+    assert all(connection.closed for connection in connections)
+
+    resumed = Checkpoint(str(tmp_path / 'checkpoint.json'), chunk_size=50)
+    assert resumed.done == checkpoint.done
+    loaded = len(table)
+    rows = load(chunks_of(frame, 50), resumed, connect=lambda: RecordingConnection(table, lock), workers=3, batch_size=20)
+    assert rows == 230 - loaded and resumed.done == {0, 1, 2, 3, 4}
+    assert sorted(table) == list(range(1, 231))
+    assert table[230][1 + COLUMNS.index('track_id')] == 'track_id_229'
+
+    # A checkpoint from another chunk size doesn't line up with these chunks
+    assert Checkpoint(str(tmp_path / 'checkpoint.json'), chunk_size=100).done == set()
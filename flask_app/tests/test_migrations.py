@@ -0,0 +1,170 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+import re
+import pytest
+import mysql.connector
+from migrations import MIGRATIONS, apply, rollback, explain, table_indexes
+
+
+class SchemaCursor:
+    """Cursor over an in-memory catalogue of indexes, understands the statements migrations issues"""
+
+    def __init__(self, indexes, fail_on=None):
+        self.indexes = indexes # {table: {index name: (column, ...)}}
+        self.versions = {}
+        self.fail_on = fail_on
+        self.ddl = []
+        self._rows = []
+
+    def execute(self, query, params=()):
+        query = ' '.join(query.split())
+        self._rows = []
+        if query.startswith('SELECT version FROM schema_migrations'):
+            self._rows = [(version,) for version in self.versions]
+        elif 'information_schema.statistics' in query:
+            self._rows = [(name, column) for name, columns in self.indexes.get(params[0], {}).items() for column in columns]
+        elif query.startswith('INSERT INTO schema_migrations'):
+            self.versions[params[0]] = params[1]
+        elif query.startswith('DELETE FROM schema_migrations'):
+            del self.versions[params[0]]
+        elif query.startswith('ALTER TABLE'):
+            table, action, name = re.match(r"ALTER TABLE `(\w+)` (ADD|DROP) INDEX `(\w+)`", query).groups()
+            if name == self.fail_on:
+                raise mysql.connector.errors.OperationalError("Lost connection to MySQL server during query")
+            self.ddl.append((action, table, name))
+            if action == 'ADD':
+                self.indexes.setdefault(table, {})[name] = tuple(re.findall(r"`(\w+)`", query.split('(', 1)[1].split(')')[0]))
+            else:
+                del self.indexes[table][name]
+
+    def fetchall(self):
+        return self._rows
+
+
+def base_indexes():
+    return {
+        'rec_dataset': {'PRIMARY': ('id',)},
+        'users': {'PRIMARY': ('unique_id',)}, # Already keyed on unique_id
+        'user_top_tracks': {'PRIMARY': ('id',), 'uq_user_track': ('unique_id', 'track_id')},
+    }
+
+
+def created_indexes(cursor):
+    return {(action, table, name) for action, table, name in cursor.ddl if action == 'ADD'}
+
+
+def test_apply_skips_covered_indexes_and_is_idempotent():
+    cursor = SchemaCursor(base_indexes())
+    assert apply(cursor) == [1, 2]
+    assert set(cursor.versions) == {1, 2}
+    created = {name for _, _, name in created_indexes(cursor)}
+    assert created == {index.name for migration in MIGRATIONS for index in migration.indexes} - {
+        'idx_users_unique_id', 'idx_user_top_tracks_unique_id'}
+    assert table_indexes(cursor, 'rec_dataset')['idx_rec_dataset_genre_artists'] == ('track_genre', 'artists')
+
+    ddl = len(cursor.ddl)
+    assert apply(cursor) == [] and len(cursor.ddl) == ddl
+
+
+def test_apply_resumes_after_a_failure_part_way():
+    cursor = SchemaCursor(base_indexes(), fail_on='idx_rec_dataset_track_id')
+    with pytest.raises(mysql.connector.errors.OperationalError):
+        apply(cursor)
+    assert cursor.versions == {} and 'idx_rec_dataset_genre_artists' in cursor.indexes['rec_dataset']
+
+    cursor.fail_on = None
+    assert apply(cursor, target=1) == [1]
+    # The two indexes built before the failure are found, not built again
+    assert [name for action, _, name in cursor.ddl if action == 'ADD'].count('idx_rec_dataset_genre_artists') == 1
+    assert apply(cursor) == [2]
+
+
+def test_rollback_drops_only_created_indexes():
+    cursor = SchemaCursor(base_indexes())
+    apply(cursor)
+    assert rollback(cursor, target=1) == [2]
+    assert set(cursor.versions) == {1}
+    assert 'idx_playlists_unique_id_playlist_id' not in cursor.indexes['playlists']
+    assert 'idx_rec_dataset_track_id' in cursor.indexes['rec_dataset']
+
+    assert rollback(cursor) == [1] and rollback(cursor) == []
+    assert cursor.indexes == {**base_indexes(), 'user_top_artists': {}, 'recently_played': {}, 'playlists': {}}
+
+
+# EXPLAIN check against a real server, e.g. a local container:
+#   docker run -d -p 3306:3306 -e MYSQL_ROOT_PASSWORD=test -e MYSQL_DATABASE=t4_migrations mysql:8
+#   MYSQL_TEST_DATABASE=t4_migrations MYSQL_TEST_USER=root MYSQL_TEST_PASSWORD=test pytest tests/test_migrations.py
+# The tables are created from scratch in that database, never point it at real data.
+SCRATCH_TABLES = {
+    'rec_dataset': """
+        id INT AUTO_INCREMENT PRIMARY KEY, artists VARCHAR(255), track_name VARCHAR(255), track_id VARCHAR(255),
+        popularity INT, danceability FLOAT, track_genre VARCHAR(255)
+    """,
+    'append_data': "artists VARCHAR(255), track_name VARCHAR(255), track_id VARCHAR(255), track_genre VARCHAR(255)",
+    'users': "id INT AUTO_INCREMENT PRIMARY KEY, unique_id VARCHAR(255), display_name VARCHAR(255), rec_count INT DEFAULT 0",
+    'user_top_tracks': """
+        id INT AUTO_INCREMENT PRIMARY KEY, unique_id VARCHAR(255), track_id VARCHAR(255), track_name VARCHAR(255),
+        short_term_rank INT, UNIQUE KEY uq_user_track (unique_id, track_id)
+    """,
+    'user_top_artists': "unique_id VARCHAR(255), artist_id VARCHAR(255), artist_name VARCHAR(255), short_term_rank INT",
+    'recently_played': "unique_id VARCHAR(255), track_id VARCHAR(255), track_name VARCHAR(255), artist_name VARCHAR(255)",
+    'playlists': """
+        playlist_id VARCHAR(255), name VARCHAR(255), image_url VARCHAR(255), owner_id VARCHAR(255),
+        unique_id VARCHAR(255)
+    """,
+}
+
+
+@pytest.fixture(scope='module')
+def mysql_cursor():
+    if not os.environ.get('MYSQL_TEST_DATABASE'):
+        pytest.skip("MYSQL_TEST_DATABASE not set, no scratch MySQL database to EXPLAIN against")
+    connection = mysql.connector.connect(
+        host=os.environ.get('MYSQL_TEST_HOST', '127.0.0.1'),
+        port=int(os.environ.get('MYSQL_TEST_PORT', 3306)),
+        user=os.environ.get('MYSQL_TEST_USER', 'root'),
+        password=os.environ.get('MYSQL_TEST_PASSWORD', ''),
+        database=os.environ['MYSQL_TEST_DATABASE'],
+    )
+    cursor = connection.cursor()
+    for table, columns in SCRATCH_TABLES.items():
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+        cursor.execute(f"CREATE TABLE {table} ({columns})")
+    cursor.execute("DROP TABLE IF EXISTS schema_migrations")
+
+    # Enough rows, spread over enough genres / artists / users, that the planner prefers an index when it has one
+    cursor.executemany("INSERT INTO rec_dataset (artists, track_name, track_id, popularity, danceability, track_genre) VALUES (%s, %s, %s, %s, %s, %s)",
+                       [(f'artist_{i % 2000}', f'track_{i}', f'id_{i}', i % 100, 0.5, f'genre_{i % 100}') for i in range(20000)])
+    cursor.executemany("INSERT INTO append_data (artists, track_name, track_id, track_genre) VALUES (%s, %s, %s, %s)",
+                       [(f'artist_{i}', f'track_{i}', f'id_{i * 7}', 'genre_0') for i in range(100)])
+    for table, columns in (('users', 'unique_id, display_name'), ('user_top_tracks', 'unique_id, track_id'),
+                           ('user_top_artists', 'unique_id, artist_id'), ('recently_played', 'unique_id, track_id'),
+                           ('playlists', 'unique_id, playlist_id')):
+        cursor.executemany(f"INSERT INTO {table} ({columns}) VALUES (%s, %s)", [(f'user_{i % 500}', f'item_{i}') for i in range(5000)])
+    connection.commit()
+    for table in SCRATCH_TABLES:
+        cursor.execute(f"ANALYZE TABLE {table}")
+        cursor.fetchall()
+
+    yield cursor
+    for table in list(SCRATCH_TABLES) + ['schema_migrations']:
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+    cursor.close()
+    connection.close()
+
+
+def test_hot_queries_use_indexes_once_migrated(mysql_cursor):
+    _, full_scans = explain(mysql_cursor)
+    assert full_scans # Sanity check: without the indexes the catalogue is scanned
+
+    assert apply(mysql_cursor) == [1, 2]
+    for table in SCRATCH_TABLES:
+        mysql_cursor.execute(f"ANALYZE TABLE {table}")
+        mysql_cursor.fetchall()
+    plans, full_scans = explain(mysql_cursor)
+    assert full_scans == [], plans
+
+    assert rollback(mysql_cursor) == [2, 1]
+    assert not any(name.startswith('idx_') for table in SCRATCH_TABLES for name in table_indexes(mysql_cursor, table))
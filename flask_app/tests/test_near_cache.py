@@ -0,0 +1,80 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+import threading
+import time
+import pytest
+from near_cache import NearCache, MISSING
+
+
+def test_lru_evicts_to_the_byte_budget():
+    cache = NearCache(max_bytes=100, policy='lru')
+    cache.set('a', 'A', 40)
+    cache.set('b', 'B', 40)
+    assert cache.get('a') == 'A' # b is now least recently used
+    cache.set('c', 'C', 40)
+
+    assert cache.get('b') is MISSING and cache.get('a') == 'A' and cache.get('c') == 'C'
+    cache.set('huge', 'H', 101)
+    assert 'huge' not in cache and len(cache) == 2
+
+    stats = cache.stats()
+    assert stats['bytes'] == 80 and stats['evictions'] == 1 and stats['oversized'] == 1
+    assert stats['hits'] == 3 and stats['misses'] == 2
+
+    assert cache.delete_prefix('c') == 1 and len(cache) == 1 and cache.stats()['bytes'] == 40
+
+
+def test_lfu_keeps_the_frequently_read():
+    cache = NearCache(max_bytes=100, policy='lfu')
+    cache.set('popular', 1, 40)
+    cache.set('rare', 2, 40)
+    for _ in range(3):
+        cache.get('popular')
+    cache.get('rare')
+    cache.set('new', 3, 40) # rare has fewer hits than popular, new isn't counted yet
+
+    assert cache.get('rare') is MISSING and cache.get('popular') == 1
+    cache.set('newer', 4, 40) # new and newer tie at 0 hits against popular's 4: new goes first
+    assert cache.get('new') is MISSING and cache.get('newer') == 4
+
+
+def test_entries_expire_with_their_ttl():
+    cache = NearCache(max_bytes=100)
+    cache.set('short', 1, 10, ttl=0.05)
+    cache.set('forever', 2, 10)
+    assert cache.get('short') == 1
+    time.sleep(0.06)
+    assert cache.get('short') is MISSING and cache.get('forever') == 2
+    assert cache.metrics['expired'] == 1 and cache.stats()['bytes'] == 10
+
+
+def test_fill_skips_values_invalidated_while_loading():
+    cache = NearCache(max_bytes=100)
+    loading, release = threading.Event(), threading.Event()
+
+    def slow_load():
+        loading.set()
+        release.wait(5)
+        return {'key': ('old', 10, None), 'other': ('fresh', 10, None)}
+    result = []
+    thread = threading.Thread(target=lambda: result.append(cache.fill_many(['key', 'other'], lambda keys: slow_load())))
+    thread.start()
+    assert loading.wait(5)
+    cache.invalidate(['key']) # Another worker overwrote the key while the read was in flight
+    release.set()
+    thread.join()
+
+    assert result == [{'key': 'old', 'other': 'fresh'}]
+    assert cache.get('key') is MISSING and cache.get('other') == 'fresh'
+    loaded = cache.fill_many(['key', 'absent'], lambda keys: {'key': ('new', 10, 60)})
+    assert loaded == {'key': 'new', 'absent': None} and cache.get('key') == 'new' and 'absent' not in cache
+
+    cache.invalidate(None) # FLUSHDB
+    assert len(cache) == 0 and cache.metrics['invalidations'] == 1
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        NearCache(policy='fifo')
@@ -0,0 +1,58 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+import pytest
+import numpy as np
+from sklearn.metrics.pairwise import cosine_similarity
+from feature_schema import NUM_FEATURES, SCORED
+from playlist_index import PlaylistVectorIndex
+
+
+@pytest.fixture
+def vectors():
+    rng = np.random.default_rng(0)
+    ids = np.array([f'playlist_{i}' for i in range(200)], dtype=object)
+    return ids, rng.random((200, NUM_FEATURES)).astype(np.float32)
+
+
+def test_similar_matches_filtered_cosine(vectors):
+    ids, matrix = vectors
+    index = PlaylistVectorIndex(ids, matrix)
+    query = matrix[5]
+    excluded = ['playlist_5', 'playlist_7', 'not stored']
+
+    keep = ~np.isin(ids, excluded)
+    similarity = cosine_similarity(matrix[keep][:, SCORED], query[SCORED].reshape(1, -1))[:, 0]
+    expected = ids[keep][np.argsort(-similarity, kind='stable')[:9]].tolist()
+
+    assert index.similar(query, excluded) == expected
+
+
+def test_queries_never_modify_the_index(vectors):
+    ids, matrix = vectors
+    index = PlaylistVectorIndex(ids, matrix)
+    before = index.matrix.copy()
+    index.similar(matrix[0], list(ids[:50]))
+    assert np.array_equal(index.matrix, before)
+    assert not index.tombstones.any()
+    assert len(index) == 200
+
+
+def test_tombstoned_and_excluded_playlists_are_never_returned(vectors):
+    ids, matrix = vectors
+    index = PlaylistVectorIndex(ids[:12], matrix[:12])
+    index.remove('playlist_3')
+    assert 'playlist_3' not in index and len(index) == 11
+
+    result = index.similar(matrix[3], ['playlist_0', 'playlist_1'], k=20)
+    assert len(result) == 9
+    assert not {'playlist_0', 'playlist_1', 'playlist_3'} & set(result)
+
+
+def test_similar_many_matches_similar(vectors):
+    ids, matrix = vectors
+    index = PlaylistVectorIndex(ids, matrix)
+    excluded = [['playlist_1'], [], ids[:100]]
+    expected = [index.similar(matrix[i], excluded[i]) for i in range(3)]
+    assert index.similar_many(matrix[:3], excluded) == expected
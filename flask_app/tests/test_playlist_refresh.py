@@ -0,0 +1,91 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+import numpy as np
+from feature_schema import NUM_FEATURES
+from playlist_index import PlaylistVectorIndex
+from playlist_refresh import PlaylistVectorRefresher
+
+
+class StreamStore:
+    """SessionStore's playlist vector stream methods over a list, the Redis side is covered in test_session_store.py"""
+
+    def __init__(self):
+        self.entries = []
+        self.trimmed = 0
+
+    def publish_playlist_vector(self, playlist_id, vector):
+        seq = self.trimmed + len(self.entries) + 1
+        self.entries.append((f'{seq}-0', seq, playlist_id, np.asarray(vector, dtype=np.float32)))
+
+    def trim(self, count):
+        self.entries = self.entries[count:]
+        self.trimmed += count
+
+    def get_playlist_vector_watermark(self):
+        if not self.entries:
+            return '0-0', self.trimmed
+        return self.entries[-1][0], self.entries[-1][1]
+
+    def get_playlist_vector_updates(self, last_id, count=500):
+        last = int(last_id.split('-')[0])
+        return [entry for entry in self.entries if entry[1] > last][:count]
+
+
+class PlaylistTable:
+    def __init__(self):
+        self.vectors = {}
+
+    def get_playlist_vectors(self):
+        ids = list(self.vectors)
+        return np.array(ids, dtype=object), np.array([self.vectors[i] for i in ids], dtype=np.float32).reshape(len(ids), NUM_FEATURES)
+
+
+def store_vector(table, stream, playlist_id, vector):
+    table.vectors[playlist_id] = vector
+    stream.publish_playlist_vector(playlist_id, vector)
+
+
+def test_upsert_appends_and_overwrites_in_place():
+    rng = np.random.default_rng(0)
+    index = PlaylistVectorIndex(np.array(['a', 'b'], dtype=object), rng.random((2, NUM_FEATURES)))
+    for i in range(100):
+        assert index.upsert(f'new_{i}', rng.random(NUM_FEATURES))
+    vector = rng.random(NUM_FEATURES)
+    assert not index.upsert('a', vector)
+
+    assert len(index) == 102
+    assert index.similar(vector, k=1) == ['a']
+    assert index.similar(vector, ['a'], k=1) != ['a']
+
+
+def test_refresh_replays_other_workers_vectors():
+    rng = np.random.default_rng(1)
+    table, stream = PlaylistTable(), StreamStore()
+    store_vector(table, stream, 'seed', rng.random(NUM_FEATURES))
+    refresher = PlaylistVectorRefresher.load(stream, table, interval=3600)
+
+    vector = rng.random(NUM_FEATURES)
+    store_vector(table, stream, 'new', vector) # Written by another worker
+    assert refresher.refresh() == 0 # Throttled
+    assert refresher.refresh(force=True) == 1
+    assert refresher.index.similar(vector, k=1) == ['new']
+
+    stats = refresher.stats()
+    assert stats['index_rows'] == 2 and stats['playlists_appended'] == 1 and stats['full_reloads'] == 0
+
+
+def test_trimmed_stream_triggers_full_reload():
+    rng = np.random.default_rng(2)
+    table, stream = PlaylistTable(), StreamStore()
+    refresher = PlaylistVectorRefresher.load(stream, table, interval=0)
+
+    for i in range(5):
+        store_vector(table, stream, f'playlist_{i}', rng.random(NUM_FEATURES))
+    stream.trim(3)
+    refresher.refresh()
+
+    assert refresher.metrics['full_reloads'] == 1
+    assert len(refresher.index) == 5
+    assert refresher.refresh() == 0
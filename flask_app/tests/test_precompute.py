@@ -0,0 +1,112 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+import pytest
+import numpy as np
+import pandas as pd
+from feature_store import FeatureStore
+from feature_schema import GENRES, GENRE_SLICE, NUM_FEATURES, SCORED
+from scoring import weighted_cosine, genre_weight_vector, top_k
+from rec_engine import RecEngine
+from precompute import PrecomputedRecs, precompute
+
+
+def make_dataset(num_tracks=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'artists': [f'artist_{i}' for i in rng.integers(0, 100, num_tracks)],
+        'track_name': [f'track_{i}' for i in range(num_tracks)],
+        'track_id': [f'id_{i}' for i in range(num_tracks)],
+        'popularity': rng.integers(0, 100, num_tracks),
+        'duration_ms': rng.integers(60000, 400000, num_tracks),
+        'danceability': rng.random(num_tracks),
+        'energy': rng.random(num_tracks),
+        'key': rng.integers(0, 12, num_tracks),
+        'loudness': rng.uniform(-30, 0, num_tracks),
+        'mode': rng.integers(0, 2, num_tracks),
+        'speechiness': rng.random(num_tracks),
+        'acousticness': rng.random(num_tracks),
+        'instrumentalness': rng.random(num_tracks),
+        'liveness': rng.random(num_tracks),
+        'valence': rng.random(num_tracks),
+        'tempo': rng.uniform(60, 200, num_tracks),
+        'time_signature': rng.integers(3, 6, num_tracks).astype(float),
+        'track_genre': rng.choice(GENRES[:5], num_tracks),
+    })
+
+
+def make_vectors(num_playlists=40, seed=1):
+    rng = np.random.default_rng(seed)
+    vectors = rng.random((num_playlists, NUM_FEATURES)).astype(np.float32)
+    vectors[:, GENRE_SLICE] = 0
+    vectors[:, GENRE_SLICE.start:GENRE_SLICE.start + 5] = rng.dirichlet(np.ones(5), num_playlists)
+    vectors[-1, GENRE_SLICE] = 0 # No genres, left to live scoring
+    return np.array([f'playlist_{i}' for i in range(num_playlists)], dtype=object), vectors
+
+
+@pytest.fixture(scope='module')
+def engine():
+    return RecEngine(None, 'test', None, FeatureStore(make_dataset()))
+
+
+@pytest.fixture(scope='module')
+def table(engine):
+    playlist_ids, vectors = make_vectors()
+    return precompute(engine, playlist_ids, vectors, per_genre=40, num_neighbours=12, batch_size=16)
+
+
+def test_tracks_are_the_exact_per_genre_top(engine, table):
+    store = engine.feature_store
+    vector = table.vectors[3]
+    full_vector = np.zeros(NUM_FEATURES, dtype=np.float32)
+    full_vector[SCORED] = vector
+    rows, similarity, _ = table.lookup('playlist_3', full_vector)
+
+    top_genres, top_ratios = engine.get_top_genres(full_vector)
+    weights = genre_weight_vector(engine.create_weights(top_genres, top_ratios))
+    expected = []
+    for genre in top_genres:
+        genre_rows = store.genre_rows(genre)
+        scores = weighted_cosine(store.encoded[genre_rows], store.feature_sqnorms[genre_rows], store.schema_genre_codes[genre_rows], weights, vector)
+        expected.append(genre_rows[top_k(scores, 40)])
+    assert np.array_equal(rows, np.concatenate(expected))
+    assert np.all(np.diff(similarity[:40]) <= 0)
+
+
+def test_neighbours_exclude_the_playlist_itself(table):
+    _, _, neighbour_ids = table.lookup('playlist_0', np.pad(table.vectors[0], (0, 2)))
+    assert len(neighbour_ids) == 12
+    assert 'playlist_0' not in neighbour_ids
+
+
+def test_missing_stale_and_genreless_playlists_fall_back(table):
+    vector = np.pad(table.vectors[5], (0, 2))
+    assert table.lookup('not stored', vector) is None
+    assert table.lookup('playlist_5', vector * 2) is None # Vector changed since the run
+    assert table.lookup('playlist_39', np.pad(table.vectors[39], (0, 2))) is None # Genreless, never precomputed
+    assert table.metrics['misses'] >= 1 and table.metrics['stale_vectors'] >= 1
+
+
+def test_save_load_round_trip(engine, table, tmp_path):
+    path = str(tmp_path / 'precomputed' / 'playlist_recs.npz')
+    table.save(path)
+    loaded = PrecomputedRecs.load_for(engine.feature_store, path)
+    assert loaded.playlist_ids.tolist() == table.playlist_ids.tolist()
+    assert np.array_equal(loaded.tracks, table.tracks) and np.array_equal(loaded.neighbours, table.neighbours)
+
+    other_store = FeatureStore(make_dataset(num_tracks=1999))
+    assert PrecomputedRecs.load_for(other_store, path) is None
+    assert PrecomputedRecs.load_for(engine.feature_store, str(tmp_path / 'missing.npz')) is None
+
+
+def test_recommend_precomputed_drops_playlist_tracks(engine, table):
+    vector = np.pad(table.vectors[7], (0, 2))
+    rows, similarity, _ = table.lookup('playlist_7', vector)
+    playlist_track_ids = set(engine.feature_store.track_ids[rows[:10]])
+    top_genres, top_ratios = engine.get_top_genres(vector)
+
+    recommended_ids = engine.recommend_precomputed(rows, similarity, playlist_track_ids, top_genres, top_ratios)
+    assert len(recommended_ids) == 30
+    assert len(set(recommended_ids)) == 30
+    assert not playlist_track_ids & set(recommended_ids)
@@ -0,0 +1,101 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+import numpy as np
+import pandas as pd
+from sklearn.metrics.pairwise import cosine_similarity
+from feature_schema import GENRES, GENRE_SLICE, KEY_OFFSET, NUM_SCORED
+from scoring import top_k, grouped_top_k, weighted_cosine, weighted_cosine_many, genre_weight_vector, RunningTopK
+
+
+def test_top_k_matches_nlargest_with_ties():
+    rng = np.random.default_rng(0)
+    scores = rng.integers(0, 20, 1000).astype(np.float32) # Lots of ties
+    expected = pd.Series(scores).nlargest(45).index.to_numpy()
+    assert np.array_equal(top_k(scores, 45), expected)
+    assert np.array_equal(top_k(scores[:10], 45), pd.Series(scores[:10]).nlargest(45).index.to_numpy())
+    assert len(top_k(scores, 0)) == 0
+
+
+def test_top_k_skips_nan():
+    scores = np.array([0.5, np.nan, 0.9, np.nan, 0.1])
+    assert list(top_k(scores, 3)) == [2, 0, 4]
+
+
+def test_grouped_top_k_matches_per_genre_nlargest():
+    rng = np.random.default_rng(1)
+    df = pd.DataFrame({'similarity': rng.random(5000).round(2), 'genre': rng.integers(0, 8, 5000)})
+    wanted = [5, 2, 7]
+
+    expected = np.concatenate([df[df['genre'] == genre].nlargest(30, 'similarity').index.to_numpy() for genre in wanted])
+    assert np.array_equal(grouped_top_k(df['similarity'].to_numpy(), df['genre'].to_numpy(), wanted, 30), expected)
+
+
+def test_running_top_k_over_chunks_matches_grouped_top_k():
+    rng = np.random.default_rng(4)
+    scores = rng.integers(0, 10, 3000).astype(np.float32) # Ties across chunk boundaries
+    groups = rng.integers(0, 6, 3000)
+    ids = np.arange(3000) + 100
+    wanted = [4, 1, 5]
+
+    running = RunningTopK(wanted, 25)
+    for start in range(0, 3000, 512):
+        running.push(ids[start:start + 512], scores[start:start + 512], groups[start:start + 512])
+    top_ids, top_scores = running.result()
+
+    expected = grouped_top_k(scores, groups, wanted, 25)
+    assert np.array_equal(top_ids, ids[expected])
+    assert np.array_equal(top_scores, scores[expected])
+
+
+def test_grouped_top_k_missing_groups():
+    scores = np.array([0.3, 0.2, 0.1])
+    groups = np.array([0, -1, 0])
+    assert list(grouped_top_k(scores, groups, [0, 4], 5)) == [0, 2]
+    assert len(grouped_top_k(scores, groups, [], 5)) == 0
+
+
+def test_weighted_cosine_matches_weighted_columns_then_cosine():
+    rng = np.random.default_rng(2)
+    num_rows = 400
+    codes = rng.integers(-1, len(GENRES), num_rows) # -1: genre outside of the schema
+    matrix = np.zeros((num_rows, NUM_SCORED), dtype=np.float32)
+    matrix[codes >= 0, codes[codes >= 0]] = 1
+    matrix[:, KEY_OFFSET:] = rng.random((num_rows, NUM_SCORED - KEY_OFFSET))
+    matrix[0] = 0 # All-zero row scores 0
+    query = rng.random(NUM_SCORED).astype(np.float32)
+    weights = {GENRES[0]: 0.5, GENRES[1]: 0.3, 'default': 0.24}
+
+    # Previous path: scale the genre columns, cosine_similarity, then scale by the row's genre weight
+    genre_weights = genre_weight_vector(weights)
+    column_weights = np.ones(NUM_SCORED, dtype=np.float32)
+    column_weights[GENRE_SLICE] = genre_weights[:-1]
+    expected = cosine_similarity(matrix * column_weights, query.reshape(1, -1))[:, 0] * genre_weights[codes]
+
+    before = matrix.copy()
+    sqnorms = np.einsum('ij,ij->i', matrix[:, KEY_OFFSET:], matrix[:, KEY_OFFSET:])
+    scores = weighted_cosine(matrix, sqnorms, codes, genre_weights, query)
+    assert scores.dtype == np.float32
+    assert np.allclose(scores, expected, atol=1e-6)
+    assert scores[0] == 0
+    assert np.array_equal(matrix, before)
+
+
+def test_weighted_cosine_many_matches_one_query_at_a_time():
+    rng = np.random.default_rng(3)
+    num_rows = 300
+    codes = rng.integers(-1, len(GENRES), num_rows)
+    matrix = np.zeros((num_rows, NUM_SCORED), dtype=np.float32)
+    matrix[codes >= 0, codes[codes >= 0]] = 1
+    matrix[:, KEY_OFFSET:] = rng.random((num_rows, NUM_SCORED - KEY_OFFSET))
+    sqnorms = np.einsum('ij,ij->i', matrix[:, KEY_OFFSET:], matrix[:, KEY_OFFSET:])
+    queries = rng.random((3, NUM_SCORED)).astype(np.float32)
+    queries[2] = 0 # All-zero query scores 0
+    genre_weights = np.stack([genre_weight_vector({GENRES[i]: 0.5, 'default': 0.1 * i}) for i in range(3)])
+
+    scores = weighted_cosine_many(matrix, sqnorms, codes, genre_weights, queries)
+    assert scores.shape == (num_rows, 3) and scores.dtype == np.float32
+    for i in range(3):
+        assert np.allclose(scores[:, i], weighted_cosine(matrix, sqnorms, codes, genre_weights[i], queries[i]), atol=1e-6)
+    assert not scores[:, 2].any()
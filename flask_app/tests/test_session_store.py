@@ -6,21 +6,31 @@ import pytest
 import redis
 import random 
 import pandas
+import numpy as np
 from collections import Counter
 import string
 from session_store import SessionStore
+from feature_schema import NUM_FEATURES
 from datetime import datetime, timedelta
 import time
+import threading
 
 @pytest.fixture(scope='module')
 def local_redis_pool():
-    """Create a Redis connection pool for testing"""
-    return redis.ConnectionPool(
+    """Create a Redis connection pool for testing, to an in-process fakeredis server when no local Redis answers"""
+    pool = redis.ConnectionPool(
         host=os.environ.get('REDIS_HOST', 'localhost'),
         port=int(os.environ.get('REDIS_PORT', 6379)),
         password=os.environ.get('REDIS_PASSWORD'),
         db=int(os.environ.get('REDIS_DB', 0))
     )
+    try:
+        redis.Redis(connection_pool=pool).ping()
+        return pool
+    except redis.ConnectionError:
+        pool.disconnect()
+    fakeredis = pytest.importorskip('fakeredis', reason="No Redis server answers and fakeredis isn't installed")
+    return redis.ConnectionPool(connection_class=fakeredis.FakeRedisConnection, server=fakeredis.FakeServer())
 
 @pytest.fixture(scope='module')
 def session_store(local_redis_pool):
@@ -176,6 +186,224 @@ def test_weekly_reset(session_store, monkeypatch):
 #     assert recs is None, f"Expected None, but got {recs}"
 
 
+def test_playlist_vector_stream(session_store):
+    session_store.redis.delete(SessionStore.PLAYLIST_VECTOR_STREAM, SessionStore.PLAYLIST_VECTOR_SEQ)
+    last_id, last_seq = session_store.get_playlist_vector_watermark()
+    assert (last_id, last_seq) == ('0-0', 0)
+
+    vectors = np.random.default_rng(0).random((3, NUM_FEATURES)).astype(np.float32)
+    for i, vector in enumerate(vectors):
+        session_store.publish_playlist_vector(f'playlist_{i}', vector)
+
+    updates = session_store.get_playlist_vector_updates(last_id)
+    assert [seq for _, seq, _, _ in updates] == [1, 2, 3]
+    assert [playlist_id for _, _, playlist_id, _ in updates] == ['playlist_0', 'playlist_1', 'playlist_2']
+    assert np.array_equal(updates[1][3], vectors[1])
+
+    # Entries after a watermark only
+    assert [seq for _, seq, _, _ in session_store.get_playlist_vector_updates(updates[0][0])] == [2, 3]
+    assert session_store.get_playlist_vector_watermark() == (updates[-1][0], 3)
+
+
+def test_near_cache_mirrors_ttl_and_invalidation(local_redis_pool):
+    client = redis.Redis(connection_pool=local_redis_pool)
+    try:
+        client.ping()
+    except redis.ConnectionError:
+        pytest.skip("No Redis server answers")
+    try:
+        client.execute_command('CLIENT', 'TRACKING', 'OFF')
+    except redis.ResponseError:
+        pytest.skip("Server without client side tracking (e.g. fakeredis)")
+    reader = SessionStore(redis_pool=local_redis_pool, tracking=True)
+    writer = SessionStore(redis_pool=local_redis_pool) # Another worker
+    writer.set_user_top_data('near_cache_test:top', {'version': 1})
+    assert reader.get_data('near_cache_test:top') == {'version': 1} # Starts tracking, then reads Redis
+
+    deadline = time.time() + 5
+    while reader.invalidation.metrics['messages'] == 0 and time.time() < deadline: # Tracking is up
+        writer.set_user_top_data('near_cache_test:other', {})
+        time.sleep(0.05)
+    assert reader.invalidation.metrics['messages'] > 0
+    assert reader.get_data('near_cache_test:top') == {'version': 1}
+    entry_expiry = reader.cache._entries['near_cache_test:top'][2]
+    assert 86300 < entry_expiry - time.monotonic() <= 86400 # The key's remaining TTL
+
+    writer.set_user_top_data('near_cache_test:top', {'version': 2})
+    deadline = time.time() + 5
+    while 'near_cache_test:top' in reader.cache._entries and time.time() < deadline:
+        time.sleep(0.01)
+    assert reader.get_data('near_cache_test:top') == {'version': 2}
+
+
+
+class CountingConnection:
+    """Counts network round trips: a pipeline, transaction or not, is sent in one go"""
+    round_trips = 0
+
+    def send_packed_command(self, command, check_health=True):
+        CountingConnection.round_trips += 1
+        super().send_packed_command(command, check_health)
+
+
+def load_scripts(store):
+    """Load the store's Lua scripts as a long running server has them, so each call is one EVALSHA"""
+    for script in (store._push_random_recs, store._take_random_recs, store._publish_playlist_vector, store._remove_user_keys):
+        store.redis.script_load(script.script)
+
+
+def counting_pool(pool):
+    """A pool to the same (real or fake) server as pool whose connections count their round trips"""
+    connection_class = type('Counting' + pool.connection_class.__name__, (CountingConnection, pool.connection_class), {})
+    return redis.ConnectionPool(connection_class=connection_class, **pool.connection_kwargs)
+
+
+def test_recommend_reads_and_writes_in_two_round_trips(local_redis_pool):
+    pool = counting_pool(local_redis_pool)
+    writer = SessionStore(redis_pool=pool)
+    vector = np.random.default_rng(0).random(NUM_FEATURES).astype(np.float32)
+    writer.set_user_top_data('batch_test:top_tracks', ['t1'])
+    writer.set_user_top_data('batch_test:top_artists', ['a1'])
+    writer.set_vector('batch_test:pl:public:playlist_vector', vector)
+    writer.set_prev_rec('batch_test:pl:playlist', {'track_ids': ['t1'], 'recommended_ids': ['r1'], 'playlist_rec_ids': []})
+    writer.redis.delete('batch_test:missing')
+    load_scripts(writer)
+
+    store = SessionStore(redis_pool=pool) # Another worker, its near cache empty
+    CountingConnection.round_trips = 0
+    keys = ['batch_test:top_tracks', 'batch_test:top_artists', 'batch_test:pl:public:playlist_vector', 'batch_test:pl:playlist', 'batch_test:missing']
+    reads = store.get_many(keys)
+    assert reads['batch_test:top_tracks'] == ['t1'] and reads['batch_test:missing'] is None
+    assert np.array_equal(reads['batch_test:pl:public:playlist_vector'], vector)
+
+    with store.writes() as writes:
+        writes.set_prev_rec('batch_test:pl:playlist', {'track_ids': ['t1'], 'recommended_ids': ['r1', 'r2'], 'playlist_rec_ids': []})
+        writes.set_random_recs(['r1', 'r2'])
+        writes.update_total_recs(2)
+    assert CountingConnection.round_trips == 2
+
+    # Later reads of the same keys come from the near cache
+    assert store.get_many(keys[:4])['batch_test:pl:playlist']['recommended_ids'] == ['r1', 'r2']
+    assert CountingConnection.round_trips == 2
+    assert 86300 < store.redis.ttl('batch_test:pl:playlist') <= 86400
+
+
+def test_remove_user_data_deletes_registered_keys(local_redis_pool):
+    pool = counting_pool(local_redis_pool)
+    store = SessionStore(redis_pool=pool)
+    for unique_id in ('logout_test_a', 'logout_test_b'):
+        store.set_user_top_data(f'{unique_id}:top_tracks', ['t1'])
+        store.set_vector(f'{unique_id}:pl:public:playlist_vector', np.zeros(NUM_FEATURES, dtype=np.float32))
+        with store.writes() as writes:
+            writes.set_prev_rec(f'{unique_id}:pl:playlist', {'track_ids': [], 'recommended_ids': [], 'playlist_rec_ids': []})
+            writes.update_total_recs(1) # Not a user key
+    load_scripts(store)
+    assert store.redis.smembers('user_keys:logout_test_a') == {b'logout_test_a:top_tracks', b'logout_test_a:pl:public:playlist_vector', b'logout_test_a:pl:playlist'}
+    assert 86300 < store.redis.ttl('user_keys:logout_test_a') <= 86400
+
+    CountingConnection.round_trips = 0
+    store.remove_user_data('logout_test_a')
+    assert CountingConnection.round_trips == 1 # No SCAN of the keyspace
+    assert not store.redis.exists('logout_test_a:top_tracks', 'logout_test_a:pl:public:playlist_vector', 'logout_test_a:pl:playlist', 'user_keys:logout_test_a')
+    assert store.redis.exists('logout_test_b:top_tracks', 'logout_test_b:pl:playlist') == 2
+    assert 'logout_test_a:top_tracks' not in store.cache and 'logout_test_b:top_tracks' in store.cache
+
+@pytest.fixture
+def random_recs_day(local_redis_pool):
+    """A SessionStore whose random recs use their own day, set_day(name) switches to a fresh one"""
+    store = SessionStore(redis_pool=local_redis_pool)
+    days = []
+
+    def set_day(name):
+        days.append(f'test-{name}')
+        store._get_date_key = lambda: days[-1]
+        store.redis.delete(*store._get_random_recs_keys())
+    set_day('random-recs')
+    yield store, set_day
+    for day in days:
+        store._get_date_key = lambda: day
+        store.redis.delete(*store._get_random_recs_keys())
+
+
+def test_random_recs_reservoir_is_bounded_and_frozen(random_recs_day):
+    store, _ = random_recs_day
+    pool_key, seen_key, _ = store._get_random_recs_keys()
+    for batch in range(28):
+        store.set_random_recs([f'song_{batch}_{i}' for i in range(7)])
+        assert store.redis.zcard(pool_key) <= SessionStore.RANDOM_RECS_SAMPLE
+    assert int(store.redis.get(seen_key)) == 196
+    assert store.get_random_recs() is None # 4 short of a sample
+
+    store.set_random_recs([f'song_late_{i}' for i in range(30)])
+    sample = store.get_random_recs()
+    assert len(sample) == len(set(sample)) == SessionStore.RANDOM_RECS_SAMPLE
+    assert not store.redis.exists(pool_key) # The reservoir is frozen into the sample
+
+    store.set_random_recs(['song_after_sample']) # Ignored for the rest of the day
+    assert store.get_random_recs() == sample and not store.redis.exists(pool_key)
+
+
+def test_random_recs_reservoir_is_uniform(random_recs_day):
+    store, set_day = random_recs_day
+    store.RANDOM_RECS_MIN_SEEN = 1
+    random.seed(0)
+    num_songs, trials = 40, 100
+    counts = Counter()
+    for trial in range(trials):
+        set_day(f'uniform-{trial}')
+        for batch in range(4): # Later batches compete with the reservoir built by the earlier ones
+            store.set_random_recs([f'song_{i}' for i in range(batch * 10, batch * 10 + 10)])
+        counts.update(store.get_random_recs())
+
+    expected = trials * SessionStore.RANDOM_RECS_SAMPLE / num_songs
+    chi_square = sum((counts[f'song_{i}'] - expected) ** 2 / expected for i in range(num_songs))
+    assert chi_square < 72.1 # 39 degrees of freedom, p = 0.001
+
+
+def test_random_recs_reservoir_concurrent_pushes(random_recs_day, local_redis_pool):
+    store, _ = random_recs_day
+    pool_key, seen_key, _ = store._get_random_recs_keys()
+    num_threads, pushes = 8, 20
+
+    def push(thread):
+        writer = SessionStore(redis_pool=local_redis_pool)
+        writer._get_date_key = store._get_date_key
+        for push in range(pushes):
+            writer.set_random_recs([f'song_{thread}_{push}_{i}' for i in range(5)])
+    threads = [threading.Thread(target=push, args=(thread,)) for thread in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert int(store.redis.get(seen_key)) == num_threads * pushes * 5 # No lost updates
+    assert store.redis.zcard(pool_key) == SessionStore.RANDOM_RECS_SAMPLE
+
+    samples = []
+    readers = [threading.Thread(target=lambda: samples.append(store.get_random_recs())) for _ in range(num_threads)]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    assert len(samples) == num_threads and all(sample == samples[0] for sample in samples) # One frozen sample
+
+def test_scripts_are_loaded_again_after_a_flush(random_recs_day):
+    store, _ = random_recs_day
+    store.RANDOM_RECS_MIN_SEEN = 1
+    store.redis.script_flush() # e.g. Redis restarted
+    with store.writes() as writes:
+        writes.set_random_recs(['song_a'])
+        writes.set_user_top_data('script_test:top_tracks', ['t1'])
+    assert store.get_random_recs() == ['song_a']
+    assert store.get_data('script_test:top_tracks') == ['t1']
+    assert store.redis.script_exists(store._push_random_recs.sha, store._take_random_recs.sha) == [True, True]
+
+def test_sync_pending_flag(session_store):
+    session_store.set_sync_pending('sync_test')
+    assert session_store.is_sync_pending('sync_test')
+    assert 0 < session_store.redis.ttl('sync_test:sync_pending') <= SessionStore.SYNC_PENDING_TTL
+    session_store.clear_sync_pending('sync_test')
+    assert not session_store.is_sync_pending('sync_test')
 
 if __name__ == "__main__":
     pytest.main([__file__])
@@ -0,0 +1,223 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import pytest
+from spotipy import Spotify
+from spotify_client import SpotifyClient
+from spotify_fetch import RateLimitGate
+from track_cache import TrackFeatureCache, SQLiteTrackStore
+from feature_schema import TRACK_COLUMNS
+
+NUM_PLAYLISTS = 230 # 5 pages of 50
+NUM_TRACKS = 2000 # 20 pages of 100
+
+
+def playlist_track(i):
+    if i % 250 == 7:
+        return {'added_at': '2024-01-01T00:00:00Z', 'track': None} # Removed from Spotify
+    track_id = f't{i % 1900}' # The last 100 repeat earlier tracks
+    return {
+        'added_at': f'2024-{1 + i % 12:02d}-{1 + i % 28:02d}T00:00:{i % 60:02d}Z',
+        'track': {'id': track_id, 'name': f'Track {i}', 'artists': [{'name': f'Artist {i % 40}'}],
+                  'popularity': i % 100, 'explicit': i % 2 == 0, 'type': 'track'},
+    }
+
+
+def tracks_page(base, offset, limit):
+    end = min(offset + limit, NUM_TRACKS)
+    return {
+        'items': [playlist_track(i) for i in range(offset, end)],
+        'limit': limit, 'offset': offset, 'total': NUM_TRACKS,
+        'next': f'{base}/v1/playlists/pl/tracks?offset={end}&limit={limit}' if end < NUM_TRACKS else None,
+    }
+
+
+def audio_features(track_id):
+    if track_id == 't13':
+        return None # No features for this one
+    number = int(track_id[1:])
+    return {'id': track_id, 'danceability': number / 1900, 'energy': 0.5, 'key': number % 12, 'loudness': -5.0,
+            'mode': number % 2, 'speechiness': 0.1, 'acousticness': 0.2, 'instrumentalness': 0.0, 'liveness': 0.1,
+            'valence': 0.3, 'tempo': 120.0, 'duration_ms': 200000 + number, 'time_signature': 4}
+
+
+class MockSpotify(BaseHTTPRequestHandler):
+    """The Spotify Web API endpoints of a login, each answering after `latency` seconds"""
+
+    latency = 0.05
+    rate_limited = set() # Paths answering their first request with a 429
+    dropped = set() # Paths whose first request loses its connection
+    log = [] # (received at, path, status)
+
+    def do_GET(self):
+        url = urlparse(self.path)._replace(path=urlparse(self.path).path.rstrip('/'))
+        query = {key: int(values[0]) if values[0].isdigit() else values[0] for key, values in parse_qs(url.query).items()}
+        received = time.monotonic()
+        if url.path in self.rate_limited:
+            self.rate_limited.discard(url.path)
+            self.log.append((received, url.path, 429))
+            return self._send(429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}}, {'Retry-After': '1'})
+
+        if url.path in self.dropped:
+            self.dropped.discard(url.path)
+            self.close_connection = True
+            return
+
+        self.log.append((received, url.path, 200))
+        time.sleep(self.latency)
+        if url.path == '/v1/me':
+            body = {'id': 'user', 'display_name': 'User', 'email': 'user@example.com'}
+        elif url.path == '/v1/me/playlists':
+            offset, limit = query.get('offset', 0), query.get('limit', 50)
+            end = min(offset + limit, NUM_PLAYLISTS)
+            body = {
+                'items': [{'id': f'p{i}', 'name': f'Playlist {i}'} for i in range(offset, end)],
+                'limit': limit, 'offset': offset, 'total': NUM_PLAYLISTS,
+                'next': f'{self.server.base}/v1/me/playlists?offset={end}&limit={limit}' if end < NUM_PLAYLISTS else None,
+            }
+        elif url.path == '/v1/playlists/pl/tracks':
+            body = tracks_page(self.server.base, query.get('offset', 0), query.get('limit', 100))
+        elif url.path == '/v1/audio-features':
+            body = {'audio_features': [audio_features(track_id) for track_id in query['ids'].split(',')]}
+        elif url.path.startswith('/v1/me/top/'):
+            body = {'items': [{'id': f'{url.path[-1]}{i}', 'time_range': query['time_range']} for i in range(query['limit'])]}
+        else:
+            return self._send(404, {'error': {'status': 404, 'message': 'Not found'}})
+        self._send(200, body)
+
+    def _send(self, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def mock_spotify():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockSpotify)
+    server.base = f'http://127.0.0.1:{server.server_address[1]}'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+def make_client(server, max_workers=8):
+    sp = Spotify(auth='token', requests_timeout=5)
+    sp.prefix = f'{server.base}/v1/'
+    client = SpotifyClient(sp)
+    client.fetcher.gate = RateLimitGate() # Not the process-wide one, tests don't share rate limits
+    client.fetcher.max_workers = max_workers
+    return client
+
+
+def timed_login(client):
+    start_time = time.perf_counter()
+    result = client.get_user_saved_info()
+    return time.perf_counter() - start_time, result
+
+
+def test_login_fetches_in_parallel(mock_spotify):
+    serial_time, serial = timed_login(make_client(mock_spotify, max_workers=1))
+    parallel_time, parallel = timed_login(make_client(mock_spotify))
+
+    user_profile, playlists, top_artists, top_tracks = parallel
+    assert user_profile['id'] == 'user'
+    assert [playlist['id'] for playlist in playlists] == [f'p{i}' for i in range(NUM_PLAYLISTS)]
+    assert len(top_artists['short_term']['items']) == 20 and top_tracks['short_term']['items'][0]['time_range'] == 'short_term'
+    assert parallel == serial
+
+    # 8 requests one after the other vs two rounds: (profile, first page, top artists, top tracks), other pages
+    assert serial_time >= 8 * MockSpotify.latency
+    assert parallel_time < serial_time / 2
+
+
+def test_rate_limit_pauses_every_request(mock_spotify):
+    client = make_client(mock_spotify)
+    MockSpotify.log.clear()
+    MockSpotify.rate_limited.add('/v1/me/top/tracks')
+    _, (_, playlists, _, top_tracks) = timed_login(client)
+
+    assert len(playlists) == NUM_PLAYLISTS and len(top_tracks['short_term']['items']) == 20
+    assert client.fetcher.gate.metrics['rate_limited'] == 1
+
+    limited_at = next(received for received, _, status in MockSpotify.log if status == 429)
+    later = [received for received, _, _ in MockSpotify.log if received > limited_at + 0.02]
+    # The retried call and the playlist pages requested after the 429 all waited out its Retry-After
+    assert len(later) == 5 and min(later) >= limited_at + 0.9
+
+
+def test_playlist_pages_and_features_in_parallel(mock_spotify):
+    playlist = {'id': 'pl', 'tracks': tracks_page(mock_spotify.base, 0, 100)}
+    start_time = time.perf_counter()
+    serial = make_client(mock_spotify, max_workers=1).analyze_playlist(playlist)
+    serial_time = time.perf_counter() - start_time
+
+    MockSpotify.dropped.add('/v1/playlists/pl/tracks') # A lost connection is retried
+    start_time = time.perf_counter()
+    parallel = make_client(mock_spotify).analyze_playlist(playlist)
+    parallel_time = time.perf_counter() - start_time
+
+    # 1900 distinct tracks, minus 7 only ever seen removed and the one without features
+    assert len(parallel) == len(set(parallel['id'])) == 1900 - 7 - 1
+    assert list(parallel.columns) == TRACK_COLUMNS
+    assert parallel['date_added'].is_monotonic_decreasing
+    assert parallel.equals(serial)
+    row = parallel.set_index('id').loc['t42']
+    assert row['key'] == 42 % 12 and row['duration_ms'] == 200042 and row['popularity'] == 42 # Latest add of t42
+
+    # 19 pages and 19 feature chunks serialized vs a couple of rounds at 8 in flight
+    assert serial_time >= 38 * MockSpotify.latency
+    assert parallel_time < serial_time / 2
+
+    track_ids = make_client(mock_spotify).analyze_playlist(playlist, 'rec')
+    assert len(track_ids) == 1900 - 7 and set(track_ids) == set(serial['id']) | {'t13'}
+
+
+def test_feature_requests_start_between_pages(mock_spotify):
+    playlist = {'id': 'pl', 'tracks': tracks_page(mock_spotify.base, 0, 100)}
+    MockSpotify.log.clear()
+    make_client(mock_spotify, max_workers=2).analyze_playlist(playlist)
+
+    paths = [path for _, path, _ in sorted(MockSpotify.log)]
+    last_page = max(i for i, path in enumerate(paths) if path == '/v1/playlists/pl/tracks')
+    # Queued behind all 19 pages none would start before the last page, here most of them do
+    assert paths[:last_page].count('/v1/audio-features') >= 15
+
+
+def test_cached_features_skip_the_api(mock_spotify, tmp_path):
+    playlist = {'id': 'pl', 'tracks': tracks_page(mock_spotify.base, 0, 100)}
+    first_cache = TrackFeatureCache(SQLiteTrackStore(str(tmp_path / 'tracks.sqlite3'), 'test'))
+    client = make_client(mock_spotify)
+    client.track_cache = first_cache
+    first = client.analyze_playlist(playlist)
+    assert first_cache.metrics['api_tracks'] == 1900 - 7 and first_cache.metrics['feature_local_hits'] == 0
+
+    # Another worker: nothing in its own LRU, every track in the shared file except the one without features
+    cache = TrackFeatureCache(SQLiteTrackStore(str(tmp_path / 'tracks.sqlite3'), 'test'))
+    client = make_client(mock_spotify)
+    client.track_cache = cache
+    MockSpotify.log.clear()
+    second = client.analyze_playlist(playlist)
+    assert second.equals(first)
+    assert [path for _, path, _ in MockSpotify.log].count('/v1/audio-features') == 1 # t13 only
+    assert cache.metrics['feature_store_hits'] == 1900 - 7 - 1 and cache.metrics['api_tracks'] == 1
+
+    MockSpotify.log.clear()
+    assert client.analyze_playlist(playlist).equals(first)
+    assert cache.metrics['feature_local_hits'] == 1900 - 7 - 1
+    stats = cache.stats()
+    assert stats['feature_hit_rate'] > 0.99 and stats['estimated_saved_ms'] > 0
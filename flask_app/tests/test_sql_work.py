@@ -0,0 +1,147 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+import numpy as np
+import pandas as pd
+from feature_store import FeatureStore, DATASET_COLUMNS
+from sql_work import SQLWork, read_columnar, APPEND_BATCH_SIZE
+
+
+class TupleCursor:
+    """Executed tuple cursor over a DataFrame, rows come back as mysql-connector returns them (None for NULL)"""
+
+    def __init__(self, dataset):
+        self.description = [(column,) for column in dataset.columns]
+        self._rows = [tuple(None if pd.isna(value) else value for value in row) for row in dataset.itertuples(index=False)]
+        self.fetch_sizes = []
+
+    def fetchmany(self, size):
+        self.fetch_sizes.append(size)
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+
+class RecordingConnection:
+    """Connection whose cursor records statements, COUNT(*) over append_data returns staged_rows"""
+
+    def __init__(self, staged_rows):
+        self.staged_rows = staged_rows
+        self.executed = []
+        self.batches = []
+        self.commits = 0
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, params=None):
+        self.executed.append(' '.join(query.split()))
+
+    def executemany(self, query, rows):
+        self.batches.append(rows)
+
+    def fetchone(self):
+        return (self.staged_rows,)
+
+    def commit(self):
+        self.commits += 1
+
+    def close(self):
+        pass
+
+
+def make_dataset(num_tracks=250, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'artists': [f'artist_{i}' for i in rng.integers(0, 30, num_tracks)],
+        'track_name': [f'track_{i}' for i in range(num_tracks)],
+        'track_id': [f'id_{i}' for i in range(num_tracks)],
+        'popularity': rng.integers(0, 100, num_tracks),
+        'duration_ms': rng.integers(60000, 400000, num_tracks),
+        'danceability': rng.random(num_tracks),
+        'energy': rng.random(num_tracks),
+        'key': rng.integers(0, 12, num_tracks),
+        'loudness': rng.uniform(-30, 0, num_tracks),
+        'mode': rng.integers(0, 2, num_tracks),
+        'speechiness': rng.random(num_tracks),
+        'acousticness': rng.random(num_tracks),
+        'instrumentalness': rng.random(num_tracks),
+        'liveness': rng.random(num_tracks),
+        'valence': rng.random(num_tracks),
+        'tempo': rng.uniform(60, 200, num_tracks),
+        'time_signature': rng.integers(3, 6, num_tracks).astype(float),
+        'track_genre': rng.choice(['pop', 'rock', 'jazz'], num_tracks),
+    })[DATASET_COLUMNS]
+
+
+def test_columnar_fetch_is_typed_and_matches_rows():
+    dataset = make_dataset()
+    cursor = TupleCursor(dataset)
+    columns = read_columnar(cursor, chunk_size=64)
+
+    assert cursor.fetch_sizes == [64] * 5 # 4 chunks, then the empty fetch
+    assert list(columns.columns) == DATASET_COLUMNS
+    assert columns['danceability'].dtype == np.float32
+    assert columns['key'].dtype == np.int8 and columns['mode'].dtype == np.int8
+    assert isinstance(columns['track_genre'].dtype, pd.CategoricalDtype)
+    assert isinstance(columns['artists'].dtype, pd.CategoricalDtype)
+    assert columns['track_genre'].astype(object).tolist() == dataset['track_genre'].tolist()
+    assert columns['artists'].astype(object).tolist() == dataset['artists'].tolist()
+    assert columns['track_id'].tolist() == dataset['track_id'].tolist()
+    assert np.allclose(columns['tempo'], dataset['tempo'], rtol=1e-6)
+    assert np.array_equal(columns['duration_ms'], dataset['duration_ms'])
+
+
+def test_columnar_fetch_nulls_and_empty_result():
+    dataset = make_dataset(10)
+    dataset.loc[2, ['energy', 'key', 'track_genre']] = None
+    columns = read_columnar(TupleCursor(dataset), chunk_size=4)
+    assert np.isnan(columns.loc[2, 'energy'])
+    assert columns.loc[2, 'key'] == 0
+    assert pd.isna(columns.loc[2, 'track_genre'])
+
+    empty = read_columnar(TupleCursor(dataset.iloc[:0]))
+    assert empty.empty and list(empty.columns) == DATASET_COLUMNS
+
+
+def test_feature_store_from_columnar_fetch_matches_object_columns():
+    dataset = make_dataset()
+    dataset.loc[5, 'track_genre'] = None
+    store = FeatureStore(dataset)
+    columnar_store = FeatureStore(read_columnar(TupleCursor(dataset), chunk_size=100))
+
+    assert columnar_store.version == store.version
+    assert np.array_equal(columnar_store.encoded, store.encoded)
+    assert np.array_equal(columnar_store.genre_codes, store.genre_codes)
+    assert np.array_equal(columnar_store.artist_codes, store.artist_codes)
+    assert columnar_store.genres.tolist() == store.genres.tolist()
+
+
+def append_with(dataset, staged_rows, append_count):
+    work = SQLWork.__new__(SQLWork) # No pool, statements only go to the recording connection
+    connection = RecordingConnection(staged_rows)
+    work.pool = type('Pool', (), {'get_connection': lambda self: connection})()
+    return work.append_tracks(dataset, append_count), connection
+
+
+def test_append_tracks_inserts_in_batches():
+    dataset = make_dataset(2 * APPEND_BATCH_SIZE + 500)
+    dataset.loc[3, 'energy'] = np.nan
+    dataset.loc[4, 'track_id'] = dataset.loc[5, 'track_id'] # Repeated track, staged once
+    merged, connection = append_with(dataset, staged_rows=10, append_count=1)
+
+    assert not merged
+    assert [len(batch) for batch in connection.batches] == [APPEND_BATCH_SIZE, APPEND_BATCH_SIZE, 499]
+    rows = [row for batch in connection.batches for row in batch]
+    assert rows[0] == tuple(dataset.loc[0, DATASET_COLUMNS].tolist())
+    assert rows[3][DATASET_COLUMNS.index('energy')] is None
+    assert all(type(value) in (str, int, float) for value in rows[0]) # No numpy scalars for the driver
+    assert connection.commits == 1 and connection.executed == ['SELECT COUNT(*) FROM append_data']
+
+
+def test_append_tracks_merges_with_an_anti_join():
+    merged, connection = append_with(make_dataset(10), staged_rows=600, append_count=1)
+    assert merged and connection.commits == 2
+    merge, truncate = connection.executed[1:]
+    assert 'LEFT JOIN rec_dataset r ON r.track_id = a.track_id WHERE r.track_id IS NULL' in merge
+    assert 'NOT IN' not in merge and truncate == 'TRUNCATE TABLE append_data'
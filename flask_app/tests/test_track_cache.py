@@ -0,0 +1,111 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.preprocessing import LabelEncoder, StandardScaler
+from spotify_client import SpotifyClient
+from track_cache import TrackFeatureCache, SQLiteTrackStore, namespace
+from load_gc import model_version
+
+SCALED_COLUMNS = ['popularity', 'duration_ms', 'danceability', 'energy', 'loudness', 'speechiness', 'acousticness',
+                  'instrumentalness', 'liveness', 'valence', 'tempo']
+
+
+def features(track_id):
+    return {'id': track_id, 'danceability': 0.5, 'energy': 0.7, 'key': 3}
+
+
+class FailingStore:
+    def get_many(self, track_ids):
+        raise ConnectionError("Connection refused")
+
+    def set_many(self, field, values):
+        raise ConnectionError("Connection refused")
+
+
+class CountingModel:
+    """Predicts class 1 for above average (scaled) danceability, counting the rows it is asked about"""
+
+    def __init__(self):
+        self.rows = 0
+
+    def predict(self, data_df):
+        self.rows += len(data_df)
+        return (data_df['danceability'] > 0).astype(int).to_numpy()
+
+
+@pytest.fixture
+def class_items():
+    rng = np.random.default_rng(0)
+    scaler = StandardScaler().fit(pd.DataFrame(rng.random((20, len(SCALED_COLUMNS))), columns=SCALED_COLUMNS))
+    return {
+        'model': CountingModel(),
+        'scaler': scaler,
+        'label_encoder': LabelEncoder().fit(['chill', 'dance']),
+        'feature_set': SCALED_COLUMNS + [f'key_{i}' for i in range(12)],
+    }
+
+
+def tracks(track_ids):
+    rng = np.random.default_rng(len(track_ids))
+    data = pd.DataFrame(rng.random((len(track_ids), len(SCALED_COLUMNS))), columns=SCALED_COLUMNS)
+    data.insert(0, 'id', track_ids)
+    data['key'] = 5
+    return data
+
+
+def test_local_lru_and_shared_store(tmp_path):
+    store = SQLiteTrackStore(str(tmp_path / 'tracks.sqlite3'), 'test')
+    cache = TrackFeatureCache(store, local_size=2)
+    cache.put_features([features('a'), features('b'), features('c')])
+    cache.put_genres({'a': 'pop'})
+
+    assert list(cache._local) == ['c', 'a'] # a and b evicted, a back with its genre only
+    assert cache.get_features(['a', 'b', 'c', 'x']) == {'a': features('a'), 'b': features('b'), 'c': features('c')}
+    assert cache.metrics['feature_local_hits'] == 1 and cache.metrics['feature_store_hits'] == 2
+
+    # The store keeps features and genre of a track together
+    assert TrackFeatureCache(store).get_genres(['a', 'b']) == {'a': 'pop'}
+    assert store.get_many(['a'])['a'] == {'features': features('a'), 'genre': 'pop'}
+
+
+def test_failing_store_is_a_miss():
+    cache = TrackFeatureCache(FailingStore())
+    cache.put_features([features('a')])
+    assert cache.get_features(['a', 'b']) == {'a': features('a')} # From the LRU, b not found anywhere
+    assert cache.metrics['store_errors'] == 2
+
+
+def test_predict_skips_cached_genres(class_items):
+    cache = TrackFeatureCache()
+    client = SpotifyClient(sp=None, track_cache=cache)
+    model = class_items['model']
+
+    data = client.predict(tracks(['a', 'b', 'c']).assign(date_added=None), 'track', class_items)
+    assert model.rows == 3
+    predicted = dict(zip(data['id'], data['track_genre']))
+    assert cache.get_genres(['a', 'b', 'c']) == predicted
+
+    cache.put_genres({'a': 'chill'}) # e.g. predicted by another worker
+    data = client.predict(tracks(['a', 'b', 'c', 'd']).assign(date_added=None), 'track', class_items)
+    assert model.rows == 4 # Only d
+    genres = data.set_index('id')['track_genre'].to_dict()
+    assert genres['a'] == 'chill' and genres['b'] == predicted['b'] and genres['d'] in ('chill', 'dance')
+
+
+def test_retrained_model_misses_the_cache(tmp_path):
+    model_files = [tmp_path / name for name in ('xgboost_model.joblib', 'label_encoder.joblib', 'feature_set.joblib')]
+    for path in model_files:
+        path.write_bytes(b'v1')
+    version = model_version(model_files)
+    store_path = str(tmp_path / 'tracks.sqlite3')
+    TrackFeatureCache(SQLiteTrackStore(store_path, namespace(version))).put_genres({'a': 'pop'})
+    assert TrackFeatureCache(SQLiteTrackStore(store_path, namespace(model_version(model_files)))).get_genres(['a']) == {'a': 'pop'}
+
+    model_files[0].write_bytes(b'v2') # Retrained
+    retrained = model_version(model_files)
+    assert retrained != version
+    assert TrackFeatureCache(SQLiteTrackStore(store_path, namespace(retrained))).get_genres(['a']) == {}
@@ -0,0 +1,174 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+import threading
+import pytest
+from mysql.connector import errors
+from db_pool import ConnectionManager
+from sql_work import SQLWork
+from user_sync import UserSyncWorker
+
+
+class RecordingConnection:
+    """Connection + cursor recording statements, optionally losing the connection on the nth one"""
+
+    def __init__(self, log, fail_at=None):
+        self.log = log
+        self.fail_at = fail_at
+        self.statements = 0
+        self.rowcount = 0
+
+    def cursor(self, dictionary=False):
+        return self
+
+    def _record(self, query, params):
+        self.statements += 1
+        if self.statements == self.fail_at:
+            raise errors.OperationalError("Lost connection to MySQL server during query")
+        self.log.append((' '.join(query.split()), params))
+
+    def execute(self, query, params=()):
+        self._record(query, params)
+
+    def executemany(self, query, rows):
+        self._record(query, rows)
+
+    def commit(self):
+        self.log.append(('COMMIT', None))
+
+    def rollback(self):
+        self.log.append(('ROLLBACK', None))
+
+    def close(self):
+        pass
+
+
+def make_work(log, fail_at=None):
+    connections = []
+
+    def get_connection():
+        connections.append(RecordingConnection(log, fail_at if not connections else None))
+        return connections[-1]
+    pool = type('Pool', (), {'get_connection': staticmethod(get_connection)})
+    work = SQLWork.__new__(SQLWork) # No MySQL, statements only go to the recording connections
+    work.pool = ConnectionManager(pool_size=2, deadline=1, base_delay=0.01, pool_factory=lambda size, **cnx_config: pool)
+    return work, connections
+
+
+def login_data():
+    playlists = [
+        {'id': 'p1', 'name': 'Mine', 'images': [{'url': 'img'}], 'owner': {'id': 'user'}},
+        {'id': 'p2', 'name': 'Followed', 'images': [], 'owner': {'id': 'other'}},
+    ]
+    top_artists = {'short_term': {'items': [{'id': f'a{i}', 'name': f'Artist {i}'} for i in range(3)]}}
+    top_tracks = {'short_term': {'items': [{'id': f't{i}', 'name': f'Track {i}', 'artists': [{'name': 'Artist 0'}]} for i in range(4)]}}
+    return 'user', 'User', 'user@example.com', playlists, top_artists, top_tracks
+
+
+def test_sync_is_one_transaction_on_one_connection():
+    log = []
+    work, connections = make_work(log)
+    work.sync_user_data(*login_data())
+
+    assert len(connections) == 1 and work.pool.metrics['in_use'] == 0
+    queries = [query for query, _ in log]
+    assert queries[-1] == 'COMMIT' and queries.count('COMMIT') == 1
+    assert len(queries) == 8 # Profile, then an upsert and a delete per list
+    assert queries[0].startswith('INSERT INTO users') and 'WHERE NOT EXISTS' in queries[0]
+
+    playlists = log[1][1]
+    assert playlists == [('p1', 'Mine', 'img', 'user', 'user'), ('p2', 'Followed', None, 'other', 'user')]
+    delete_query, delete_params = log[2]
+    assert delete_query.startswith('DELETE FROM playlists WHERE unique_id = %s AND playlist_id NOT IN')
+    assert delete_params[0] == 'user' and sorted(delete_params[1:]) == ['p1', 'p2']
+    assert log[5][1][-1] == ('user', 't3', 'Track 3', 'Artist 0', 4)
+
+
+def test_sync_deletes_everything_for_empty_lists():
+    log = []
+    work, _ = make_work(log)
+    unique_id, display_name, email, _, top_artists, _ = login_data()
+    work.sync_user_data(unique_id, display_name, email, [], top_artists, {'short_term': {'items': []}})
+    deletes = [(query, params) for query, params in log if query.startswith('DELETE')]
+    assert deletes[0] == ('DELETE FROM playlists WHERE unique_id = %s', ['user'])
+    assert deletes[2] == ('DELETE FROM user_top_tracks WHERE unique_id = %s', ['user'])
+
+
+def test_sync_rolls_back_and_retries_the_whole_transaction():
+    log = []
+    work, connections = make_work(log, fail_at=4) # Lost during the artists upsert
+    work.sync_user_data(*login_data())
+
+    assert len(connections) == 2 and work.pool.metrics['retries'] == 1
+    queries = [query for query, _ in log]
+    assert queries[3] == 'ROLLBACK'
+    assert queries[4:].count('COMMIT') == 1 and len(queries[4:]) == 8 # Retried from the profile insert
+
+
+def test_worker_coalesces_and_waits():
+    started, release = threading.Event(), threading.Event()
+    synced = []
+
+    def sync(unique_id, value):
+        if value == 'first':
+            started.set()
+            release.wait(5)
+        synced.append((unique_id, value))
+    worker = UserSyncWorker(sync)
+    assert worker.wait('nobody', timeout=0) # Nothing pending
+
+    worker.submit('a', 'first')
+    assert started.wait(5)
+    worker.submit('b', 'stale')
+    worker.submit('b', 'fresh') # Replaces the queued sync of b
+    assert not worker.wait('b', timeout=0.05)
+
+    release.set()
+    assert worker.wait('b', timeout=5) and worker.wait('a', timeout=5)
+    assert synced == [('a', 'first'), ('b', 'fresh')]
+    stats = worker.stats()
+    assert stats['submitted'] == 3 and stats['coalesced'] == 1 and stats['synced'] == 2
+    assert stats['queued'] == 0 and stats['wait_timeouts'] == 1
+
+
+def test_worker_survives_a_failed_sync():
+    def sync(unique_id):
+        if unique_id == 'broken':
+            raise errors.DatabaseError("Deadlock found")
+    worker = UserSyncWorker(sync)
+    worker.submit('broken')
+    worker.submit('fine')
+    assert worker.wait('broken', timeout=5) and worker.wait('fine', timeout=5)
+    assert worker.metrics['failed'] == 1 and worker.metrics['synced'] == 1
+
+
+class SharedFlags:
+    """SessionStore's sync_pending flags, shared by the workers of a test as Redis is by worker processes"""
+
+    def __init__(self):
+        self.pending = set()
+
+    def set_sync_pending(self, unique_id):
+        self.pending.add(unique_id)
+
+    def clear_sync_pending(self, unique_id):
+        self.pending.discard(unique_id)
+
+    def is_sync_pending(self, unique_id):
+        return unique_id in self.pending
+
+
+def test_worker_waits_for_a_sync_queued_by_another_process():
+    release = threading.Event()
+    shared = SharedFlags()
+    login_worker = UserSyncWorker(lambda unique_id: release.wait(5), shared)
+    other_worker = UserSyncWorker(lambda unique_id: None, shared) # Serves the first request after the login
+
+    login_worker.submit('a')
+    assert shared.pending == {'a'}
+    assert not other_worker.wait('a', timeout=0.2)
+    release.set()
+    assert other_worker.wait('a', timeout=5)
+    assert shared.pending == set() and other_worker.wait('nobody', timeout=0)
+    assert other_worker.stats()['waits'] == 2 and other_worker.stats()['wait_timeouts'] == 1